@@ -1,4 +1,4 @@
-#!../bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 '''
@@ -17,15 +17,19 @@ from __future__ import print_function
 import argparse
 import datetime
 import json
-import urllib2
 import logging
 import logging.handlers
+import os
 import re
+import urllib.error
+import urllib.request
 from pytz import timezone
-import contextlib
 
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from harvesters_common.orion_writer import post_entities  # noqa: E402
+
 AIRQUALITY_TYPE_NAME = 'AirQualityObserved'
 
 FIWARE_SERVICE = 'AirQuality'
@@ -98,30 +102,30 @@ def get_air_quality_barcelona(target_stations):
         service_url1 = dataset_url.format(station)
 
         # Request to obtain station data
-        station_req = urllib2.Request(
+        station_req = urllib.request.Request(
             url=service_url1, headers={
                 'Accept': MIME_JSON})
         try:
-            f = urllib2.urlopen(station_req)
-        except urllib2.URLError as e:
+            f = urllib.request.urlopen(station_req)
+        except urllib.error.URLError as e:
             logger.error('Error while calling: %s : %s', service_url1, e)
             if f is not None:
                 f.close()
             continue
 
         # deal with wrong encoding
-        json_str = f.read().replace("'", '"')
-        data = json.loads(json_str, encoding='ISO-8859-15')
+        json_str = f.read().decode('ISO-8859-15').replace("'", '"')
+        data = json.loads(json_str)
         f.close()
 
         service_url2 = dataset_url2.format(station)
         # Request to obtain pollutants data
-        data_req = urllib2.Request(
+        data_req = urllib.request.Request(
             url=service_url2, headers={
                 'Accept': MIME_JSON})
         try:
-            f2 = urllib2.urlopen(data_req)
-        except urllib2.URLError as e:
+            f2 = urllib.request.urlopen(data_req)
+        except urllib.error.URLError as e:
             logger.error('Error while calling: %s : %s', service_url2, e)
             if f2 is not None:
                 f2.close()
@@ -130,9 +134,8 @@ def get_air_quality_barcelona(target_stations):
         logger.debug("All data from %s retrieved properly", station)
 
         # deal with wrong encoding
-        json_pollutants_str = f2.read().replace("'", '"')
-        pollutant_data_st = json.loads(
-            json_pollutants_str, encoding='ISO-8859-15')
+        json_pollutants_str = f2.read().decode('ISO-8859-15').replace("'", '"')
+        pollutant_data_st = json.loads(json_pollutants_str)
         f2.close()
 
         station_code = data['codiEOI']
@@ -210,6 +213,7 @@ def get_air_quality_barcelona(target_stations):
             logger.warn('No data found for station: %s', station)
 
     # Now persisting data to Orion Context Broker
+    entities = []
     for a_station in entity_data:
         if stations_to_retrieve_data:
             if a_station not in stations_to_retrieve_data:
@@ -220,7 +224,9 @@ def get_air_quality_barcelona(target_stations):
             last_measurement['id'] = 'Barcelona-AirQualityObserved' + \
                 '-' + last_measurement['stationCode']['value'] + '-' + 'latest'
 
-        post_station_data(a_station, data_for_station)
+        entities.extend(station_data_to_persist(data_for_station))
+
+    post_data(entities)
 
 
 def build_station(station_code, data):
@@ -265,56 +271,30 @@ def build_station(station_code, data):
     return station_data
 
 
-# POST data to an Orion Context Broker instance using NGSIv2 API
-def post_station_data(station_code, data):
+# Selects the entities of a station to be persisted
+def station_data_to_persist(data):
     if len(data) == 0:
-        return
-
-    data_to_be_persisted = data
+        return []
 
     if only_latest:
-        data_to_be_persisted = [data[-1]]
+        return [data[-1]]
 
-    payload = {
-        'actionType': 'APPEND',
-        'entities': data_to_be_persisted
-    }
+    return data
 
-    data_as_str = json.dumps(payload)
 
-    headers = {
-        'Content-Type': MIME_JSON,
-        'Content-Length': len(data_as_str),
-        'Fiware-Service': FIWARE_SERVICE,
-        'Fiware-Servicepath': FIWARE_SPATH
-    }
+# POST data to an Orion Context Broker instance using NGSIv2 API
+def post_data(entities):
+    global persisted_entities, in_error_entities
+
+    if len(entities) == 0:
+        return
 
-    req = urllib2.Request(
-        url=(
-            orion_service +
-            '/v2/op/update'),
-        data=data_as_str,
-        headers=headers)
+    logger.debug('Going to persist %d entities to %s', len(entities), orion_service)
 
-    logger.debug(
-        'Going to persist %s to %s - %d',
-        station_code,
-        orion_service,
-        len(data))
-
-    try:
-        with contextlib.closing(urllib2.urlopen(req)) as f:
-            global persisted_entities
-            logger.debug("Entity successfully created: %s", station_code)
-            persisted_entities = persisted_entities + 1
-    except urllib2.URLError as e:
-        global in_error_entities
-        logger.error(
-            'Error while POSTing data to Orion: %d %s',
-            e.code,
-            e.read())
-        logger.debug('Data which failed: %s', data_as_str)
-        in_error_entities = in_error_entities + 1
+    posted, failed = post_entities(entities, orion_service, service=FIWARE_SERVICE, path=FIWARE_SPATH, logger=logger)
+
+    persisted_entities = persisted_entities + posted
+    in_error_entities = in_error_entities + failed
 
 
 def setup_logger():
@@ -1,25 +1,40 @@
-#!../bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from __future__ import print_function
+"""
+    Context provider of the Madrid air quality data, with an NGSI v2 endpoint (/v2/entities) and an NGSI10 one
+    (/v1/queryContext).
+
+    It is served by aiohttp, in one event loop: the requests to Orion and the download of the dataset do not block
+    the other clients, and go through one pooled keep-alive session (up to --limit-upstream connections).
+
+    Usage:
+
+        python3 madrid_air_quality.py --orion http://orion:1026/v1/queryContext --port 1029
+
+    madrid_air_quality_load_test.py measures its latency against local stubs of Orion and of the dataset.
+
+    AsyncIO name convention:
+    async def name - entry point for asynchronous data processing/http requests and post processing
+    async def name_bounded - intermediate step to limit amount of parallel workers
+    async def name_one - worker process
+"""
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+from argparse import ArgumentParser
+from asyncio import TimeoutError as ToE, ensure_future, shield
+from functools import partial
+from os.path import abspath, dirname, join
+from sys import stdout
+from time import monotonic
 import csv
 import datetime
+import io
 import json
-from flask import Flask, jsonify, request, Response
-import urllib2
-import StringIO
-
-import sys
+import logging
 
 import ngsi_helper
 
-try:
-    xrange          # Python 2
-except NameError:
-    xrange = range  # Python 3
-
-app = Flask(__name__)
-
 AMBIENT_TYPE_NAME = 'AmbientObserved'
 
 pollutant_dict = {
@@ -86,23 +101,117 @@ other_descriptions = {
     '92': 'Acid Rain Level'
 }
 
+chunk_size = 65536                     # bytes of a response written at once
 dataset_url = 'http://datos.madrid.es/egob/catalogo/212531-7916318-calidad-aire-tiempo-real.txt'
+# Seconds the parsed dataset is answered from memory, the source is updated once per hour
+dataset_ttl = 300
+hours_per_day = 24
+limit_upstream = 100                   # max amount of connections to Orion and to the dataset
 orion_service = 'http://130.206.83.68:1026/v1/queryContext'
-
-
-@app.route('/v1/queryContext', methods=['POST'])
-def query_context():
-    msg = json.dumps(request.get_json())
+timeout = 30                           # seconds, timeout of one request to Orion or to the dataset
+
+log_levels = ['ERROR', 'INFO', 'DEBUG']
+logger = logging.getLogger('root')
+
+
+# The parsed dataset, shared by all the requests until it is older than ttl.
+# Only one request downloads it again (single-flight), the others are answered with the
+# previous one meanwhile. Only the first load makes them wait, for the same download.
+class DatasetCache(object):
+    def __init__(self, load, ttl):
+        self.load = load
+        self.ttl = ttl
+        self.data = None
+        self.loaded = 0
+        self.refresh = None
+
+    def expired(self):
+        return self.data is None or monotonic() - self.loaded >= self.ttl
+
+    async def get(self):
+        if not self.expired():
+            return self.data
+
+        if self.refresh is None:
+            self.refresh = ensure_future(self.reload())
+        if self.data is not None:
+            return self.data
+
+        # Shielded, a client which goes away does not cancel the download of the others
+        return await shield(self.refresh)
+
+    async def reload(self):
+        try:
+            self.data = await self.load()
+            self.loaded = monotonic()
+        except (ClientError, ToE, ValueError) as e:
+            # Waiting requests get the error (DatasetError if it can not be parsed), otherwise the previous
+            # dataset is kept
+            if self.data is None:
+                raise
+            logger.error('Refreshing the dataset failed, the previous one is kept: %s', e)
+        finally:
+            self.refresh = None
+
+        return self.data
+
+
+class DatasetError(ValueError):
+    pass
+
+
+class QueryError(ValueError):
+    pass
+
+
+# The parsed dataset as a (station, hour) index. Every entity is serialized once, as
+# json.dumps(entity, sort_keys=True), so queries are answered by lookups, without scans.
+class AirQualityIndex(object):
+    def __init__(self, stations):
+        self.stations = []
+        self.entities = {}
+
+        for station in stations:
+            self.stations.append(station)
+            for hour, data in enumerate(stations[station]):
+                if data['pollutants'] or 'temperature' in data:
+                    self.entities[(station, hour)] = json.dumps(data, sort_keys=True).encode('utf-8')
+
+    # JSON of the entities of the stations (all of them if not given), from hour_from to hour_to
+    # Every station is answered once, even if it is repeated in target_stations
+    def query(self, target_stations=None, hour_from=0, hour_to=hours_per_day - 1, offset=0, limit=None):
+        hour_from = max(hour_from, 0)
+        hour_to = min(hour_to, hours_per_day - 1)
+
+        count = 0
+        for station in list(dict.fromkeys(target_stations)) if target_stations else self.stations:
+            for hour in range(hour_from, hour_to + 1):
+                entity = self.entities.get((station, hour))
+                if entity is None:
+                    continue
+                if offset > 0:
+                    offset -= 1
+                    continue
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield entity
+
+
+async def query_context(request):
+    msg = await request.read()
     # A post to Orion is issued in order to get the concerned entities
 
-    req = urllib2.Request(url=orion_service, data=msg,
-                          headers={
-                              'Content-Type': 'application/json',
-                              'Accept': 'application/json'
-                          })
-    f = urllib2.urlopen(req)
-    orion_response = json.loads(f.read())
-    f.close()
+    try:
+        async with request.app['session'].post(orion_service, data=msg,
+                                               headers={
+                                                   'Content-Type': 'application/json',
+                                                   'Accept': 'application/json'
+                                               }) as response:
+            response.raise_for_status()
+            orion_response = json.loads(await response.read())
+    except (ClientError, ToE, ValueError) as e:
+        return upstream_error('Orion', e)
 
     elements = ngsi_helper.parse(orion_response)
 
@@ -121,64 +230,110 @@ def query_context():
             station_code = element['id'].split('-')[2]
             station_list.append(station_code)
 
-        entities = get_air_quality_madrid(station_list, target_hour)
+        try:
+            entities = await get_air_quality_madrid(request.app, station_list, target_hour, target_hour)
+        except (ClientError, ToE, ValueError) as e:
+            return upstream_error('the dataset', e)
     else:
         entities = []
 
-    return Response(json.dumps(entities, sort_keys=True),
-                    mimetype='application/json')
-
+    return await stream_json(request, entities)
 
-@app.route('/v2/entities', methods=['GET'])
-def v2_end_point():
-    entity_type = request.args.get('type')
-    query = request.args.get('q')
 
-    station_code = ''
-    target_hour = -1
-    if query:
-        tokens = query.split(';')
+async def v2_end_point(request):
+    entity_type = request.query.get('type')
 
-        for token in tokens:
-            items = token.split(':')
-            if items[0] == 'stationCode':
-                station_code = items[1].lower()
-            elif items[0] == 'hour':
-                target_hour = int(items[1])
+    try:
+        station_codes, hour_from, hour_to = parse_query(request.query.get('q'))
+        offset = parse_count(request.query.get('offset'), 0)
+        limit = parse_count(request.query.get('limit'), None)
+    except QueryError as e:
+        return web.json_response({'error': 'BadRequest', 'description': str(e)}, status=400)
 
     if entity_type == AMBIENT_TYPE_NAME:
-        station_codes = None
-        if station_code:
-            station_codes = [station_code]
-
-        return Response(
-            json.dumps(
-                get_air_quality_madrid(
-                    station_codes,
-                    target_hour),
-                sort_keys=True),
-            mimetype='application/json')
+        try:
+            entities = await get_air_quality_madrid(request.app, station_codes, hour_from, hour_to, offset, limit)
+        except (ClientError, ToE, ValueError) as e:
+            return upstream_error('the dataset', e)
+
+        return await stream_json(request, entities)
     else:
-        return Response(json.dumps([]), mimetype='application/json')
+        return web.json_response([])
+
+
+# The dataset is taken before the response starts, so a failed download is not a broken stream
+async def get_air_quality_madrid(app, target_stations, hour_from=0, hour_to=hours_per_day - 1, offset=0, limit=None):
+    dataset = await app['dataset'].get()
+    return dataset.query(target_stations, hour_from, hour_to, offset, limit)
+
+
+def make_app():
+    app = web.Application()
+    app.cleanup_ctx.append(setup_session)
+    app.add_routes([web.post('/v1/queryContext', query_context),
+                    web.get('/v2/entities', v2_end_point)])
+
+    return app
+
 
+def parse_count(value, default):
+    if value is None:
+        return default
 
-def get_air_quality_madrid(target_stations, target_hour=-1):
-    req = urllib2.Request(url=dataset_url)
-    f = urllib2.urlopen(req)
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise QueryError('Invalid count: ' + value)
 
-    csv_data = f.read()
-    csv_file = StringIO.StringIO(csv_data)
+    return count
+
+
+# q=stationCode:28079004,28079008;hour:10 or q=hour:6..12
+def parse_query(query):
+    station_codes = None
+    hour_from = 0
+    hour_to = hours_per_day - 1
+
+    if query:
+        tokens = query.split(';')
+
+        for token in tokens:
+            items = token.split(':', 1)
+            if len(items) != 2:
+                raise QueryError('Invalid query: ' + token)
+
+            if items[0] == 'stationCode':
+                station_codes = [code.lower() for code in items[1].split(',') if code]
+            elif items[0] == 'hour':
+                try:
+                    hours = [int(hour) for hour in items[1].split('..')]
+                except ValueError:
+                    raise QueryError('Invalid hour: ' + items[1])
+                # As before, hour:-1 is every hour
+                if hours == [-1]:
+                    hours = [0, hours_per_day - 1]
+                if len(hours) > 2 or min(hours) < 0:
+                    raise QueryError('Invalid hour: ' + items[1])
+                hour_from = hours[0]
+                hour_to = hours[-1]
+
+    return station_codes, hour_from, hour_to
+
+
+# Parses the whole dataset, the hourly data of every station
+def parse_air_quality_madrid(csv_data):
+    csv_file = io.StringIO(csv_data)
     reader = csv.reader(csv_file, delimiter=',')
 
     stations = {}
 
     for row in reader:
         station_code = str(row[0]) + str(row[1]) + str(row[2])
-        if station_code and target_stations and station_code not in target_stations:
-            continue
 
         station_num = row[2]
-        if not station_dict[station_num]:
+        if not station_dict.get(station_num):
             continue
 
         if station_code not in stations:
@@ -200,11 +355,8 @@ def get_air_quality_madrid(target_stations, target_hour=-1):
             property_desc = other_descriptions[magnitude]
             is_other = True
 
-        print('processing')
-        sys.stdout.flush()
-
         hour = 0
-        for x in xrange(9, 57, 2):
+        for x in range(9, 57, 2):
             value = row[x]
             value_control = row[x + 1]
             if len(stations[station_code]) < hour + 1:
@@ -251,30 +403,27 @@ def get_air_quality_madrid(target_stations, target_hour=-1):
                     stations[station_code][hour][property_name] = param_value
             hour += 1
 
-    # Returning data as an array
-    station_list = []
+    return AirQualityIndex(stations)
 
-    for station in stations:
-        index_from = 0
-        index_to = len(station_data)
-        station_data = stations[station]
-        if target_hour != -1:
-            index_from = target_hour
-            index_to = index_from + 1
 
-        data_list = station_data[index_from:index_to]
+async def read_air_quality_madrid(session):
+    async with session.get(dataset_url) as response:
+        response.raise_for_status()
+        csv_data = await response.text(encoding='utf-8', errors='replace')
 
-        for data in data_list:
-            if data['pollutants'] or 'temperature' in data:
-                station_list.append(data)
-    return station_list
+    # A row with missing columns or unexpected values (i.e. a truncated download or a change of format)
+    try:
+        return parse_air_quality_madrid(csv_data)
+    except (IndexError, KeyError, ValueError, csv.Error) as e:
+        raise DatasetError('The dataset can not be parsed: {!r}'.format(e)) from e
 
 
 station_dict = {}
 
 
 def read_station_csv():
-    with open('madrid_airquality_stations.csv', 'rU') as csvfile:
+    with open(join(dirname(abspath(__file__)), 'madrid_airquality_stations.csv'), 'r', encoding='utf-8',
+              newline='') as csvfile:
         reader = csv.reader(csvfile, delimiter=',')
 
         index = 0
@@ -302,6 +451,95 @@ def read_station_csv():
         }
 
 
+# One session for the requests to Orion and to the dataset, open while the app runs
+async def setup_session(app):
+    app['session'] = ClientSession(connector=TCPConnector(limit=limit_upstream), timeout=ClientTimeout(total=timeout))
+    app['dataset'] = DatasetCache(partial(read_air_quality_madrid, app['session']), dataset_ttl)
+
+    yield
+
+    await app['session'].close()
+
+
+# A JSON array, written entity by entity as json.dumps would write it, in chunks
+async def stream_json(request, entities):
+    response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+    await response.prepare(request)
+
+    chunk = bytearray(b'[')
+    separator = b''
+    for entity in entities:
+        chunk += separator + entity
+        separator = b', '
+        if len(chunk) >= chunk_size:
+            await response.write(bytes(chunk))
+            chunk = bytearray()
+    chunk += b']'
+
+    await response.write(bytes(chunk))
+    await response.write_eof()
+
+    return response
+
+
+def upstream_error(upstream, e):
+    logger.error('Request to %s failed: %s', upstream, e)
+    return web.json_response({'error': 'BadGateway', 'description': 'Request to {} failed'.format(upstream)},
+                             status=502)
+
+
 if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--dataset',
+                        action='store',
+                        default=dataset_url,
+                        dest='dataset',
+                        help='URL of the Madrid air quality dataset')
+    parser.add_argument('--dataset-ttl',
+                        action='store',
+                        default=dataset_ttl,
+                        dest='dataset_ttl',
+                        help='Seconds the parsed dataset is answered from memory')
+    parser.add_argument('--limit-upstream',
+                        action='store',
+                        default=limit_upstream,
+                        dest='limit_upstream',
+                        help='Limit amount of connections to Orion and to the dataset')
+    parser.add_argument('--log-level',
+                        action='store',
+                        default='INFO',
+                        dest='log_level',
+                        help='Set the logging output level. {0}'.format(log_levels),
+                        nargs='?')
+    parser.add_argument('--orion',
+                        action='store',
+                        default=orion_service,
+                        dest='orion',
+                        help='Orion Context Broker queryContext endpoint')
+    parser.add_argument('--port',
+                        action='store',
+                        default=1029,
+                        dest='port',
+                        help='Port of the endpoints')
+    parser.add_argument('--timeout',
+                        action='store',
+                        default=timeout,
+                        dest='timeout',
+                        help='Timeout of one request to Orion or to the dataset')
+
+    args = parser.parse_args()
+
+    if args.log_level not in log_levels:
+        parser.error('Log level must be one of {0}'.format(log_levels))
+
+    dataset_url = args.dataset
+    dataset_ttl = int(args.dataset_ttl)
+    limit_upstream = int(args.limit_upstream)
+    orion_service = args.orion
+    timeout = int(args.timeout)
+
+    logging.basicConfig(stream=stdout, level=logging.getLevelName(args.log_level),
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
     read_station_csv()
-    app.run(host='0.0.0.0', port=1029, debug=True)
+    web.run_app(make_app(), port=int(args.port), print=None)
@@ -1,4 +1,4 @@
-#!../bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
@@ -6,15 +6,18 @@ from __future__ import print_function
 import argparse
 import csv
 import datetime
-import json
-import urllib2
-import StringIO
+import io
 import logging
 import logging.handlers
+import os
 import re
+import sys
 from pytz import timezone
 import contextlib
-import copy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from harvesters_common.http_cache import HttpCache, fetch  # noqa: E402
+from harvesters_common.orion_writer import post_entities  # noqa: E402
 
 try:
     xrange  # Python 2
@@ -105,6 +108,9 @@ other_descriptions = {
 dataset_url = 'http://datos.madrid.es/egob/catalogo/' \
               '212531-7916318-calidad-aire-tiempo-real.txt'
 
+# Cache of the dataset, to skip the harvest when it did not change
+http_cache = None
+
 # Statistics for tracking purposes
 persisted_entities = 0
 in_error_entities = 0
@@ -123,10 +129,12 @@ def sanitize(str_in):
 
 # Obtains air quality data and harmonizes it, persisting to Orion
 def get_air_quality_madrid():
-    req = urllib2.Request(url=dataset_url)
-    with contextlib.closing(urllib2.urlopen(req)) as f:
-        csv_data = f.read()
-        csv_file = StringIO.StringIO(csv_data)
+    status, csv_data = fetch(dataset_url, http_cache)
+    if status == 304:
+        logger.debug('Air quality data not modified since the last harvest, nothing to persist')
+        return
+
+    with io.StringIO(csv_data.decode('utf-8')) as csv_file:
         reader = csv.reader(csv_file, delimiter=',')
 
         # Dictionary with station data indexed by station code
@@ -202,6 +210,7 @@ def get_air_quality_madrid():
                 hour += 1
 
         # Now persisting data to Orion Context Broker
+        entities = []
         for station in stations:
             if stations_to_retrieve_data:
                 if station not in stations_to_retrieve_data:
@@ -223,7 +232,9 @@ def get_air_quality_madrid():
             else:
                 logger.warn('No data retrieved for: %s', station)
 
-            post_station_data(station, data_array)
+            entities.extend(station_data_to_persist(data_array))
+
+        post_data(entities)
 
 
 #############
@@ -294,61 +305,36 @@ def build_station(station_num, station_code, hour, row):
     return station_data
 
 
-# POST data to an Orion Context Broker instance using NGSIv2 API
-def post_station_data(station_code, data):
+# Selects the entities of a station to be persisted
+def station_data_to_persist(data):
     if len(data) == 0:
-        return
-
-    data_to_be_persisted = data
+        return []
 
     if only_latest:
-        data_to_be_persisted = [data[-1]]
+        return [data[-1]]
 
-    payload = {
-        'actionType': 'APPEND',
-        'entities': data_to_be_persisted
-    }
+    return data
 
-    data_as_str = json.dumps(payload)
 
-    headers = {
-        'Content-Type': MIME_JSON,
-        'Content-Length': len(data_as_str),
-        'Fiware-Service': FIWARE_SERVICE,
-        'Fiware-Servicepath': FIWARE_SPATH
-    }
+# POST data to an Orion Context Broker instance using NGSIv2 API
+def post_data(entities):
+    global persisted_entities, in_error_entities
 
-    req = urllib2.Request(
-        url=(orion_service +
-             '/v2/op/update'),
-        data=data_as_str,
-        headers=headers)
+    if len(entities) == 0:
+        return
 
-    logger.debug(
-        'Going to persist %s to %s - %d',
-        station_code,
-        orion_service,
-        len(data))
-
-    try:
-        with contextlib.closing(urllib2.urlopen(req)) as f:
-            global persisted_entities
-            logger.debug("Entity successfully created: %s", station_code)
-            persisted_entities = persisted_entities + 1
-    except urllib2.URLError as e:
-        global in_error_entities
-        logger.error(
-            'Error while POSTing data to Orion: %d %s',
-            e.code,
-            e.read())
-        logger.debug('Data which failed: %s', data_as_str)
-        in_error_entities = in_error_entities + 1
+    logger.debug('Going to persist %d entities to %s', len(entities), orion_service)
+
+    posted, failed = post_entities(entities, orion_service, service=FIWARE_SERVICE, path=FIWARE_SPATH, logger=logger)
+
+    persisted_entities = persisted_entities + posted
+    in_error_entities = in_error_entities + failed
 
 
 # Reads station data from CSV file
 def read_station_csv():
     with contextlib.closing(
-            open('madrid_airquality_stations.csv', 'rU')) as csvfile:
+            open('madrid_airquality_stations.csv', 'r')) as csvfile:
         reader = csv.reader(csvfile, delimiter=',')
 
         index = 0
@@ -417,6 +403,9 @@ if __name__ == '__main__':
     parser.add_argument('--latest', action='store_true',
                         help='Flag to indicate to only '
                              'harvest the latest observation')
+    parser.add_argument('--http-cache', metavar='http_cache', type=str,
+                        nargs=1, help='SQLite file to cache the dataset, '
+                                      'an unchanged dataset is not persisted again')
 
     args = parser.parse_args()
 
@@ -439,6 +428,10 @@ if __name__ == '__main__':
         print('Only retrieving latest observations')
         only_latest = True
 
+    if args.http_cache:
+        http_cache = HttpCache(args.http_cache[0])
+        print('HTTP cache: ' + args.http_cache[0])
+
     setup_logger()
 
     read_station_csv()
@@ -448,6 +441,11 @@ if __name__ == '__main__':
 
     get_air_quality_madrid()
 
+    # The dataset is cached only once its entities were persisted, so that it is not skipped as not modified
+    if http_cache is not None:
+        http_cache.end(in_error_entities == 0)
+        http_cache.close()
+
     logger.debug('Number of entities persisted: %d', persisted_entities)
     logger.debug('Number of entities in error: %d', in_error_entities)
     logger.debug('#### Harvesting cycle finished ... ####')
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Load test of the Madrid air quality context provider (madrid_air_quality.py), against local stubs of its
+    upstreams: the Madrid dataset (GET /dataset) and Orion (POST /v1/queryContext), both answering after --delay
+    seconds.
+
+    Half of the requests are GET /v2/entities?type=AmbientObserved&q=stationCode:...;hour:..., the other half are
+    POST /v1/queryContext, --concurrency of them at once. The latency distribution (p50, p95, p99, max) of every
+    endpoint is printed at the end. The requests to Orion wait for a connection of the provider once
+    --limit-upstream of them are in progress.
+
+    The provider is started with the stubs as upstreams. With --provider, an already running provider is tested
+    instead, i.e. a former version, which has to use http://127.0.0.1:PORT/dataset and
+    http://127.0.0.1:PORT/v1/queryContext as upstreams (PORT is --port-stubs).
+
+    Usage:
+
+        python3 madrid_air_quality_load_test.py --requests 2000 --concurrency 50 --delay 0.2
+"""
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+from argparse import ArgumentParser
+from asyncio import Semaphore, TimeoutError as ToE, create_subprocess_exec, gather, run, sleep
+from os.path import abspath, dirname, join
+from random import choice, randint, random, seed
+from sys import executable
+from time import monotonic
+import json
+
+default_concurrency = 50               # amount of requests to the provider at once
+default_delay = 0.2                    # seconds, latency of the stubs of the upstreams
+default_limit_upstream = 100           # max amount of connections of the provider started to the upstreams
+default_port = 1029                    # port of the provider started by the load test
+default_port_stubs = 1030              # port of the stubs of the upstreams
+default_requests = 2000                # amount of requests to the provider
+
+# Codes of the stations of the dataset, and magnitudes measured by all of them (NO2, O3, temperature)
+stations = ['004', '008', '011', '016', '017', '018', '024', '027', '035', '036', '038', '039', '040', '047', '048',
+            '049', '050', '054', '055', '056', '057', '058', '059', '060']
+magnitudes = ['08', '14', '83']
+
+
+async def dataset(request):
+    await sleep(request.app['delay'])
+    return web.Response(text=request.app['csv'], content_type='text/plain')
+
+
+async def load_test(provider, requests, concurrency, delay, port, port_stubs, limit_upstream):
+    runner = web.AppRunner(make_stubs(delay))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port_stubs).start()
+
+    process = None
+    if provider is None:
+        stubs = 'http://127.0.0.1:{}'.format(port_stubs)
+        process = await create_subprocess_exec(executable, join(dirname(abspath(__file__)), 'madrid_air_quality.py'),
+                                               '--dataset', stubs + '/dataset',
+                                               '--limit-upstream', str(limit_upstream),
+                                               '--orion', stubs + '/v1/queryContext',
+                                               '--port', str(port),
+                                               '--log-level', 'ERROR')
+        provider = 'http://127.0.0.1:{}'.format(port)
+
+    latencies = dict()
+    errors = dict()
+
+    try:
+        async with ClientSession(connector=TCPConnector(limit=0), timeout=ClientTimeout(total=60)) as session:
+            await wait_provider(session, provider)
+
+            sem = Semaphore(concurrency)
+            started = monotonic()
+            await gather(*[request_bounded(session, provider, sem, latencies, errors) for _ in range(requests)])
+            elapsed = monotonic() - started
+    finally:
+        if process is not None:
+            process.terminate()
+            await process.wait()
+        await runner.cleanup()
+
+    print('{} requests, {} at once, upstreams answering in {}s'.format(requests, concurrency, delay))
+    print('{:.1f}s, {:.0f} requests/s'.format(elapsed, requests / elapsed))
+    for name in sorted(latencies):
+        values = latencies[name]
+        print('{:18} {:5} requests, {:4} errors, latency p50 {:.3f}s, p95 {:.3f}s, p99 {:.3f}s, max {:.3f}s'.format(
+            name, len(values), errors.get(name, 0), percentile(values, 50), percentile(values, 95),
+            percentile(values, 99), max(values)))
+
+
+def make_csv():
+    seed(1)
+    rows = list()
+
+    for station in stations:
+        for magnitude in magnitudes:
+            values = list()
+            for _ in range(24):
+                values += ['{:.1f}'.format(random() * 100), choice(['V', 'V', 'V', 'N'])]
+            rows.append(','.join(['28', '079', station, magnitude, '0', '0', '2019', '6', '13'] + values))
+
+    return '\n'.join(rows)
+
+
+def make_stubs(delay):
+    app = web.Application()
+    app['csv'] = make_csv()
+    app['delay'] = delay
+    app.add_routes([web.get('/dataset', dataset),
+                    web.post('/v1/queryContext', query_context)])
+
+    return app
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+async def query_context(request):
+    await request.read()
+    await sleep(request.app['delay'])
+
+    responses = list()
+    for station in stations[:randint(1, 5)]:
+        responses.append({'contextElement': {'id': 'Madrid-AmbientObserved-28079' + station,
+                                             'attributes': [{'name': 'location', 'value': '40.4,-3.7'}]}})
+
+    return web.json_response({'contextResponses': responses})
+
+
+async def request_bounded(session, provider, sem, latencies, errors):
+    async with sem:
+        await request_one(session, provider, latencies, errors)
+
+
+async def request_one(session, provider, latencies, errors):
+    if random() < 0.5:
+        name = '/v2/entities'
+        query = 'stationCode:28079{};hour:{}'.format(choice(stations), randint(0, 23))
+        call = session.get(provider + name, params={'type': 'AmbientObserved', 'q': query})
+    else:
+        name = '/v1/queryContext'
+        call = session.post(provider + name, data=json.dumps({'entities': [{'type': 'AmbientObserved'}]}),
+                            headers={'Content-Type': 'application/json'})
+
+    started = monotonic()
+    try:
+        async with call as response:
+            await response.read()
+            status = response.status
+    except (ClientError, ToE):
+        status = None
+    latency = monotonic() - started
+
+    if status != 200:
+        errors[name] = errors.get(name, 0) + 1
+    latencies.setdefault(name, list()).append(latency)
+
+
+# Waits until the provider answers, it loads the dataset on its first request
+async def wait_provider(session, provider):
+    for _ in range(100):
+        try:
+            async with session.get(provider + '/v2/entities', params={'type': 'AmbientObserved', 'limit': '1'}) as r:
+                if r.status == 200:
+                    return
+        except ClientError:
+            pass
+        await sleep(0.1)
+
+    raise RuntimeError('Provider {} is not answering'.format(provider))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--concurrency',
+                        action='store',
+                        default=default_concurrency,
+                        dest='concurrency',
+                        help='Amount of requests to the provider at once')
+    parser.add_argument('--delay',
+                        action='store',
+                        default=default_delay,
+                        dest='delay',
+                        help='Seconds the stubs of the upstreams take to answer')
+    parser.add_argument('--limit-upstream',
+                        action='store',
+                        default=default_limit_upstream,
+                        dest='limit_upstream',
+                        help='Limit amount of connections of the provider started to the upstreams')
+    parser.add_argument('--port',
+                        action='store',
+                        default=default_port,
+                        dest='port',
+                        help='Port of the provider started by the load test')
+    parser.add_argument('--port-stubs',
+                        action='store',
+                        default=default_port_stubs,
+                        dest='port_stubs',
+                        help='Port of the stubs of the upstreams')
+    parser.add_argument('--provider',
+                        action='store',
+                        dest='provider',
+                        help='URL of a running provider to test, instead of starting one')
+    parser.add_argument('--requests',
+                        action='store',
+                        default=default_requests,
+                        dest='requests',
+                        help='Amount of requests to the provider')
+
+    args = parser.parse_args()
+
+    run(load_test(args.provider, int(args.requests), int(args.concurrency), float(args.delay), int(args.port),
+                  int(args.port_stubs), int(args.limit_upstream)))
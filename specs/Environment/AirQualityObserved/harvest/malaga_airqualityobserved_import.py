@@ -1,17 +1,18 @@
-#!../bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 import csv
 import datetime
 import json
-import urllib2
-import StringIO
 import logging
 import logging.handlers
-import re
-from pytz import timezone
+import os
+import sys
 import contextlib
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from harvesters_common.orion_writer import post_entities  # noqa: E402
+
 pollutant_descriptions = {
     'NO2': 'Nitrogen Dioxide',
     'CO': 'Carbon Monoxide'
@@ -36,7 +37,7 @@ airquality_data = {}
 
 
 def read_geojson_data():
-    with contextlib.closing(open('Distritos.geojson', 'rU')) as data_file:
+    with contextlib.closing(open('Distritos.geojson', 'r')) as data_file:
         data = json.load(data_file)
 
         features = data['features']
@@ -48,7 +49,7 @@ def read_geojson_data():
                 'geometry': feature['geometry']
             }
 
-    with contextlib.closing(open('Barrios.geojson', 'rU')) as data_file:
+    with contextlib.closing(open('Barrios.geojson', 'r')) as data_file:
         data = json.load(data_file)
 
         features = data['features']
@@ -152,7 +153,7 @@ def build_entity(zone, zone_type, date):
 
 # Reads data from CSV file (origin of data are public buses)
 def get_malaga_airquality():
-    with contextlib.closing(open('hourly_no2.csv', 'rU')) as csvfile:
+    with contextlib.closing(open('hourly_no2.csv', 'r')) as csvfile:
         reader = csv.reader(csvfile, delimiter=',')
 
         index = 0
@@ -163,7 +164,7 @@ def get_malaga_airquality():
 
             process_csv_row(row, 'NO2', 'GQ')
 
-    with contextlib.closing(open('octohourly_co.csv', 'rU')) as csvfile:
+    with contextlib.closing(open('octohourly_co.csv', 'r')) as csvfile:
         reader = csv.reader(csvfile, delimiter=',')
 
         index = 0
@@ -176,63 +177,21 @@ def get_malaga_airquality():
 
     logger.debug('Number of entities built: %d', len(airquality_data.keys()))
     # Entities are persisted on batches of 10 elements
-    entity_buffer = []
-    for entry in airquality_data:
-        entity_buffer.append(airquality_data[entry])
-
-        if len(entity_buffer) == 10:
-            post_data(entity_buffer)
-            entity_buffer = []
-
-    # Last set of entities is persisted
-    post_data(entity_buffer)
+    post_data(list(airquality_data.values()))
 
 
 # POST data to an Orion Context Broker instance using NGSIv2 API
 def post_data(data):
+    global persisted_entities, in_error_entities
+
     if len(data) == 0:
         return
 
-    entity_ids = []
-    for entity in data:
-        entity_ids.append(entity['id'])
-
-    payload = {
-        'actionType': 'APPEND',
-        'entities': data
-    }
-
-    data_as_str = json.dumps(payload)
-
-    headers = {
-        'Content-Type': MIME_JSON,
-        'Content-Length': len(data_as_str),
-        'Fiware-Service': FIWARE_SERVICE,
-        'Fiware-Servicepath': FIWARE_SERVICE_PATH
-    }
+    posted, failed = post_entities(data, orion_service, service=FIWARE_SERVICE, path=FIWARE_SERVICE_PATH,
+                                   limit_entities=10, logger=logger)
 
-    req = urllib2.Request(
-        url=(
-            orion_service +
-            '/v2/op/update'),
-        data=data_as_str,
-        headers=headers)
-
-    try:
-        with contextlib.closing(urllib2.urlopen(req)) as f:
-            global persisted_entities
-            logger.debug(
-                "Entity batch successfully created: %s",
-                ', '.join(entity_ids))
-            persisted_entities = persisted_entities + 1
-    except urllib2.URLError as e:
-        global in_error_entities
-        logger.error(
-            'Error while POSTing data to Orion: %d %s',
-            e.code,
-            e.read())
-        # logger.debug('Data which failed: %s', data_as_str)
-        in_error_entities = in_error_entities + 1
+    persisted_entities = persisted_entities + posted
+    in_error_entities = in_error_entities + failed
 
 
 def setup_logger():
@@ -1,60 +1,221 @@
-# This simple Flask application allows to listen for incoming notification
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# This simple aiohttp application allows to listen for incoming notification
 # messages with air quality data from servers owned by the city of Santander
 # The notification messages are listened and data is sent to FIWARE GSMA
 # instance
+#
+# Notifications are acknowledged once their entities are appended to a
+# write-ahead spool on local disk (see harvesters_common/spool.py). A
+# background forwarder reads the spool and posts to /v2/op/update up to
+# limit_batch entities at once (a bigger notification is split between
+# flushes), waiting linger seconds for more after the first one. The position forwarded is committed to the spool only once
+# Orion took the entities, so they outlast Orion outages and restarts. Failed
+# posts (timeouts, connection problems, 5xx) are retried, with backoff, from
+# the same position. Entities rejected by Orion (4xx) are not retried.
+# While the spool holds more than limit_spool bytes to be forwarded, new
+# entities are dropped and 503 is answered.
+# GET /status returns the counters of entities queued, flushed, failed and
+# dropped, and the bytes not forwarded yet.
 
-from __future__ import print_function
-import json
-from flask import Flask, jsonify, request, Response
-import urllib2
-import contextlib
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+from argparse import ArgumentParser
+from asyncio import CancelledError, ensure_future, get_event_loop, sleep
+from os.path import abspath, dirname, join
+from time import monotonic
 import logging
 import logging.handlers
-app = Flask(__name__)
+import sys
+
+sys.path.append(join(dirname(abspath(__file__)), '..', '..', '..'))
+from harvesters_common.adaptive_limiter import AdaptiveLimiter  # noqa: E402
+from harvesters_common.dead_letter import DeadLetter  # noqa: E402
+from harvesters_common.orion_writer import OrionWriter, default_limit_target, default_limit_target_max  # noqa: E402
+from harvesters_common.spool import Spool, SpoolFull, default_max_bytes, default_segment_bytes  # noqa: E402
 
 orion_service = 'http://localhost:1030'
 FIWARE_SERVICE = 'airquality'
 FIWARE_SERVICE_PATH = '/Spain_Santander'
-MIME_JSON = 'application/json'
 SUBSCRIPTION_ID = '58a1ac701afd1c0f8f5a0d33'
 
+backoff = 1.0                          # seconds before forwarding again after a failure, doubled on every failure
+backoff_max = 60.0                     # seconds before forwarding again after a failure, at most
+dead_letter = None
+limit_batch = 500                      # entities forwarded to Orion at once, at most
+limit_spool = default_max_bytes        # bytes in the spool not forwarded yet, at most
+linger = 1.0                           # seconds an entity waits in the spool for more, at most
+segment_bytes = default_segment_bytes  # size of the segment files of the spool
+spool_folder = 'spool'
+timeout = 60                           # seconds, timeout of one request to Orion
 
-# POST data to an Orion Context Broker instance using NGSIv2 API
-def post_data(data):
-    app.logger.debug('Going to post data %d', len(data))
+logger = logging.getLogger('root')
 
-    if len(data) == 0:
-        return
 
-    payload = {
-        'actionType': 'APPEND',
-        'entities': data
-    }
+# Collects the batches which failed, given to the writer instead of a dead-letter file
+class Failures(object):
+    def __init__(self):
+        self.batches = list()
 
-    data_as_str = json.dumps(payload)
+    # Timeouts, connection problems and 5xx responses are worth retrying, rejected batches (4xx) are not
+    def retryable(self):
+        return any(not reason.startswith('response code 4') for _, reason in self.batches)
 
-    headers = {
-        'Content-Type': MIME_JSON,
-        'Content-Length': len(data_as_str),
-        'Fiware-Service': FIWARE_SERVICE,
-        'Fiware-Servicepath': FIWARE_SERVICE_PATH
-    }
+    def write(self, batch, reason):
+        self.batches.append((batch, reason))
 
-    req = urllib2.Request(
-        url=(
-            orion_service +
-            '/v2/op/update'),
-        data=data_as_str,
-        headers=headers)
 
-    try:
-        with contextlib.closing(urllib2.urlopen(req)) as f:
-            app.logger.debug("Entity batch successfully created!")
-    except urllib2.URLError as e:
-        app.logger.error(
-            'Error while POSTing data to Orion: %d %s',
-            e.code,
-            e.read())
+# Forwards the entities of the spool to Orion, one flush at a time.
+# The entities received meanwhile are forwarded together in the next one.
+class Forwarder(object):
+    def __init__(self, spool, flush, limit_batch, linger, dead_letter=None):
+        self.spool = spool
+        self.flush = flush
+        self.limit_batch = limit_batch
+        self.linger = linger
+        self.dead_letter = DeadLetter(dead_letter, logger) if dead_letter else None
+
+        # First record not forwarded in full, and amount of its entities already forwarded
+        self.position = spool.checkpoint
+        self.skip = 0
+        self.worker = None
+
+        # Amount of entities
+        self.queued = 0
+        self.flushed = 0
+        self.failed = 0
+        self.dropped = 0
+
+        # Amount of flushes retried
+        self.retries = 0
+
+    # The entities not forwarded yet stay in the spool, they are forwarded on the next start.
+    # A flush in progress is cancelled, its entities may be posted again then.
+    async def close(self):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except CancelledError:
+            pass
+
+        await self.spool.close()
+
+    # Entities of the next flush, up to limit_batch, and the position and skip after them
+    # A record with more entities than there is room for is split, the rest goes in the next flush
+    async def collect(self):
+        batch = list()
+        position, skip = self.position, self.skip
+        deadline = None
+
+        while True:
+            records, end = await self.spool.read(position, self.limit_batch - len(batch))
+            for start, entities in records:
+                if start != position:
+                    skip = 0
+                entities = entities[skip:]
+
+                room = self.limit_batch - len(batch)
+                if len(entities) > room:
+                    batch.extend(entities[:room])
+                    return batch, (start, skip + room)
+
+                batch.extend(entities)
+                position, skip = start, skip + len(entities)
+            # Every record read was taken in full
+            position, skip = end, 0
+
+            if len(batch) >= self.limit_batch:
+                break
+            if deadline is None and len(batch) > 0:
+                deadline = monotonic() + self.linger
+
+            wait = None if deadline is None else deadline - monotonic()
+            if wait is not None and wait <= 0:
+                break
+            if not await self.spool.wait(position, wait):
+                break
+
+        return batch, (position, skip)
+
+    # Returns False if the entities were dropped, the spool being full
+    async def put(self, entities):
+        if len(entities) == 0:
+            return True
+
+        try:
+            await self.spool.append(entities)
+        except (OSError, SpoolFull) as e:
+            self.dropped += len(entities)
+            logger.warning('Spool not available, %s entities dropped: %s', len(entities), e)
+            return False
+
+        self.queued += len(entities)
+        return True
+
+    async def run(self):
+        delay = backoff
+
+        while True:
+            try:
+                batch, (position, skip) = await self.collect()
+            except Exception:
+                logger.exception('Reading the spool failed, retrying in %.0f seconds', delay)
+                await sleep(delay)
+                delay = min(2 * delay, backoff_max)
+                continue
+
+            logger.debug('Flushing %s entities, %s bytes spooled', len(batch), self.spool.backlog())
+            failures = Failures()
+            try:
+                posted, failed = await self.flush(batch, failures)
+            except Exception:
+                logger.exception('Flushing %s entities failed', len(batch))
+                failures.write(batch, 'exception')
+
+            # The same entities (and the ones received meanwhile) are flushed again, the position is not committed
+            if failures.retryable():
+                self.retries += 1
+                logger.warning('Flushing %s entities failed, retrying in %.0f seconds', len(batch), delay)
+                await sleep(delay)
+                delay = min(2 * delay, backoff_max)
+                continue
+            delay = backoff
+
+            for failed_batch, reason in failures.batches:
+                if self.dead_letter is not None:
+                    await get_event_loop().run_in_executor(None, self.dead_letter.write, failed_batch, reason)
+                else:
+                    logger.error('%s entities rejected by Orion due to the %s', len(failed_batch), reason)
+
+            self.flushed += posted
+            self.failed += failed
+
+            # A record split between flushes is committed once it is forwarded in full
+            await self.spool.commit(position)
+            self.position, self.skip = position, skip
+
+    def start(self):
+        self.worker = ensure_future(self.run())
+
+    def status(self):
+        return {
+            'queued': self.queued,
+            'flushed': self.flushed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'retries': self.retries,
+            'spooled': self.spool.backlog()
+        }
+
+
+# POST data to an Orion Context Broker instance using NGSIv2 API
+# Returns the amount of entities posted and failed, the failed batches are kept in failures
+async def post_data(session, limiter, data, failures):
+    async with OrionWriter(orion_service, service=FIWARE_SERVICE, path=FIWARE_SERVICE_PATH, dead_letter=failures,
+                           session=session, limiter=limiter, logger=logger) as writer:
+        await writer.post(data)
+
+    return writer.posted, writer.failed
 
 
 def build_logger_handler():
@@ -70,40 +231,129 @@ def build_logger_handler():
     return handler
 
 
-@app.route("/")
-def hello():
-    return "Hello World!"
+async def hello(request):
+    return web.Response(text='Hello World!')
+
+
+def make_app():
+    app = web.Application()
+    app.cleanup_ctx.append(setup_spool)
+    app.add_routes([web.get('/', hello),
+                    web.post('/federate', process),
+                    web.get('/status', status)])
+
+    return app
+
 
+async def process(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
 
-@app.route("/federate", methods=['POST'])
-def process():
-    data = request.get_json()
     # Check that subscription id is correct
-    if 'subscriptionId' in data or not 'data' not in data:
-        app.logger.warn('JSON payload seems not to be appropriate')
-        return ('', 200)
+    if not isinstance(data, dict) or 'subscriptionId' not in data or 'data' not in data:
+        logger.warning('JSON payload seems not to be appropriate')
+        return web.Response(status=200)
 
     subscriptionId = data['subscriptionId']
     if subscriptionId != SUBSCRIPTION_ID:
-        app.logger.warn(
+        logger.warning(
             'Subscription id : %s. Not recognized!!',
             subscriptionId)
-        return ('', 200)
+        return web.Response(status=200)
 
-    app.logger.debug('Subscription id is correct, posting data')
+    logger.debug('Subscription id is correct, spooling data')
     # TODO: Validate the data using the JSON-Schema for air quality
-    post_data(data['data'])
+    if not await request.app['forwarder'].put(data['data']):
+        return web.Response(status=503)
+
+    return web.Response(status=200)
+
+
+# The spool, its forwarder and one session for the requests to Orion, closed when the app stops
+async def setup_spool(app):
+    spool = Spool(spool_folder, segment_bytes=segment_bytes, max_bytes=limit_spool, dead_letter=dead_letter,
+                  logger=logger)
+    await spool.open()
+
+    session = ClientSession(connector=TCPConnector(limit=default_limit_target_max), timeout=ClientTimeout(total=timeout))
+    limiter = AdaptiveLimiter(default_limit_target, max_limit=default_limit_target_max)
+
+    app['forwarder'] = Forwarder(spool, lambda data, failures: post_data(session, limiter, data, failures), limit_batch,
+                                 linger, dead_letter=dead_letter)
+    app['forwarder'].start()
 
-    return ('', 200)
+    yield
+
+    await app['forwarder'].close()
+    await session.close()
+    logger.info('Ended, %s', app['forwarder'].status())
+
+
+async def status(request):
+    return web.json_response(request.app['forwarder'].status())
 
 
 if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--dead-letter',
+                        action='store',
+                        dest='dead_letter',
+                        help='NDJSON file to store the entities which could not be posted to Orion')
+    parser.add_argument('--limit-batch',
+                        action='store',
+                        default=limit_batch,
+                        dest='limit_batch',
+                        help='Limit amount of entities flushed to Orion at once')
+    parser.add_argument('--limit-spool',
+                        action='store',
+                        default=limit_spool,
+                        dest='limit_spool',
+                        help='Limit bytes in the spool not forwarded to Orion yet, new entities are dropped beyond it')
+    parser.add_argument('--linger',
+                        action='store',
+                        default=linger,
+                        dest='linger',
+                        help='Max seconds an entity waits in the spool for more entities')
+    parser.add_argument('--orion',
+                        action='store',
+                        default=orion_service,
+                        dest='orion',
+                        help='Orion Context Broker endpoint')
+    parser.add_argument('--port',
+                        action='store',
+                        default=1050,
+                        dest='port',
+                        help='Port of the endpoint')
+    parser.add_argument('--segment-bytes',
+                        action='store',
+                        default=segment_bytes,
+                        dest='segment_bytes',
+                        help='Size of the segment files of the spool')
+    parser.add_argument('--spool',
+                        action='store',
+                        default=spool_folder,
+                        dest='spool',
+                        help='Folder of the spool of the notifications not forwarded to Orion yet')
+
+    args = parser.parse_args()
+
+    dead_letter = args.dead_letter
+    limit_batch = int(args.limit_batch)
+    limit_spool = int(args.limit_spool)
+    linger = float(args.linger)
+    orion_service = args.orion
+    segment_bytes = int(args.segment_bytes)
+    spool_folder = args.spool
+
     print('Running')
     handler = build_logger_handler()
-    app.logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
 
     print(handler)
 
-    app.logger.debug('Starting server ....')
+    logger.debug('Starting server ....')
 
-    app.run(debug=True, host="0.0.0.0", port=int("1050"))
+    web.run_app(make_app(), host="0.0.0.0", port=int(args.port), print=None)
@@ -12,6 +12,9 @@
     to Google Maps:
       - https://www.google.com/maps/d/viewer?mid=1Sd5uNFd2um0GPog2EGkyrlzmBnEKzPQw .
 
+    It can be hosted by the scheduler (harvesters_common/scheduler.py), which uploads the list of stations on the
+    schedule of its job.
+
     if AEMET data should be used, you must provide a valid API key, that can be obtained via email:
      - https://opendata.aemet.es/centrodedescargas/altaUsuario?.
 
@@ -34,21 +37,26 @@
 """
 
 from aiohttp import ClientSession, ClientConnectorError
-from asyncio import Semaphore, ensure_future, gather, run, TimeoutError as ToE, set_event_loop_policy
+from asyncio import ensure_future, gather, run, TimeoutError as ToE, set_event_loop_policy
 from argparse import ArgumentTypeError, ArgumentParser
 from copy import deepcopy
 from csv import DictWriter
 from datetime import datetime
 from io import BytesIO
+from os.path import abspath, dirname, join
 from re import sub
-from requests import get, exceptions
 from sys import stdout
 from uvloop import EventLoopPolicy
 from xlrd import open_workbook
-from yajl import loads, dumps
+from yajl import loads
 from yaml import safe_load as load, dump
 from zipfile import ZipFile
 import logging
+import sys
+
+sys.path.append(join(dirname(abspath(__file__)), '..', '..', '..', '..'))
+from harvesters_common.entity_builder import EntityBuilder  # noqa: E402
+from harvesters_common.orion_writer import OrionWriter  # noqa: E402
 
 default_limit_entities = 50           # amount of entities per 1 request to Orion
 default_limit_targets = 50            # amount of parallel request to Orion
@@ -59,7 +67,6 @@ http_ok = [200, 201, 204]
 
 log_levels = ['ERROR', 'INFO', 'DEBUG']
 logger = None
-logger_req = None
 
 stations_file_yml = 'stations.yml'   # destination file for yml format
 stations_file_csv = 'stations.csv'   # destination file for csv format
@@ -101,44 +108,54 @@ template = {
     },
 }
 
+builder = EntityBuilder(template)
+
 
-def collect_aemet(key):
+async def collect_aemet(key, session):
     logger.debug("Collection data from AEMET started")
 
     try:
-        result = get(url_aemet, headers={'api_key': key})
-    except exceptions.ConnectionError:
+        async with session.get(url_aemet, headers={'api_key': key}) as response:
+            result = await response.text()
+            status = response.status
+    except ClientConnectorError:
         logger.error('Collecting data from AEMET failed due to the connection problem')
         return False
+    except ToE:
+        logger.error('Collecting data from AEMET failed due to the timeout problem')
+        return False
 
-    if result.status_code not in http_ok:
-        logger.error('Collecting data from AEMET failed due to the return code')
+    if status not in http_ok:
+        logger.error('Collecting data from AEMET failed due to the return code %s', status)
         return False
 
-    logger.debug('Remaining requests %s', result.headers.get('Remaining-request-count'))
-    result = loads(result.text)
+    logger.debug('Remaining requests %s', response.headers.get('Remaining-request-count'))
+    result = loads(result)
 
     try:
-        result = get(result['datos'])
-    except exceptions.ConnectionError:
+        async with session.get(result['datos']) as response:
+            result = await response.text()
+            status = response.status
+    except ClientConnectorError:
         logger.error('Collecting data from AEMET failed due to the connection problem')
         return False
+    except ToE:
+        logger.error('Collecting data from AEMET failed due to the timeout problem')
+        return False
 
-    if result.status_code not in http_ok:
-        logger.error('Collecting data from AEMET failed due to the return code')
+    if status not in http_ok:
+        logger.error('Collecting data from AEMET failed due to the return code %s', status)
         return False
 
-    result = loads(result.text)
+    result = loads(result)
 
     logger.debug("Collection data from AEMET ended")
     return result
 
 
-def collect_ine():
+async def collect_ine(session):
     logger.debug("Collection data from INE started")
 
-    response = None
-
     result = dict()
     result['provinces'] = list()
     result['communities'] = list()
@@ -148,16 +165,21 @@ def collect_ine():
     url = url_ine.format(year)
 
     try:
-        response = get(url)
-    except exceptions.ConnectionError:
+        async with session.get(url) as response:
+            content = await response.read()
+            status = response.status
+    except ClientConnectorError:
         logger.error('Collecting data from INE failed due to the connection problem')
-        exit(1)
+        return False
+    except ToE:
+        logger.error('Collecting data from INE failed due to the timeout problem')
+        return False
 
-    if response.status_code not in http_ok:
-        logger.error('Collecting data from INE failed due to the connection problem')
-        exit(1)
+    if status not in http_ok:
+        logger.error('Collecting data from INE failed due to the return code %s', status)
+        return False
 
-    with ZipFile(BytesIO(response.content)) as archive:
+    with ZipFile(BytesIO(content)) as archive:
         for f in archive.filelist:
             if f.filename == 'DATOS/relacion_municipios_' + str(year) + '/' + str(year)[2:] + '_cod_ccaa.xls':
                 wb = open_workbook(file_contents=archive.read(f))
@@ -205,6 +227,27 @@ def collect_ine():
     return result
 
 
+async def collect_stations(session=None):
+    if session is None:
+        async with ClientSession() as session:
+            return await collect_stations(session)
+
+    logger.debug('Initial data collection started')
+
+    aemet = await collect_aemet(args.key, session)
+    if not aemet:
+        return False
+
+    ine = await collect_ine(session)
+    if not ine:
+        return False
+
+    result = await prepare_data(aemet, ine)
+
+    logger.debug('Initial data collection ended')
+    return result
+
+
 def convert_coordinates(coordinate):
     direction = 1
 
@@ -218,91 +261,39 @@ def convert_coordinates(coordinate):
     return round((degrees + (minutes / 60) + (seconds / 3600)) * direction, 6)
 
 
-def log_level_to_int(log_level_string):
-    if log_level_string not in log_levels:
-        message = 'invalid choice: {0} (choose from {1})'.format(log_level_string, log_levels)
-        raise ArgumentTypeError(message)
+# One cycle, the scheduler shares its session and Orion limiter with the harvesters
+async def harvest(session=None, limiter=None, executor=None):
+    source = import_stations() if args.import_yml else await collect_stations(session)
+    if not source:
+        return False
 
-    return getattr(logging, log_level_string, logging.ERROR)
+    reply_status(source)
 
+    return await post(await prepare_schema(source), session, limiter)
 
-async def post(body):
-    logger.debug('Posting data to Orion started')
 
-    tasks = list()
+def import_stations():
+    try:
+        with open(stations_file_yml, 'r') as file:
+            return load(file)
+    except FileNotFoundError:
+        logger.error('Station file is not present')
+        return False
 
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    if service:
-        headers['FIWARE-SERVICE'] = service
-
-    if path:
-        headers['FIWARE-SERVICEPATH'] = path
-
-    sem = Semaphore(limit_targets)
-
-    # splitting list to list of lists to fit into limits
-    block = 0
-    items = 0
-    body_divided = dict()
-    body_divided[0] = list()
-    while True:
-        if len(body) > 0:
-            if items < limit_entities:
-                body_divided[block].append(body.pop())
-                items += 1
-            else:
-                items = 0
-                block += 1
-                body_divided[block] = list()
-        else:
-            break
-
-    async with ClientSession() as session:
-        for item in body_divided:
-            task = ensure_future(post_bounded(body_divided[item], headers, sem, session))
-            tasks.append(task)
-
-        response = await gather(*tasks)
-
-    response = list(set(response))
-    if True in response:
-        response.remove(True)
-
-    for item in response:
-        logger.error('Posting data to Orion failed due to the %s', item)
-
-    logger.debug('Posting data to Orion ended')
-    return True
-
-
-async def post_bounded(el, headers, sem, session):
-    async with sem:
-        return await post_one(el, headers, session)
-
-
-async def post_one(el, headers, session):
-    payload = {
-        'actionType': 'APPEND',
-        'entities': el
-    }
 
-    payload = dumps(payload)
+def log_level_to_int(log_level_string):
+    if log_level_string not in log_levels:
+        message = 'invalid choice: {0} (choose from {1})'.format(log_level_string, log_levels)
+        raise ArgumentTypeError(message)
 
-    url = orion + '/v2/op/update'
-    try:
-        async with session.post(url, headers=headers, data=payload) as response:
-            status = response.status
-    except ClientConnectorError:
-        return 'connection problem'
-    except ToE:
-        return 'timeout problem'
+    return getattr(logging, log_level_string, logging.ERROR)
 
-    if status not in http_ok:
-        return 'response code ' + str(status)
 
-    return True
+async def post(body, session=None, limiter=None):
+    async with OrionWriter(orion, service=service, path=path, limit_entities=limit_entities,
+                           limit_target=limit_targets, dead_letter=dead_letter,
+                           change_cache=change_cache, session=session, limiter=limiter, logger=logger) as writer:
+        return await writer.post(body)
 
 
 async def prepare_data(aemet_data, ine_data):
@@ -432,12 +423,15 @@ async def prepare_schema(src_file, csv_flag=False):
 async def prepare_schema_one(local_id, station, csv_flag):
 
     if not csv_flag:
-        item = deepcopy(template)
-
-        item['location']['value']['coordinates'] = [station['longitude'], station['latitude']]
-        item['address']['value']['addressRegion'] = station['province']
-        item['address']['value']['addressLocality'] = station['locality']
-        item['id'] = item['id'] + local_id
+        item = builder.build(template['id'] + local_id, {
+            'address': {
+                'addressRegion': station['province'],
+                'addressLocality': station['locality']
+            },
+            'location': {
+                'coordinates': [station['longitude'], station['latitude']]
+            }
+        })
     else:
         item = deepcopy(station)
 
@@ -461,23 +455,9 @@ def sanitize(str_in):
     return sub(r"[<(>)\"\'=;]", "", str_in)
 
 
-def setup_logger():
-    local_logger = logging.getLogger('root')
-    local_logger.setLevel(log_level_to_int(args.log_level))
-
-    handler = logging.StreamHandler(stdout)
-    handler.setLevel(log_level_to_int(args.log_level))
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%dT%H:%M:%SZ')
-    handler.setFormatter(formatter)
-    local_logger.addHandler(handler)
-
-    local_logger_req = logging.getLogger('requests')
-    local_logger_req.setLevel(logging.WARNING)
-
-    return local_logger, local_logger_req
-
-
-if __name__ == '__main__':
+# Parses the arguments (the command line by default) and prepares the harvester, the scheduler uses it too
+def setup(argv=None, local_logger=None):
+    global args, change_cache, dead_letter, limit_entities, limit_targets, logger, orion, path, service
 
     parser = ArgumentParser()
     parser.add_argument('--export_csv',
@@ -488,6 +468,14 @@ if __name__ == '__main__':
                         action='store_true',
                         dest='yml',
                         help='Export the list of stations to YML file (./stations.yml) and exit')
+    parser.add_argument('--change-cache',
+                        action='store',
+                        dest='change_cache',
+                        help='SQLite file to keep track of the entities posted, so that only changed ones are posted')
+    parser.add_argument('--dead-letter',
+                        action='store',
+                        dest='dead_letter',
+                        help='NDJSON file to store the entities that could not be posted to Orion')
     parser.add_argument('--import',
                         action='store_true',
                         dest='import_yml',
@@ -523,8 +511,10 @@ if __name__ == '__main__':
                         dest="service",
                         help='FIWARE Service')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
+    change_cache = args.change_cache
+    dead_letter = args.dead_letter
     limit_entities = int(args.limit_entities)
     limit_targets = int(args.limit_targets)
     orion = args.orion
@@ -534,57 +524,58 @@ if __name__ == '__main__':
     if 'service' in args:
         service = args.service
 
-    logger, logger_req = setup_logger()
-
-    set_event_loop_policy(EventLoopPolicy())
+    if local_logger is None:
+        logger = setup_logger()
+    else:
+        logger = local_logger
 
-    logger.info('Started')
+    if not args.import_yml and not args.key:
+        logger.error('API Key is not provided')
+        exit(1)
 
-    res = None
 
-    if not args.import_yml:
-        if not args.key:
-            logger.error('API Key is not provided')
-            exit(1)
+def setup_logger():
+    local_logger = logging.getLogger('root')
+    local_logger.setLevel(log_level_to_int(args.log_level))
 
-        logger.debug('Initial data collection started')
+    handler = logging.StreamHandler(stdout)
+    handler.setLevel(log_level_to_int(args.log_level))
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%dT%H:%M:%SZ')
+    handler.setFormatter(formatter)
+    local_logger.addHandler(handler)
 
-        aemet = collect_aemet(args.key)
-        ine = collect_ine()
+    return local_logger
 
-        res = run(prepare_data(aemet, ine))
 
-        logger.debug('Initial data collection ended')
-    else:
-        try:
-            with open(stations_file_yml, 'r') as file:
-                res = load(file)
+if __name__ == '__main__':
+    setup()
 
-        except FileNotFoundError:
-            logger.error('Station file is not present')
-            exit(1)
+    set_event_loop_policy(EventLoopPolicy())
 
-    if args.csv:
-        fieldnames = ['id', 'country', 'community', 'province', 'locality', 'latitude', 'longitude', 'timezone']
+    logger.info('Started')
 
-        res = run(prepare_schema(res, True))
+    if args.csv or args.yml:
+        res = import_stations() if args.import_yml else run(collect_stations())
+        if not res:
+            exit(1)
 
-        with open(stations_file_csv, 'w', encoding='utf8') as file:
-            writer = DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
+        if args.csv:
+            fieldnames = ['id', 'country', 'community', 'province', 'locality', 'latitude', 'longitude', 'timezone']
 
-            for element in res:
-                writer.writerow(element)
+            stations = run(prepare_schema(res, True))
 
-    if args.yml:
-        with open(stations_file_yml, 'w', encoding='utf8') as file:
-            file.write(dump(res, indent=4, allow_unicode=True))
+            with open(stations_file_csv, 'w', encoding='utf8') as file:
+                writer = DictWriter(file, fieldnames=fieldnames)
+                writer.writeheader()
 
-    if not args.yml and not args.csv:
-        reply_status(res)
+                for element in stations:
+                    writer.writerow(element)
 
-        res = run(prepare_schema(res))
-        run(post(res))
+        if args.yml:
+            with open(stations_file_yml, 'w', encoding='utf8') as file:
+                file.write(dump(res, indent=4, allow_unicode=True))
+    elif not run(harvest()):
+        exit(1)
 
     logger.info('Ended')
     exit(0)
@@ -1,15 +1,15 @@
-#!../bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
 import sys
 import os
 import xml.dom.minidom
-import json
 import re
 import hashlib
-import urllib2
-import contextlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from harvesters_common.orion_writer import post_entities  # noqa: E402
 
 DEFAULT_SOURCE_FOLDER = 'INECO'
 BEACH_FOLDER = '20170510_playas/playas'
@@ -30,8 +30,6 @@ orion_service = 'http://localhost:1030'
 FIWARE_SERVICE = 'poi'
 FIWARE_SPATH = '/Spain'
 
-MIME_JSON = 'application/json'
-
 # Dictionary containing all the POIs
 pois = {}
 
@@ -91,7 +89,7 @@ def transform_data(source_folder_param):
                 id_input = categories_names[index_poi_type] + \
                     '-' + a_file + '-' + str(num_processed)
                 m = hashlib.md5()
-                m.update(id_input.decode())
+                m.update(id_input.encode('utf-8'))
 
                 description_data = get_description(DOMTree, index_poi_type)
 
@@ -202,47 +200,28 @@ def get_description(DOMTree, index_poi_type):
 
 
 def import_data():
+    data = []
     for poi_type in pois:
         poi_list = pois[poi_type]
 
         print(poi_type, len(poi_list))
 
-        post_data(poi_list)
+        data.extend(poi_list)
+
+    post_data(data)
 
 
 # POST data to an Orion Context Broker instance using NGSIv2 API
 def post_data(data):
+    global persisted_entities, in_error_entities
+
     if len(data) == 0:
         return
 
-    payload = {
-        'actionType': 'APPEND',
-        'entities': data
-    }
-
-    data_as_str = json.dumps(payload)
-
-    headers = {
-        'Content-Type': MIME_JSON,
-        'Content-Length': len(data_as_str),
-        'Fiware-Service': FIWARE_SERVICE,
-        'Fiware-Servicepath': FIWARE_SPATH
-    }
-
-    req = urllib2.Request(
-        url=(
-            orion_service +
-            '/v2/op/update'),
-        data=data_as_str,
-        headers=headers)
-
-    try:
-        with contextlib.closing(urllib2.urlopen(req)) as f:
-            global persisted_entities
-            persisted_entities = persisted_entities + 1
-    except urllib2.URLError as e:
-        global in_error_entities
-        in_error_entities = in_error_entities + 1
+    posted, failed = post_entities(data, orion_service, service=FIWARE_SERVICE, path=FIWARE_SPATH)
+
+    persisted_entities = persisted_entities + posted
+    in_error_entities = in_error_entities + failed
 
 
 if __name__ == '__main__':
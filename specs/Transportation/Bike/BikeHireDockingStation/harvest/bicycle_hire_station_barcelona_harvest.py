@@ -1,4 +1,4 @@
-#!bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 """
@@ -6,17 +6,19 @@ Harmonises data from the city of Barcelona corresponding to
 the bicycle hiring stations
 """
 
-from __future__ import print_function
 import contextlib
 import json
+import os
+import sys
 from datetime import datetime
 from pytz import timezone
 import re
-try:                 # Python 3
-    from urllib.request import Request, urlopen
-    from urllib.error import URLError
-except ImportError:  # Python 2
-    from urllib2 import Request, URLError, urlopen
+from urllib.request import Request, urlopen
+from urllib.error import URLError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..'))
+from harvesters_common.change_cache import ChangeCache  # noqa: E402
+from harvesters_common.orion_writer import post_entities  # noqa: E402
 
 
 # Origin of the Data (Barcelona's open data)
@@ -29,12 +31,16 @@ status_dictionary = {
 
 barcelona_tz = timezone('CET')
 
-MIME_JSON = 'application/json'
 FIWARE_SERVICE = 'Bicycle'
 FIWARE_SERVICE_PATH = "/Barcelona"
 
 DATA_BROKER = 'http://localhost:1026'
 
+# Entities posted in previous runs, only changed stations are posted again
+CHANGE_CACHE = 'bike_stations_changes.db'
+# Seconds after which an unchanged station is posted anyway, so a station lost by Orion comes back
+CHANGE_CACHE_MAX_AGE = 3600
+
 """
 See
 # http://fiware-datamodels.readthedocs.io/en/latest/
@@ -117,33 +123,18 @@ def harmonize_station(station_data):
 
 # Persists the data to a Data Broker supporting FIWARE NGSI v2
 def persist_data(entity_list):
-    # print json.dumps(entity_list)
-
-    data_obj = {
-        'actionType': 'APPEND',
-        'entities': entity_list
-    }
-    data_as_str = json.dumps(data_obj)
+    # The timestamp of the metadata changes on every run
+    change_cache = ChangeCache(CHANGE_CACHE, ignore=['metadata'], max_age=CHANGE_CACHE_MAX_AGE)
 
-    headers = {
-        'Content-Type': MIME_JSON,
-        'Content-Length': len(data_as_str),
-        'Fiware-Service': FIWARE_SERVICE,
-        'Fiware-Servicepath': FIWARE_SERVICE_PATH
-    }
+    posted, failed = post_entities(entity_list, DATA_BROKER, service=FIWARE_SERVICE, path=FIWARE_SERVICE_PATH,
+                                   change_cache=change_cache)
 
-    req = Request(
-        url=(
-            DATA_BROKER +
-            '/v2/op/update'),
-        data=data_as_str,
-        headers=headers)
+    change_cache.close()
 
-    try:
-        with contextlib.closing(urlopen(req)) as f:
-            print('Entities successfully created')
-    except URLError as e:
-        print('Error while POSTing data to Orion: %d %s' % (e.code, e.read()))
+    if failed == 0:
+        print('Entities successfully created')
+    else:
+        print('Error while POSTing data to Orion: %d entities failed' % failed)
 
 
 # Main module
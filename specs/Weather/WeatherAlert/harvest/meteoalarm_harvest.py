@@ -4,17 +4,19 @@
 Get Europe WeatherAlarms as offered by Meteoalarm.eu
 """
 
-import StringIO
+import os
 import re
-import urllib2
+import sys
 import xml.dom.minidom
 import datetime
-import json
 import argparse
 import logging
 import logging.handlers
 import unicodedata
-import contextlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from harvesters_common.http_cache import HttpCache, fetch  # noqa: E402
+from harvesters_common.orion_writer import post_entities  # noqa: E402
 
 awareness_type_dict = {
     '1': 'wind',
@@ -45,11 +47,14 @@ reg_exp = re.compile('<img(?P<group>.*?)>')
 
 countries_to_retrieve = []
 
+# Cache of the feeds, to skip the countries whose alarms did not change
+http_cache = None
+
 
 # Sanitize string to avoid forbidden characters by Orion
 def sanitize(str_in):
     aux = re.sub(r"[<(>)\"\'=;-]", "", str_in)
-    return unicodedata.normalize('NFD', aux).encode('ascii', 'ignore')
+    return unicodedata.normalize('NFD', aux).encode('ascii', 'ignore').decode('ascii')
 
 
 def get_weather_alarms(country):
@@ -57,10 +62,11 @@ def get_weather_alarms(country):
 
     logger.debug("Going to GET %s", source)
 
-    req = urllib2.Request(url=source)
-    f = urllib2.urlopen(req)
+    status, xml_data = fetch(source, http_cache)
+    if status == 304:
+        logger.debug("%s not modified since the last harvest, skipped", source)
+        return []
 
-    xml_data = f.read()
     final_data = xml_data
     DOMTree = xml.dom.minidom.parseString(final_data).documentElement
 
@@ -75,7 +81,7 @@ def get_weather_alarms(country):
             'description')[0].firstChild.nodeValue
         # Enable description parsing
         description = description.replace('&nbsp;', '')
-        description = re.sub(reg_exp, '<img\g<group>></img>', description)
+        description = re.sub(reg_exp, r'<img\g<group>></img>', description)
 
         zone = item.getElementsByTagName(
             'title')[0].firstChild.nodeValue.strip()
@@ -204,43 +210,15 @@ def setup_logger():
     logger.addHandler(handler)
 
 
+# Returns True if all the entities were posted
 def persist_entities(data):
-    data_to_be_persisted = data
-
-    data_obj = {
-        'actionType': 'APPEND',
-        'entities': data_to_be_persisted
-    }
-    data_as_str = json.dumps(data_obj)
-
-    headers = {
-        'Content-Type': 'application/json',
-        'Content-Length': len(data_as_str)
-    }
+    posted, failed = post_entities(data, orion_service, service=fiware_service, path=fiware_service_path,
+                                   logger=logger)
 
-    if fiware_service:
-        headers['Fiware-Service'] = fiware_service
+    if failed == 0:
+        logger.debug('Entities successfully created')
 
-    if fiware_service_path:
-        headers['Fiware-Servicepath'] = fiware_service_path
-
-    req = urllib2.Request(
-        url=(
-            orion_service +
-            '/v2/op/update'),
-        data=data_as_str,
-        headers=headers)
-
-    try:
-        with contextlib.closing(urllib2.urlopen(req)) as f:
-            logger.debug('Entities successfully created')
-    except urllib2.URLError as e:
-        logger.error('Error!!!')
-        logger.error(
-            'Error while POSTing data to Orion: %d %s',
-            e.code,
-            e.read())
-        logger.debug('Data which failed: %s', data_as_str)
+    return failed == 0
 
 
 if __name__ == '__main__':
@@ -251,6 +229,8 @@ if __name__ == '__main__':
                         type=str, nargs='?', help='FIWARE Service Path')
     parser.add_argument('--endpoint', metavar='endpoint',
                         type=str, required=True, help='Context Broker end point. Example. http://orion:1030')
+    parser.add_argument('--http-cache', metavar='http_cache',
+                        type=str, help='SQLite file to cache the feeds, unchanged alarms are not persisted again')
     parser.add_argument('countries', metavar='countries', type=str, nargs='+',
                         help='Country Codes separated by spaces. ')
 
@@ -270,13 +250,24 @@ if __name__ == '__main__':
         orion_service = args.endpoint
         print('Context Broker: ' + orion_service)
 
+    if args.http_cache:
+        http_cache = HttpCache(args.http_cache)
+        print('HTTP cache: ' + args.http_cache)
+
     for s in args.countries:
         countries_to_retrieve.append(s)
 
     setup_logger()
 
+    alarms = []
     for c in countries_to_retrieve:
         logger.debug("Going to retrieve data from country: %s", c)
-        alarms = get_weather_alarms(c)
-        logger.debug("Going to persist data from country: %s", c)
-        persist_entities(alarms)
+        alarms.extend(get_weather_alarms(c))
+
+    logger.debug("Going to persist data from countries: %s", ', '.join(countries_to_retrieve))
+    persisted = persist_entities(alarms)
+
+    # The feeds are cached only once their alarms were persisted, so that they are not skipped as not modified
+    if http_cache is not None:
+        http_cache.end(persisted)
+        http_cache.close()
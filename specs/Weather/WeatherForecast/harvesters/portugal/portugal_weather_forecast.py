@@ -22,18 +22,25 @@
 
 from aiohttp import ClientSession, ClientConnectorError
 from argparse import ArgumentTypeError, ArgumentParser
-from asyncio import Semaphore, ensure_future, gather, run, TimeoutError as ToE, set_event_loop_policy
-from copy import deepcopy
+from asyncio import Semaphore, as_completed, ensure_future, run, TimeoutError as ToE, set_event_loop_policy
 from datetime import datetime, timedelta
+from os.path import abspath, dirname, join
 from pytz import timezone
 from re import sub
 from requests import get, exceptions
 from sys import stdout
 from time import sleep
 from uvloop import EventLoopPolicy
-from yajl import dumps, loads
+from yajl import loads
 from yaml import safe_load as load
 import logging
+import sys
+
+sys.path.append(join(dirname(abspath(__file__)), '..', '..', '..', '..'))
+from harvesters_common.entity_builder import EntityBuilder  # noqa: E402
+from harvesters_common.http_cache import HttpCache  # noqa: E402
+from harvesters_common.orion_writer import OrionWriter  # noqa: E402
+from harvesters_common.pipeline import pipeline  # noqa: E402
 
 default_latest = False                # preserve only latest values
 default_limit_entities = 50           # amount of entities per 1 request to Orion
@@ -42,6 +49,7 @@ default_limit_target = 50             # amount of parallel request to Orion
 default_log_level = 'INFO'
 default_orion = 'http://orion:1026'   # Orion Contest Broker endpoint
 default_timeout = -1                  # if value != -1, then work as a service
+default_workers = None                # amount of processes to prepare the schema, one per CPU by default
 
 http_ok = [200, 201, 204]
 
@@ -140,6 +148,8 @@ template = {
     }
 }
 
+builder = EntityBuilder(template)
+
 
 def check_entity(forecast, item):
     if item in forecast:
@@ -224,25 +234,29 @@ def decode_wind_direction(item):
     return out if out else None
 
 
-async def collect():
+# session - shared by the harvesters of the scheduler, one is opened here if not given
+async def collect(session=None):
+    if session is None:
+        async with ClientSession() as session:
+            async for item in collect(session):
+                yield item
+        return
+
     logger.debug('Connecting data from IPMA started')
 
     tasks = list()
 
     sem = Semaphore(limit_source)
 
-    async with ClientSession() as session:
-        for station in stations:
-            task = ensure_future(collect_bounded(station, sem, session))
-            tasks.append(task)
-
-        result = await gather(*tasks)
+    for station in stations:
+        task = ensure_future(collect_bounded(station, sem, session))
+        tasks.append(task)
 
-    while False in result:
-        result.remove(False)
+    # Stations are passed on to the schema preparation as soon as they are collected
+    for task in as_completed(tasks):
+        yield await task
 
     logger.debug('Collecting data from IPMA ended')
-    return result
 
 
 async def collect_bounded(station, sem, session):
@@ -252,10 +266,13 @@ async def collect_bounded(station, sem, session):
 
 async def collect_one(station, session):
 
+    url = stations[station]['url']
     try:
-        async with session.get(stations[station]['url']) as response:
+        async with session.get(url, headers=None if http_cache is None else http_cache.headers(url)) as response:
             result = await response.text()
             status = response.status
+            if http_cache is not None:
+                http_cache.store(url, status, response.headers, result)
     except ClientConnectorError:
         logger.error('Collecting data from IPMA station %s failed due to the connection problem', station)
         return False
@@ -263,6 +280,10 @@ async def collect_one(station, session):
         logger.error('Collecting link from IPMA station %s failed due to the timeout problem', station)
         return False
 
+    if status == 304:
+        logger.debug('Collecting data from IPMA station %s skipped, not modified', station)
+        return False
+
     if status not in http_ok:
         logger.error('Collecting data from IPMA station %s failed due to the return code %s', station, status)
         return False
@@ -303,6 +324,23 @@ async def collect_one(station, session):
     return result
 
 
+# One cycle, the scheduler shares its session, Orion limiter and process pool (executor) with the harvesters
+async def harvest(session=None, limiter=None, executor=None):
+    result = False
+    try:
+        async with OrionWriter(orion, service=service, path=path, limit_entities=limit_entities,
+                               limit_target=limit_target, dead_letter=dead_letter, session=session, limiter=limiter,
+                               logger=logger) as writer:
+            result = await pipeline(collect(session), prepare_schema_one, writer, workers=workers,
+                                    initializer=setup_worker, initargs=(stations, latest), executor=executor,
+                                    logger=logger)
+    finally:
+        if http_cache is not None:
+            http_cache.end(result)
+
+    return result
+
+
 def log_level_to_int(log_level_string):
     if log_level_string not in log_levels:
         message = 'invalid choice: {0} (choose from {1})'.format(log_level_string, log_levels)
@@ -311,101 +349,7 @@ def log_level_to_int(log_level_string):
     return getattr(logging, log_level_string, logging.ERROR)
 
 
-async def post(body):
-    logger.debug('Posting data to Orion started')
-
-    tasks = list()
-
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    if service:
-        headers['FIWARE-SERVICE'] = service
-
-    if path:
-        headers['FIWARE-SERVICEPATH'] = path
-
-    sem = Semaphore(limit_target)
-
-    # splitting list to list of lists to fit into limits
-    block = 0
-    items = 0
-    body_divided = dict()
-    body_divided[0] = list()
-    while True:
-        if len(body) > 0:
-            if items < limit_entities:
-                body_divided[block].append(body.pop())
-                items += 1
-            else:
-                items = 0
-                block += 1
-                body_divided[block] = list()
-        else:
-            break
-
-    async with ClientSession() as session:
-        for item in body_divided:
-            task = ensure_future(post_bounded(body_divided[item], headers, sem, session))
-            tasks.append(task)
-
-        response = await gather(*tasks)
-
-    response = list(set(response))
-    if True in response:
-        response.remove(True)
-
-    for item in response:
-        logger.error('Posting data to Orion failed due to the %s', item)
-
-    logger.debug('Posting data to Orion ended')
-
-
-async def post_bounded(item, headers, sem, session):
-    async with sem:
-        return await post_one(item, headers, session)
-
-
-async def post_one(item, headers, session):
-    payload = {
-        'actionType': 'APPEND',
-        'entities': item
-    }
-
-    payload = dumps(payload)
-
-    url = orion + '/v2/op/update'
-    try:
-        async with session.post(url, headers=headers, data=payload) as response:
-            status = response.status
-    except ClientConnectorError:
-        return 'connection problem'
-    except ToE:
-        return 'timeout problem'
-
-    if status not in http_ok:
-        return 'response code ' + str(status)
-
-    return True
-
-
-async def prepare_schema(source):
-    logger.debug('Schema preparation started')
-
-    tasks = list()
-
-    for item in source:
-        task = ensure_future(prepare_schema_one(item))
-        tasks.append(task)
-
-    result = await gather(*tasks)
-
-    logger.debug('Schema preparation ended')
-
-    return [j for i in result for j in i]
-
-
-async def prepare_schema_one(source):
+def prepare_schema_one(source):
     result = list()
     id_local = source['id']
 
@@ -413,9 +357,12 @@ async def prepare_schema_one(source):
     tomorrow = (datetime.now(tz) + timedelta(days=1)).strftime("%Y-%m-%d") + 'T00:00:00'
     retrieved = source['retrieved'].replace(tzinfo=tz).isoformat().replace('+00:00', 'Z')
 
-    for date in source['forecasts']:
+    address = {
+        'addressLocality': stations[id_local]['addressLocality'],
+        'postalCode': stations[id_local]['postalCode']
+    }
 
-        item = deepcopy(template)
+    for date in source['forecasts']:
 
         forecast = source['forecasts'][date]
 
@@ -432,73 +379,44 @@ async def prepare_schema_one(source):
         valid_to_iso = valid_to.isoformat().replace('+00:00', 'Z')
         valid_to_short = valid_to.strftime('%H:%M:%S')
 
+        item_id = template['id']
         if latest:
             if date == today:
-                item['id'] = item['id'] + id_local + '_today_' + valid_from_short + '_' + valid_to_short
+                item_id = item_id + id_local + '_today_' + valid_from_short + '_' + valid_to_short
             if date == tomorrow:
-                item['id'] = item['id'] + id_local + '_tomorrow_' + valid_from_short + '_' + valid_to_short
+                item_id = item_id + id_local + '_tomorrow_' + valid_from_short + '_' + valid_to_short
         else:
-            item['id'] = item['id'] + id_local + '_' + valid_from_iso + '_' + valid_to_iso
-
-        item['address']['value']['addressLocality'] = stations[id_local]['addressLocality']
-        item['address']['value']['postalCode'] = stations[id_local]['postalCode']
-
-        item['dateIssued']['value'] = issued
-
-        item['dateRetrieved']['value'] = retrieved
+            item_id = item_id + id_local + '_' + valid_from_iso + '_' + valid_to_iso
+
+        values = {
+            'address': address,
+            'dateIssued': issued,
+            'dateRetrieved': retrieved,
+            'feelsLikeTemperature': to_float(forecast['feelsLikeTemperature']),
+            'precipitationProbability': to_float(forecast['precipitationProbability'], 100),
+            'relativeHumidity': to_float(forecast['relativeHumidity']),
+            'temperature': to_float(forecast['temperature']),
+            'validFrom': valid_from_iso,
+            'validTo': valid_to_iso,
+            'validity': valid_from_iso + '/' + valid_to_iso
+        }
 
         if 'tMax' in forecast:
-            item['dayMaximum']['value']['temperature'] = float(forecast['tMax'])
-        else:
-            del item['dayMaximum']
+            values['dayMaximum'] = {'temperature': float(forecast['tMax'])}
 
         if 'tMin' in forecast:
-            item['dayMinimum']['value']['temperature'] = float(forecast['tMin'])
-        else:
-            del item['dayMinimum']
-
-        if forecast['feelsLikeTemperature'] is not None:
-            item['feelsLikeTemperature']['value'] = float(forecast['feelsLikeTemperature'])
-        else:
-            del item['feelsLikeTemperature']
-
-        if forecast['precipitationProbability'] is not None:
-            item['precipitationProbability']['value'] = float(forecast['precipitationProbability'] / 100)
-        else:
-            del item['precipitationProbability']
-
-        if forecast['relativeHumidity'] is not None:
-            item['relativeHumidity']['value'] = float(forecast['relativeHumidity'])
-        else:
-            del item['relativeHumidity']
-
-        if forecast['temperature'] is not None:
-            item['temperature']['value'] = float(forecast['temperature'])
-        else:
-            del item['temperature']
-
-        item['validFrom']['value'] = valid_from_iso
-
-        item['validTo']['value'] = valid_to_iso
-
-        item['validity']['value'] = valid_from_iso + '/' + valid_to_iso
+            values['dayMinimum'] = {'temperature': float(forecast['tMin'])}
 
         if forecast['weatherType'] is not None:
-            item['weatherType']['value'] = decode_weather_type(forecast['weatherType'])
-
-        if item['weatherType']['value'] is None:
-            del item['weatherType']
+            values['weatherType'] = decode_weather_type(forecast['weatherType'])
 
         if forecast['windDirection'] is not None:
-            item['windDirection']['value'] = decode_wind_direction(forecast['windDirection'])
-
-        if item['windDirection']['value'] is None:
-            del item['windDirection']
+            values['windDirection'] = decode_wind_direction(forecast['windDirection'])
 
         if forecast['windSpeed'] is not None:
-            item['windSpeed']['value'] = round(float(forecast['windSpeed']) * 0.28, 2)
-        else:
-            del item['windSpeed']
+            values['windSpeed'] = round(float(forecast['windSpeed']) * 0.28, 2)
+
+        item = builder.build(item_id, values)
 
         result.append(item)
 
@@ -514,6 +432,7 @@ def reply_status():
     logger.info('Latest: %s', str(latest))
     logger.info('Limit_source: %s', str(limit_source))
     logger.info('limit_target: %s', str(limit_target))
+    logger.info('Workers: %s', str(workers))
     logger.info('Log level: %s', args.log_level)
     logger.info('Started')
 
@@ -522,6 +441,97 @@ def sanitize(str_in):
     return sub(r"[<(>)\"\'=;-]", "", str_in)
 
 
+# Parses the arguments (the command line by default) and prepares the harvester, the scheduler uses it too
+def setup(argv=None, local_logger=None):
+    global args, dead_letter, http_cache, latest, limit_entities, limit_source, limit_target, logger, logger_req
+    global orion, path, service, stations, timeout, workers
+
+    parser = ArgumentParser()
+    parser.add_argument('--config',
+                        dest='config',
+                        help='YAML file with list of stations to be collected or excluded from collecting')
+    parser.add_argument('--dead-letter',
+                        action='store',
+                        dest='dead_letter',
+                        help='NDJSON file to store the entities that could not be posted to Orion')
+    parser.add_argument('--http-cache',
+                        action='store',
+                        dest='http_cache',
+                        help='SQLite file to cache the responses of the source, unchanged data is not posted again')
+    parser.add_argument('--latest',
+                        action='store_true',
+                        default=default_latest,
+                        dest='latest',
+                        help='Collect only latest forecast')
+    parser.add_argument('--limit-entities',
+                        default=default_limit_entities,
+                        dest='limit_entities',
+                        help='Limit amount of entities per 1 request to orion')
+    parser.add_argument('--limit-source',
+                        default=default_limit_source,
+                        dest='limit_source',
+                        help='Limit amount of parallel requests to IPMA')
+    parser.add_argument('--limit-target',
+                        default=default_limit_target,
+                        dest='limit_target',
+                        help='Limit amount of parallel requests to Orion')
+    parser.add_argument('--log-level',
+                        default=default_log_level,
+                        dest='log_level',
+                        help='Set the logging output level. {0}'.format(log_levels),
+                        nargs='?')
+    parser.add_argument('--orion',
+                        action='store',
+                        default=default_orion,
+                        dest='orion',
+                        help='Orion Context Broker endpoint')
+    parser.add_argument('--path',
+                        action='store',
+                        dest='path',
+                        help='FIWARE Service Path')
+    parser.add_argument('--service',
+                        action='store',
+                        dest="service",
+                        help='FIWARE Service')
+    parser.add_argument('--timeout',
+                        action='store',
+                        default=default_timeout,
+                        dest='timeout',
+                        help='Run as a service')
+    parser.add_argument('--workers',
+                        action='store',
+                        default=default_workers,
+                        dest='workers',
+                        help='Amount of processes to prepare the schema, one per CPU by default')
+
+    args = parser.parse_args(argv)
+
+    latest = args.latest
+    dead_letter = args.dead_letter
+    http_cache = HttpCache(args.http_cache) if args.http_cache else None
+    limit_entities = int(args.limit_entities)
+    limit_source = int(args.limit_source)
+    limit_target = int(args.limit_target)
+    orion = args.orion
+    timeout = int(args.timeout)
+    workers = int(args.workers) if args.workers else None
+
+    if 'path' in args:
+        path = args.path
+    if 'service' in args:
+        service = args.service
+
+    if local_logger is None:
+        logger, logger_req = setup_logger()
+    else:
+        logger = local_logger
+
+    res = setup_stations_config(args.config)
+    stations = setup_stations(res)
+
+    reply_status()
+
+
 def setup_logger():
     local_logger = logging.getLogger('root')
     local_logger.setLevel(log_level_to_int(args.log_level))
@@ -628,81 +638,29 @@ def setup_config_re(station):
     return "- '{}'\n".format(fix)
 
 
-if __name__ == '__main__':
-
-    parser = ArgumentParser()
-    parser.add_argument('--config',
-                        dest='config',
-                        help='YAML file with list of stations to be collected or excluded from collecting')
-    parser.add_argument('--latest',
-                        action='store_true',
-                        default=default_latest,
-                        dest='latest',
-                        help='Collect only latest forecast')
-    parser.add_argument('--limit-entities',
-                        default=default_limit_entities,
-                        dest='limit_entities',
-                        help='Limit amount of entities per 1 request to orion')
-    parser.add_argument('--limit-source',
-                        default=default_limit_source,
-                        dest='limit_source',
-                        help='Limit amount of parallel requests to IPMA')
-    parser.add_argument('--limit-target',
-                        default=default_limit_target,
-                        dest='limit_target',
-                        help='Limit amount of parallel requests to Orion')
-    parser.add_argument('--log-level',
-                        default=default_log_level,
-                        dest='log_level',
-                        help='Set the logging output level. {0}'.format(log_levels),
-                        nargs='?')
-    parser.add_argument('--orion',
-                        action='store',
-                        default=default_orion,
-                        dest='orion',
-                        help='Orion Context Broker endpoint')
-    parser.add_argument('--path',
-                        action='store',
-                        dest='path',
-                        help='FIWARE Service Path')
-    parser.add_argument('--service',
-                        action='store',
-                        dest="service",
-                        help='FIWARE Service')
-    parser.add_argument('--timeout',
-                        action='store',
-                        default=default_timeout,
-                        dest='timeout',
-                        help='Run as a service')
+# Worker processes of the pipeline may not share the globals set in __main__
+def setup_worker(local_stations, local_latest):
+    global latest, logger, stations
 
-    args = parser.parse_args()
+    latest = local_latest
+    logger = logging.getLogger('root')
+    stations = local_stations
 
-    latest = args.latest
-    limit_entities = int(args.limit_entities)
-    limit_source = int(args.limit_source)
-    limit_target = int(args.limit_target)
-    orion = args.orion
-    timeout = int(args.timeout)
 
-    if 'path' in args:
-        path = args.path
-    if 'service' in args:
-        service = args.service
+def to_float(value, divisor=1):
+    if value is None:
+        return None
 
-    logger, logger_req = setup_logger()
+    return float(value) / divisor
 
-    set_event_loop_policy(EventLoopPolicy())
 
-    res = setup_stations_config(args.config)
-    stations = setup_stations(res)
+if __name__ == '__main__':
+    setup()
 
-    reply_status()
+    set_event_loop_policy(EventLoopPolicy())
 
     while True:
-        res = run(collect())
-        if res:
-            res = run(prepare_schema(res))
-            run(post(res))
+        run(harvest())
         if timeout == -1:
             break
         else:
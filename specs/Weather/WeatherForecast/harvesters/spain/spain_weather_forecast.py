@@ -22,39 +22,47 @@
     async def name_bounded - intermediate step to limit amount of parallel workers
     async def name_one - worker process
 
-    Warning! AEMET open data portal has a requests limit. So you can't make more then 149 requests from one try.
-    This limit will be removed in the next version.
+    Warning! AEMET open data portal has a requests limit. Requests with the API key are rate limited (token bucket),
+    by default up to 149 requests per minute, see --limit-rate.
 """
 
-from aiohttp import ClientSession, ClientConnectorError
+from aiohttp import ClientSession, ClientConnectorError, TCPConnector
 from argparse import ArgumentTypeError, ArgumentParser
-from asyncio import Semaphore, ensure_future, gather, run, TimeoutError as ToE, set_event_loop_policy
-from copy import deepcopy
+from asyncio import Semaphore, as_completed, ensure_future, run, TimeoutError as ToE, set_event_loop_policy
 from datetime import datetime, timedelta
+from os.path import abspath, dirname, join
 from pytz import timezone
 from re import sub
-from requests import get, exceptions
 from sys import stdout
 from time import sleep
 from uvloop import EventLoopPolicy
-from yajl import dumps, loads
+from yajl import loads
 from yaml import safe_load as load
 import logging
+import sys
+
+sys.path.append(join(dirname(abspath(__file__)), '..', '..', '..', '..'))
+from harvesters_common.entity_builder import EntityBuilder  # noqa: E402
+from harvesters_common.http_cache import HttpCache  # noqa: E402
+from harvesters_common.orion_writer import OrionWriter  # noqa: E402
+from harvesters_common.pipeline import pipeline  # noqa: E402
+from harvesters_common.token_bucket import TokenBucket  # noqa: E402
 
 default_latest = False                 # preserve only latest values
 default_limit_entities = 50            # amount of entities per 1 request to Orion
+default_limit_rate = 149               # amount of requests to AEMET per minute
 default_limit_source = 10              # amount of parallel request to AEMET
 default_limit_target = 50              # amount of parallel request to Orion
 default_log_level = 'INFO'
 default_orion = 'http://orion:1026'    # Orion Contest Broker endpoint
 default_station_file = 'stations.yml'  # source file with list of municipalities
 default_timeout = -1                   # if value != -1, then work as a service
+default_workers = None                 # amount of processes to prepare the schema, one per CPU by default
 
 http_ok = [200, 201, 204]
 
 log_levels = ['ERROR', 'INFO', 'DEBUG']
 logger = None
-logger_req = None
 
 stations = dict()                      # preprocessed list of stations
 
@@ -147,34 +155,44 @@ template = {
     }
 }
 
+builder = EntityBuilder(template)
+
+
+# session - shared by the harvesters of the scheduler, one is opened here if not given
+async def collect(key, session=None):
+    if session is None:
+        # Both requests of a station go to the same host, over the same pool of keep-alive connections
+        async with ClientSession(connector=TCPConnector(limit_per_host=limit_source)) as session:
+            async for item in collect(key, session):
+                yield item
+        return
 
-async def collect(key):
     logger.debug('Collecting data from AEMET started')
 
     tasks = list()
 
     sem = Semaphore(limit_source)
+    bucket = TokenBucket(limit_rate / 60, capacity=limit_rate)
 
-    async with ClientSession() as session:
-        for station in stations:
-            task = ensure_future(collect_bounded(station, sem, session, key))
-            tasks.append(task)
-
-        result = await gather(*tasks)
+    for station in stations:
+        task = ensure_future(collect_bounded(station, sem, bucket, session, key))
+        tasks.append(task)
 
-    while False in result:
-        result.remove(False)
+    # Stations are passed on to the schema preparation as soon as they are collected
+    for task in as_completed(tasks):
+        yield await task
 
-    logger.debug("Collection data from AEMET ended")
-    return result
+    logger.debug('Collecting data from AEMET ended, %s', bucket.summary())
 
 
-async def collect_bounded(station, sem, session, key):
+async def collect_bounded(station, sem, bucket, session, key):
     async with sem:
-        return await collect_one(station, session, key)
+        return await collect_one(station, bucket, session, key)
 
 
-async def collect_one(station, session, key):
+# AEMET returns a link to the data first, only the requests with the API key count for the quota
+async def collect_one(station, bucket, session, key):
+    await bucket.acquire()
 
     try:
         async with session.get(stations[station]['url'], headers={'api_key': key}, ssl=False) as response:
@@ -194,18 +212,29 @@ async def collect_one(station, session, key):
     logger.debug('Remaining requests %s', response.headers.get('Remaining-request-count'))
     result = loads(result.decode('UTF-8'))
 
+    url = result['datos']
     try:
-        content = get(result['datos'])
-    except exceptions.ConnectionError:
+        async with session.get(url, headers=None if http_cache is None else http_cache.headers(url)) as response:
+            content = await response.text()
+            status = response.status
+            if http_cache is not None:
+                http_cache.store(url, status, response.headers, content)
+    except ClientConnectorError:
         logger.error('Collecting data from AEMET station %s failed due to the connection problem', station)
         return False
+    except ToE:
+        logger.error('Collecting data from AEMET station %s failed due to the timeout problem', station)
+        return False
+
+    if status == 304:
+        logger.debug('Collecting data from AEMET station %s skipped, not modified', station)
+        return False
 
-    if content.status_code not in http_ok:
-        logger.error('Collecting data from AEMET station %s failed due to the return code %s', station,
-                     str(response.status))
+    if status not in http_ok:
+        logger.error('Collecting data from AEMET station %s failed due to the return code %s', station, str(status))
         return False
 
-    content = loads(content.text)
+    content = loads(content)
 
     result = dict()
     result['station'] = station
@@ -357,6 +386,23 @@ def decode_wind_direction(item):
     return out if out else None
 
 
+# One cycle, the scheduler shares its session, Orion limiter and process pool (executor) with the harvesters
+async def harvest(session=None, limiter=None, executor=None):
+    result = False
+    try:
+        async with OrionWriter(orion, service=service, path=path, limit_entities=limit_entities,
+                               limit_target=limit_target, dead_letter=dead_letter, session=session, limiter=limiter,
+                               logger=logger) as writer:
+            result = await pipeline(collect(args.key, session), prepare_schema_one, writer, workers=workers,
+                                    initializer=setup_worker, initargs=(stations, latest), executor=executor,
+                                    logger=logger)
+    finally:
+        if http_cache is not None:
+            http_cache.end(result)
+
+    return result
+
+
 def log_level_to_int(log_level_string):
     if log_level_string not in log_levels:
         message = 'invalid choice: {0} (choose from {1})'.format(log_level_string, log_levels)
@@ -365,110 +411,36 @@ def log_level_to_int(log_level_string):
     return getattr(logging, log_level_string, logging.ERROR)
 
 
-async def post(body):
-    logger.debug('Posting data to Orion started')
-
-    tasks = list()
-
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    if service:
-        headers['FIWARE-SERVICE'] = service
-
-    if path:
-        headers['FIWARE-SERVICEPATH'] = path
-
-    sem = Semaphore(limit_target)
-
-    # splitting list to list of lists to fit into limits
-    block = 0
-    items = 0
-    body_divided = dict()
-    body_divided[0] = list()
-    while True:
-        if len(body) > 0:
-            if items < limit_entities:
-                body_divided[block].append(body.pop())
-                items += 1
-            else:
-                items = 0
-                block += 1
-                body_divided[block] = list()
-        else:
-            break
-
-    async with ClientSession() as session:
-        for item in body_divided:
-            task = ensure_future(post_bounded(body_divided[item], headers, sem, session))
-            tasks.append(task)
-
-        response = await gather(*tasks)
-
-    response = list(set(response))
-    if True in response:
-        response.remove(True)
-
-    for item in response:
-        logger.error('Posting data to Orion failed due to the %s', item)
-
-    logger.debug('Posting data to Orion ended')
-
-
-async def post_bounded(item, headers, sem, session):
-    async with sem:
-        return await post_one(item, headers, session)
-
+def prepare_schema_one(source):
+    result = list()
+    id_local = source['station']
 
-async def post_one(item, headers, session):
-    payload = {
-        'actionType': 'APPEND',
-        'entities': item
+    address = {
+        'addressLocality': stations[id_local]['addressLocality'],
+        'postalCode': stations[id_local]['postalCode']
     }
 
-    payload = dumps(payload)
-
-    url = orion + '/v2/op/update'
-    try:
-        async with session.post(url, headers=headers, data=payload) as response:
-            status = response.status
-    except ClientConnectorError:
-        return 'connection problem'
-    except ToE:
-        return 'timeout problem'
-
-    if status not in http_ok:
-        return 'response code ' + str(status)
-
-    return True
-
-
-async def prepare_schema(source):
-    logger.debug('Schema preparation started')
-
-    tasks = list()
-
-    for item in source:
-        task = ensure_future(prepare_schema_one(item))
-        tasks.append(task)
-
-    result = await gather(*tasks)
-
-    logger.debug('Schema preparation ended')
-
-    return [j for i in result for j in i]
-
-
-async def prepare_schema_one(source):
-    result = list()
-    id_local = source['station']
+    # Same for all the periods of a day
+    day_maximum = dict()
+    day_minimum = dict()
+    for day in ['today', 'tomorrow']:
+        data = source[day]
+        day_maximum[day] = {
+            'feelsLikeTemperature': to_float(data['sensTermica']['maxima']),
+            'temperature': to_float(data['temperatura']['maxima']),
+            'relativeHumidity': to_float(data['humedadRelativa']['maxima'], 100)
+        }
+        day_minimum[day] = {
+            'feelsLikeTemperature': to_float(data['sensTermica']['minima']),
+            'temperature': to_float(data['temperatura']['minima']),
+            'relativeHumidity': to_float(data['humedadRelativa']['minima'], 100)
+        }
 
     for day in ['today', 'tomorrow']:
 
         forecast_date = datetime.strptime(source[day]['fecha'], '%Y-%m-%d').replace(tzinfo=tz)
         for period in [0, 1, 2, 3]:
 
-            item = deepcopy(template)
             valid_from = None
             valid_to = None
             l_period = period + 3
@@ -493,96 +465,36 @@ async def prepare_schema_one(source):
             valid_to_short = valid_to.strftime('%H:%M:%S')
 
             if latest:
-                item['id'] = item['id'] + id_local + '_' + day + '_' + valid_from_short + '_' + valid_to_short
-            else:
-                item['id'] = item['id'] + id_local + '_' + valid_from_iso + '_' + valid_to_iso
-
-            item['address']['value']['addressLocality'] = stations[id_local]['addressLocality']
-            item['address']['value']['postalCode'] = stations[id_local]['postalCode']
-
-            item['dateIssued']['value'] = source['issued']
-
-            item['dateRetrieved']['value'] = source['retrieved']
-
-            if source[day]['sensTermica']['maxima'] is not None:
-                item['dayMaximum']['value']['feelsLikeTemperature'] = float(source[day]['sensTermica']['maxima'])
-            else:
-                del item['dayMaximum']['value']['feelsLikeTemperature']
-
-            if source[day]['temperatura']['maxima'] is not None:
-                item['dayMaximum']['value']['temperature'] = float(source[day]['temperatura']['maxima'])
-            else:
-                del item['dayMaximum']['value']['temperature']
-
-            if source[day]['humedadRelativa']['maxima'] is not None:
-                item['dayMaximum']['value']['relativeHumidity'] = float(source[day]['humedadRelativa']['maxima']) / 100
-            else:
-                del item['dayMaximum']['value']['relativeHumidity']
-
-            if len(item['dayMaximum']['value']) == 0:
-                del item['dayMaximum']
-
-            if source[day]['sensTermica']['minima'] is not None:
-                item['dayMinimum']['value']['feelsLikeTemperature'] = float(source[day]['sensTermica']['minima'])
-            else:
-                del item['dayMinimum']['value']['feelsLikeTemperature']
-
-            if source[day]['temperatura']['minima'] is not None:
-                item['dayMinimum']['value']['temperature'] = float(source[day]['temperatura']['minima'])
-            else:
-                del item['dayMinimum']['value']['temperature']
-
-            if source[day]['humedadRelativa']['minima'] is not None:
-                item['dayMinimum']['value']['relativeHumidity'] = float(source[day]['humedadRelativa']['minima']) / 100
-            else:
-                del item['dayMinimum']['value']['relativeHumidity']
-
-            if len(item['dayMinimum']['value']) == 0:
-                del item['dayMinimum']
-
-            if source[day]['sensTermica']['dato'][period]['value'] is not None:
-                item['feelsLikeTemperature']['value'] = float(source[day]['sensTermica']['dato'][period]['value'])
-            else:
-                del item['feelsLikeTemperature']
-
-            if source[day]['probPrecipitacion'][l_period]['value'] is not None:
-                value = float(source[day]['probPrecipitacion'][l_period]['value']) / 100
-                item['precipitationProbability']['value'] = value
-            else:
-                del item['precipitationProbability']
-
-            if source[day]['humedadRelativa']['dato'][period]['value'] is not None:
-                item['relativeHumidity']['value'] = float(source[day]['humedadRelativa']['dato'][period]['value']) / 100
-            else:
-                del item['relativeHumidity']
-
-            if source[day]['temperatura']['dato'][period]['value'] is not None:
-                item['temperature']['value'] = float(source[day]['temperatura']['dato'][period]['value'])
-            else:
-                del item['temperature']
-
-            item['validFrom']['value'] = valid_from_iso
-
-            item['validTo']['value'] = valid_to_iso
-
-            item['validity']['value'] = valid_from_iso + '/' + valid_to_iso
-
-            if source[day]['estadoCielo'][l_period]['value'] != '':
-                item['weatherType']['value'] = decode_weather_type(source[day]['estadoCielo'][l_period]['value'])
-
-            if item['weatherType']['value'] is None:
-                del item['weatherType']
-
-            if source[day]['viento'][l_period]['direccion'] is not None:
-                item['windDirection']['value'] = decode_wind_direction(source[day]['viento'][l_period]['direccion'])
-
-            if item['windDirection']['value'] is None:
-                del item['windDirection']
-
-            if source[day]['viento'][period + 3]['velocidad'] is not None:
-                item['windSpeed']['value'] = round(float(source[day]['viento'][period + 3]['velocidad']) * 0.28, 2)
+                item_id = template['id'] + id_local + '_' + day + '_' + valid_from_short + '_' + valid_to_short
             else:
-                del item['windSpeed']
+                item_id = template['id'] + id_local + '_' + valid_from_iso + '_' + valid_to_iso
+
+            data = source[day]
+            values = {
+                'address': address,
+                'dateIssued': source['issued'],
+                'dateRetrieved': source['retrieved'],
+                'dayMaximum': day_maximum[day],
+                'dayMinimum': day_minimum[day],
+                'feelsLikeTemperature': to_float(data['sensTermica']['dato'][period]['value']),
+                'precipitationProbability': to_float(data['probPrecipitacion'][l_period]['value'], 100),
+                'relativeHumidity': to_float(data['humedadRelativa']['dato'][period]['value'], 100),
+                'temperature': to_float(data['temperatura']['dato'][period]['value']),
+                'validFrom': valid_from_iso,
+                'validTo': valid_to_iso,
+                'validity': valid_from_iso + '/' + valid_to_iso
+            }
+
+            if data['estadoCielo'][l_period]['value'] != '':
+                values['weatherType'] = decode_weather_type(data['estadoCielo'][l_period]['value'])
+
+            if data['viento'][l_period]['direccion'] is not None:
+                values['windDirection'] = decode_wind_direction(data['viento'][l_period]['direccion'])
+
+            if data['viento'][l_period]['velocidad'] is not None:
+                values['windSpeed'] = round(float(data['viento'][l_period]['velocidad']) * 0.28, 2)
+
+            item = builder.build(item_id, values)
             result.append(item)
 
     return result
@@ -596,12 +508,120 @@ def reply_status():
     logger.info('Stations: %s', str(len(stations)))
     logger.info('Latest: %s', str(latest))
     logger.info('limit_entities: %s', str(limit_entities))
+    logger.info('limit_rate: %s', str(limit_rate))
     logger.info('Limit_source: %s', str(limit_source))
     logger.info('limit_target: %s', str(limit_target))
+    logger.info('Workers: %s', str(workers))
     logger.info('Log level: %s', args.log_level)
     logger.info('Started')
 
 
+# Parses the arguments (the command line by default) and prepares the harvester, the scheduler uses it too
+def setup(argv=None, local_logger=None):
+    global args, dead_letter, http_cache, latest, limit_entities, limit_rate, limit_source, limit_target
+    global logger, orion, path, service, stations, timeout, workers
+
+    parser = ArgumentParser()
+    parser.add_argument('--config',
+                        dest='config',
+                        help='YAML file with list of municipalities to be collected or excluded from collecting')
+    parser.add_argument('--dead-letter',
+                        action='store',
+                        dest='dead_letter',
+                        help='NDJSON file to store the entities that could not be posted to Orion')
+    parser.add_argument('--http-cache',
+                        action='store',
+                        dest='http_cache',
+                        help='SQLite file to cache the responses of the source, unchanged data is not posted again')
+    parser.add_argument('--key',
+                        action='store',
+                        dest='key',
+                        help='API Key to access to AEMET Open Data Portal',
+                        required=True)
+    parser.add_argument('--latest',
+                        action='store_true',
+                        default=default_latest,
+                        dest='latest',
+                        help='Collect only latest forecast')
+    parser.add_argument('--limit-entities',
+                        default=default_limit_entities,
+                        dest='limit_entities',
+                        help='Limit amount of entities per 1 request to Orion')
+    parser.add_argument('--limit-rate',
+                        default=default_limit_rate,
+                        dest='limit_rate',
+                        help='Limit amount of requests to AEMET per minute (API key quota)')
+    parser.add_argument('--limit-source',
+                        default=default_limit_source,
+                        dest='limit_source',
+                        help='Limit amount of parallel requests to AEMET')
+    parser.add_argument('--limit-target',
+                        default=default_limit_target,
+                        dest='limit_target',
+                        help='Limit amount of parallel requests to Orion')
+    parser.add_argument('--log-level',
+                        default=default_log_level,
+                        dest='log_level',
+                        help='Set the logging output level. {0}'.format(log_levels),
+                        nargs='?')
+    parser.add_argument('--orion',
+                        action='store',
+                        default=default_orion,
+                        dest='orion',
+                        help='Orion Context Broker endpoint')
+    parser.add_argument('--path',
+                        action='store',
+                        dest='path',
+                        help='FIWARE Service Path')
+    parser.add_argument('--service',
+                        action='store',
+                        dest="service",
+                        help='FIWARE Service')
+    parser.add_argument('--stations',
+                        action='store',
+                        default=default_station_file,
+                        dest="station_file",
+                        help='Station file')
+    parser.add_argument('--timeout',
+                        action='store',
+                        default=default_timeout,
+                        dest='timeout',
+                        help='Run as a service')
+    parser.add_argument('--workers',
+                        action='store',
+                        default=default_workers,
+                        dest='workers',
+                        help='Amount of processes to prepare the schema, one per CPU by default')
+
+    args = parser.parse_args(argv)
+
+    latest = args.latest
+    dead_letter = args.dead_letter
+    http_cache = HttpCache(args.http_cache) if args.http_cache else None
+    limit_entities = int(args.limit_entities)
+    limit_rate = int(args.limit_rate)
+    limit_source = int(args.limit_source)
+    limit_target = int(args.limit_target)
+    orion = args.orion
+    timeout = int(args.timeout)
+    workers = int(args.workers) if args.workers else None
+
+    if 'path' in args:
+        path = args.path
+    if 'service' in args:
+        service = args.service
+
+    if local_logger is None:
+        logger = setup_logger()
+    else:
+        logger = local_logger
+
+    res = setup_stations_config(args.config)
+    stations = setup_stations(res, args.station_file)
+
+    reply_status()
+
+
 def setup_logger():
     local_logger = logging.getLogger('root')
     local_logger.setLevel(log_level_to_int(args.log_level))
@@ -612,10 +632,7 @@ def setup_logger():
     handler.setFormatter(formatter)
     local_logger.addHandler(handler)
 
-    local_logger_req = logging.getLogger('requests')
-    local_logger_req.setLevel(logging.WARNING)
-
-    return local_logger, local_logger_req
+    return local_logger
 
 
 def setup_stations(stations_limit, station_file):
@@ -701,90 +718,29 @@ def setup_config_re(station):
     return "- '{}'\n".format(fix)
 
 
-if __name__ == '__main__':
-    parser = ArgumentParser()
-    parser.add_argument('--config',
-                        dest='config',
-                        help='YAML file with list of municipalities to be collected or excluded from collecting')
-    parser.add_argument('--key',
-                        action='store',
-                        dest='key',
-                        help='API Key to access to AEMET Open Data Portal',
-                        required=True)
-    parser.add_argument('--latest',
-                        action='store_true',
-                        default=default_latest,
-                        dest='latest',
-                        help='Collect only latest forecast')
-    parser.add_argument('--limit-entities',
-                        default=default_limit_entities,
-                        dest='limit_entities',
-                        help='Limit amount of entities per 1 request to Orion')
-    parser.add_argument('--limit-source',
-                        default=default_limit_source,
-                        dest='limit_source',
-                        help='Limit amount of parallel requests to AEMET')
-    parser.add_argument('--limit-target',
-                        default=default_limit_target,
-                        dest='limit_target',
-                        help='Limit amount of parallel requests to Orion')
-    parser.add_argument('--log-level',
-                        default=default_log_level,
-                        dest='log_level',
-                        help='Set the logging output level. {0}'.format(log_levels),
-                        nargs='?')
-    parser.add_argument('--orion',
-                        action='store',
-                        default=default_orion,
-                        dest='orion',
-                        help='Orion Context Broker endpoint')
-    parser.add_argument('--path',
-                        action='store',
-                        dest='path',
-                        help='FIWARE Service Path')
-    parser.add_argument('--service',
-                        action='store',
-                        dest="service",
-                        help='FIWARE Service')
-    parser.add_argument('--stations',
-                        action='store',
-                        default=default_station_file,
-                        dest="station_file",
-                        help='Station file')
-    parser.add_argument('--timeout',
-                        action='store',
-                        default=default_timeout,
-                        dest='timeout',
-                        help='Run as a service')
+# Worker processes of the pipeline may not share the globals set in __main__
+def setup_worker(local_stations, local_latest):
+    global latest, logger, stations
 
-    args = parser.parse_args()
+    latest = local_latest
+    logger = logging.getLogger('root')
+    stations = local_stations
 
-    latest = args.latest
-    limit_entities = int(args.limit_entities)
-    limit_source = int(args.limit_source)
-    limit_target = int(args.limit_target)
-    orion = args.orion
-    timeout = int(args.timeout)
 
-    if 'path' in args:
-        path = args.path
-    if 'service' in args:
-        service = args.service
+def to_float(value, divisor=1):
+    if value is None:
+        return None
 
-    logger, logger_req = setup_logger()
+    return float(value) / divisor
 
-    set_event_loop_policy(EventLoopPolicy())
 
-    res = setup_stations_config(args.config)
-    stations = setup_stations(res, args.station_file)
+if __name__ == '__main__':
+    setup()
 
-    reply_status()
+    set_event_loop_policy(EventLoopPolicy())
 
     while True:
-        res = run(collect(args.key))
-        if res:
-            res = run(prepare_schema(res))
-            run(post(res))
+        run(harvest())
         if timeout == -1:
             break
         else:
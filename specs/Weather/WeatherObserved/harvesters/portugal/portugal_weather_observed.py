@@ -22,18 +22,24 @@
 
 from aiohttp import ClientSession, ClientConnectorError
 from argparse import ArgumentTypeError, ArgumentParser
-from asyncio import Semaphore, ensure_future, gather, run, TimeoutError as ToE, set_event_loop_policy
-from copy import deepcopy
+from asyncio import run, TimeoutError as ToE, set_event_loop_policy
 from datetime import datetime
+from os.path import abspath, dirname, join
 from pytz import timezone
 from re import sub
 from sys import stdout
 from time import sleep
 from uvloop import EventLoopPolicy
-from yajl import dumps, loads
+from yajl import loads
 from yaml import safe_load as load
-from requests import get, exceptions
 import logging
+import sys
+
+sys.path.append(join(dirname(abspath(__file__)), '..', '..', '..', '..'))
+from harvesters_common.entity_builder import EntityBuilder  # noqa: E402
+from harvesters_common.http_cache import HttpCache  # noqa: E402
+from harvesters_common.orion_writer import OrionWriter  # noqa: E402
+from harvesters_common.pipeline import pipeline  # noqa: E402
 
 default_latest = False                 # preserve only latest values
 default_limit_entities = 50            # amount of entities per 1 request to Orion
@@ -42,12 +48,14 @@ default_log_level = 'INFO'
 default_station_file = 'stations.yml'  # source file with list of municipalities
 default_orion = 'http://orion:1026'    # Orion Contest Broker endpoint
 default_timeout = -1                   # if value != -1, then work as a service
+default_workers = None                 # amount of processes to prepare the schema, one per CPU by default
+
+chunk = 100                            # amount of observations prepared by 1 task of a worker process
 
 http_ok = [200, 201, 204]
 
 log_levels = ['ERROR', 'INFO', 'DEBUG']
 logger = None
-logger_req = None
 
 stations = dict()                     # preprocessed list of stations
 stations_file = 'stations.json'       # source file with list of stations
@@ -121,20 +129,39 @@ template = {
 
 }
 
+builder = EntityBuilder(template)
+
+
+# session - shared by the harvesters of the scheduler, one is opened here if not given
+async def collect(session=None):
+    if session is None:
+        async with ClientSession() as session:
+            return await collect(session)
 
-def collect():
     logger.debug('Collecting data from IPMA started')
     result = list()
     last = ''
 
+    headers = None if http_cache is None else http_cache.headers(url_observation)
     try:
-        request = get(url_observation)
-    except exceptions.ConnectionError:
+        async with session.get(url_observation, headers=headers) as response:
+            content = await response.text()
+            status = response.status
+            if http_cache is not None:
+                http_cache.store(url_observation, status, response.headers, content)
+    except ClientConnectorError:
         logger.error('Collecting data from IPMA failed due to the connection problem')
         return False
+    except ToE:
+        logger.error('Collecting data from IPMA failed due to the timeout problem')
+        return False
+
+    if status == 304:
+        logger.info('Collecting data from IPMA skipped, not modified')
+        return False
 
-    if request.status_code in http_ok:
-        content = loads(request.text)
+    if status in http_ok:
+        content = loads(content)
     else:
         logger.error('Collecting data from IPMA failed due to the return code')
         return False
@@ -211,6 +238,27 @@ def decode_wind_direction(item):
     return out if out else None
 
 
+# One cycle, the scheduler shares its session, Orion limiter and process pool (executor) with the harvesters
+async def harvest(session=None, limiter=None, executor=None):
+    result = False
+    try:
+        source = await collect(session)
+        if not source:
+            return result
+
+        async with OrionWriter(orion, service=service, path=path, limit_entities=limit_entities,
+                               limit_target=limit_target, dead_letter=dead_letter, session=session, limiter=limiter,
+                               logger=logger) as writer:
+            result = await pipeline(source, prepare_schema_one, writer, workers=workers, chunk=chunk,
+                                    initializer=setup_worker, initargs=(stations, latest), executor=executor,
+                                    logger=logger)
+    finally:
+        if http_cache is not None:
+            http_cache.end(result)
+
+    return result
+
+
 def log_level_to_int(log_level_string):
     if log_level_string not in log_levels:
         message = 'invalid choice: {0} (choose from {1})'.format(log_level_string, log_levels)
@@ -219,153 +267,46 @@ def log_level_to_int(log_level_string):
     return getattr(logging, log_level_string, logging.ERROR)
 
 
-async def post(body):
-    logger.debug('Posting data to Orion started')
-
-    tasks = list()
-
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    if service:
-        headers['FIWARE-SERVICE'] = service
-
-    if path:
-        headers['FIWARE-SERVICEPATH'] = path
-
-    sem = Semaphore(limit_target)
-
-    # splitting list to list of lists to fit into limits
-    block = 0
-    items = 0
-    body_divided = dict()
-    body_divided[0] = list()
-    while True:
-        if len(body) > 0:
-            if items < limit_entities:
-                body_divided[block].append(body.pop())
-                items += 1
-            else:
-                items = 0
-                block += 1
-                body_divided[block] = list()
-        else:
-            break
-
-    async with ClientSession() as session:
-        for item in body_divided:
-            task = ensure_future(post_bounded(body_divided[item], headers, sem, session))
-            tasks.append(task)
-
-        response = await gather(*tasks)
-
-    response = list(set(response))
-    if True in response:
-        response.remove(True)
-
-    for item in response:
-        logger.error('Posting data to Orion failed due to the %s', item)
-
-    logger.debug('Posting data to Orion ended')
-
-
-async def post_bounded(item, headers, sem, session):
-    async with sem:
-        return await post_one(item, headers, session)
-
-
-async def post_one(item, headers, session):
-    payload = {
-        'actionType': 'APPEND',
-        'entities': item
-    }
-
-    payload = dumps(payload)
-
-    url = orion + '/v2/op/update'
-    try:
-        async with session.post(url, headers=headers, data=payload) as response:
-            status = response.status
-    except ClientConnectorError:
-        return 'connection problem'
-    except ToE:
-        return 'timeout problem'
-
-    if status not in http_ok:
-        return 'response code ' + str(status)
-
-    return True
-
-
-async def prepare_schema(source):
-    logger.debug('Schema preparation started')
-
-    tasks = list()
-
-    for item in source:
-        task = ensure_future(prepare_schema_one(item))
-        tasks.append(task)
-
-    result = await gather(*tasks)
-
-    logger.debug('Schema preparation ended')
-
-    return result
-
-
-async def prepare_schema_one(source):
+def prepare_schema_one(source):
     id_local = source['id']
 
     date_local = source['dateObserved'].replace(tzinfo=tz).isoformat().replace('+00:00', 'Z')
 
-    result = deepcopy(template)
-
     if latest:
-        result['id'] = result['id'] + id_local + '-' + 'latest'
+        item_id = template['id'] + id_local + '-' + 'latest'
     else:
-        result['id'] = result['id'] + id_local + '-' + date_local
-
-    result['address']['value']['addressLocality'] = stations[id_local]['name']
+        item_id = template['id'] + id_local + '-' + date_local
+
+    values = {
+        'address': {'addressLocality': stations[id_local]['name']},
+        'dateObserved': date_local,
+        'location': {'coordinates': stations[id_local]['coordinates']},
+        'stationCode': id_local,
+        'stationName': stations[id_local]['name']
+    }
 
     if 'atmosphericPressure' in source:
-        result['atmosphericPressure']['value'] = float(source['atmosphericPressure'])
-
-    result['dateObserved']['value'] = date_local
-
-    result['location']['value']['coordinates'] = stations[id_local]['coordinates']
+        values['atmosphericPressure'] = float(source['atmosphericPressure'])
 
     if 'precipitation' in source:
-        result['precipitation']['value'] = float(source['precipitation'])
-    else:
-        del result['precipitation']
+        values['precipitation'] = float(source['precipitation'])
 
     if 'pressureTendency' in source:
-        result['pressureTendency']['value'] = float(source['pressureTendency'])
-    else:
-        del result['pressureTendency']
+        values['pressureTendency'] = float(source['pressureTendency'])
 
     if 'relativeHumidity' in source:
-        result['relativeHumidity']['value'] = float(source['relativeHumidity']) / 100
-    else:
-        del result['relativeHumidity']
-
-    result['stationCode']['value'] = id_local
-
-    result['stationName']['value'] = stations[id_local]['name']
+        values['relativeHumidity'] = float(source['relativeHumidity']) / 100
 
     if 'temperature' in source:
-        result['temperature']['value'] = float(source['temperature'])
-    else:
-        del result['temperature']
+        values['temperature'] = float(source['temperature'])
 
     if 'windDirection' in source:
-        result['windDirection']['value'] = decode_wind_direction(str(source['windDirection']))
-
-    if result['windDirection']['value'] is None:
-        del result['windDirection']
+        values['windDirection'] = decode_wind_direction(str(source['windDirection']))
 
     if 'windSpeed' in source:
-        result['windSpeed']['value'] = float(source['windSpeed']) * 0.28
+        values['windSpeed'] = float(source['windSpeed']) * 0.28
+
+    result = builder.build(item_id, values)
 
     return result
 
@@ -378,6 +319,7 @@ def reply_status():
     logger.info('Stations: %s', str(len(stations)))
     logger.info('Latest: %s', str(latest))
     logger.info('limit_target: %s', str(limit_target))
+    logger.info('Workers: %s', str(workers))
     logger.info('Log level: %s', args.log_level)
     logger.info('Started')
 
@@ -386,6 +328,97 @@ def sanitize(str_in):
     return sub(r"[<(>)\"\'=;-]", "", str_in)
 
 
+# Parses the arguments (the command line by default) and prepares the harvester, the scheduler uses it too
+def setup(argv=None, local_logger=None):
+    global args, dead_letter, http_cache, latest, limit_entities, limit_target, logger
+    global orion, path, service, stations, timeout, workers
+
+    parser = ArgumentParser()
+    parser.add_argument('--config',
+                        dest='config',
+                        help='YAML file with list of stations to be harvested or excluded from collecting')
+    parser.add_argument('--dead-letter',
+                        action='store',
+                        dest='dead_letter',
+                        help='NDJSON file to store the entities that could not be posted to Orion')
+    parser.add_argument('--http-cache',
+                        action='store',
+                        dest='http_cache',
+                        help='SQLite file to cache the responses of the source, unchanged data is not posted again')
+    parser.add_argument('--latest',
+                        action='store_true',
+                        default=default_latest,
+                        dest='latest',
+                        help='Collect only latest observation')
+    parser.add_argument('--limit-entities',
+                        default=default_limit_entities,
+                        dest='limit_entities',
+                        help='Limit amount of entities per 1 post request to Orion')
+    parser.add_argument('--limit-target',
+                        default=default_limit_target,
+                        dest='limit_target',
+                        help='Limit amount of parallel requests to Orion')
+    parser.add_argument('--log-level',
+                        default=default_log_level,
+                        dest='log_level',
+                        help='Set the logging output level. {0}'.format(log_levels),
+                        nargs='?')
+    parser.add_argument('--orion',
+                        action='store',
+                        default=default_orion,
+                        dest='orion',
+                        help='Orion Context Broker endpoint')
+    parser.add_argument('--path',
+                        action='store',
+                        dest='path',
+                        help='FIWARE Service Path')
+    parser.add_argument('--service',
+                        action='store',
+                        dest="service",
+                        help='FIWARE Service')
+    parser.add_argument('--stations',
+                        action='store',
+                        default=default_station_file,
+                        dest="station_file",
+                        help='Station file')
+    parser.add_argument('--timeout',
+                        action='store',
+                        default=default_timeout,
+                        dest='timeout',
+                        help='Run as a service')
+    parser.add_argument('--workers',
+                        action='store',
+                        default=default_workers,
+                        dest='workers',
+                        help='Amount of processes to prepare the schema, one per CPU by default')
+
+    args = parser.parse_args(argv)
+
+    latest = args.latest
+    dead_letter = args.dead_letter
+    http_cache = HttpCache(args.http_cache) if args.http_cache else None
+    limit_entities = int(args.limit_entities)
+    limit_target = int(args.limit_target)
+    orion = args.orion
+    timeout = int(args.timeout)
+    workers = int(args.workers) if args.workers else None
+
+    if 'path' in args:
+        path = args.path
+    if 'service' in args:
+        service = args.service
+
+    if local_logger is None:
+        logger = setup_logger()
+    else:
+        logger = local_logger
+
+    res = setup_stations_config(args.config)
+    stations = setup_stations(res, args.station_file)
+
+    reply_status()
+
+
 def setup_logger():
     local_logger = logging.getLogger('root')
     local_logger.setLevel(log_level_to_int(args.log_level))
@@ -396,10 +429,7 @@ def setup_logger():
     handler.setFormatter(formatter)
     local_logger.addHandler(handler)
 
-    local_logger_req = logging.getLogger('requests')
-    local_logger_req.setLevel(logging.WARNING)
-
-    return local_logger, local_logger_req
+    return local_logger
 
 
 def setup_stations(stations_limit, station_file):
@@ -487,81 +517,22 @@ def setup_config_re(station):
     return "- '{}'\n".format(fix)
 
 
-if __name__ == '__main__':
+# Worker processes of the pipeline may not share the globals set in __main__
+def setup_worker(local_stations, local_latest):
+    global latest, logger, stations
 
-    parser = ArgumentParser()
-    parser.add_argument('--config',
-                        dest='config',
-                        help='YAML file with list of stations to be harvested or excluded from collecting')
-    parser.add_argument('--latest',
-                        action='store_true',
-                        default=default_latest,
-                        dest='latest',
-                        help='Collect only latest observation')
-    parser.add_argument('--limit-entities',
-                        default=default_limit_entities,
-                        dest='limit_entities',
-                        help='Limit amount of entities per 1 post request to Orion')
-    parser.add_argument('--limit-target',
-                        default=default_limit_target,
-                        dest='limit_target',
-                        help='Limit amount of parallel requests to Orion')
-    parser.add_argument('--log-level',
-                        default=default_log_level,
-                        dest='log_level',
-                        help='Set the logging output level. {0}'.format(log_levels),
-                        nargs='?')
-    parser.add_argument('--orion',
-                        action='store',
-                        default=default_orion,
-                        dest='orion',
-                        help='Orion Context Broker endpoint')
-    parser.add_argument('--path',
-                        action='store',
-                        dest='path',
-                        help='FIWARE Service Path')
-    parser.add_argument('--service',
-                        action='store',
-                        dest="service",
-                        help='FIWARE Service')
-    parser.add_argument('--stations',
-                        action='store',
-                        default=default_station_file,
-                        dest="station_file",
-                        help='Station file')
-    parser.add_argument('--timeout',
-                        action='store',
-                        default=default_timeout,
-                        dest='timeout',
-                        help='Run as a service')
-
-    args = parser.parse_args()
-
-    latest = args.latest
-    limit_entities = int(args.limit_entities)
-    limit_target = int(args.limit_target)
-    orion = args.orion
-    timeout = int(args.timeout)
+    latest = local_latest
+    logger = logging.getLogger('root')
+    stations = local_stations
 
-    if 'path' in args:
-        path = args.path
-    if 'service' in args:
-        service = args.service
 
-    logger, logger_req = setup_logger()
+if __name__ == '__main__':
+    setup()
 
     set_event_loop_policy(EventLoopPolicy())
 
-    res = setup_stations_config(args.config)
-    stations = setup_stations(res, args.station_file)
-
-    reply_status()
-
     while True:
-        res = collect()
-        if res:
-            res = run(prepare_schema(res))
-            run(post(res))
+        run(harvest())
         if timeout == -1:
             break
         else:
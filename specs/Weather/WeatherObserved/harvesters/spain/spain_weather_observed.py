@@ -28,16 +28,22 @@
 
 from aiohttp import ClientSession, ClientConnectorError
 from argparse import ArgumentTypeError, ArgumentParser
-from asyncio import Semaphore, ensure_future, gather, run, TimeoutError as ToE, set_event_loop_policy
-from copy import deepcopy
+from asyncio import run, TimeoutError as ToE, set_event_loop_policy
+from os.path import abspath, dirname, join
 from re import sub
-from requests import get, exceptions
 from sys import stdout
 from time import sleep
 from uvloop import EventLoopPolicy
-from yajl import dumps, loads
+from yajl import loads
 from yaml import safe_load as load
 import logging
+import sys
+
+sys.path.append(join(dirname(abspath(__file__)), '..', '..', '..', '..'))
+from harvesters_common.entity_builder import EntityBuilder  # noqa: E402
+from harvesters_common.http_cache import HttpCache  # noqa: E402
+from harvesters_common.orion_writer import OrionWriter  # noqa: E402
+from harvesters_common.pipeline import pipeline  # noqa: E402
 
 default_latest = False                 # preserve only latest values
 default_limit_entities = 50            # amount of entities per 1 request to Orion
@@ -46,12 +52,14 @@ default_log_level = 'INFO'
 default_orion = 'http://orion:1026'    # Orion Contest Broker endpoint
 default_station_file = 'stations.yml'  # source file with list of municipalities
 default_timeout = -1                   # if value != -1, then work as a service
+default_workers = None                 # amount of processes to prepare the schema, one per CPU by default
+
+chunk = 100                            # amount of observations prepared by 1 task of a worker process
 
 http_ok = [200, 201, 204]
 
 log_levels = ['ERROR', 'INFO', 'DEBUG']
 logger = None
-logger_req = None
 
 stations = dict()                      # preprocessed list of stations
 
@@ -119,34 +127,58 @@ template = {
     }
 }
 
+builder = EntityBuilder(template)
+
+
+# session - shared by the harvesters of the scheduler, one is opened here if not given
+async def collect(key, session=None):
+    if session is None:
+        async with ClientSession() as session:
+            return await collect(key, session)
 
-def collect(key):
     logger.debug('Collecting data from AEMET started')
 
     try:
-        result = get(url_aemet, headers={'api_key': key})
-    except exceptions.ConnectionError:
+        async with session.get(url_aemet, headers={'api_key': key}) as response:
+            result = await response.text()
+            status = response.status
+    except ClientConnectorError:
         logger.error('Collecting link from AEMET failed due to the connection problem')
         return False
+    except ToE:
+        logger.error('Collecting link from AEMET failed due to the timeout problem')
+        return False
 
-    if result.status_code not in http_ok:
-        logger.error('Collecting link from AEMET failed due to the return code %s', result.status_code)
+    if status not in http_ok:
+        logger.error('Collecting link from AEMET failed due to the return code %s', status)
         return False
 
-    logger.debug('Remaining requests %s', result.headers.get('Remaining-request-count'))
-    result = loads(result.text)
+    logger.debug('Remaining requests %s', response.headers.get('Remaining-request-count'))
+    result = loads(result)
 
+    url = result['datos']
     try:
-        result = get(result['datos'])
-    except exceptions.ConnectionError:
+        async with session.get(url, headers=None if http_cache is None else http_cache.headers(url)) as response:
+            result = await response.text()
+            status = response.status
+            if http_cache is not None:
+                http_cache.store(url, status, response.headers, result)
+    except ClientConnectorError:
         logger.error('Collecting data from AEMET failed due to the connection problem')
         return False
+    except ToE:
+        logger.error('Collecting data from AEMET failed due to the timeout problem')
+        return False
+
+    if status == 304:
+        logger.info('Collecting data from AEMET skipped, not modified')
+        return False
 
-    if result.status_code not in http_ok:
-        logger.error('Collecting data from AEMET failed due to the return code %s', result.status_code)
+    if status not in http_ok:
+        logger.error('Collecting data from AEMET failed due to the return code %s', status)
         return False
 
-    result = loads(result.text)
+    result = loads(result)
 
     for i in range(len(result) - 1, -1, -1):
         if result[i]['idema'] not in stations:
@@ -166,6 +198,27 @@ def collect(key):
     return result
 
 
+# One cycle, the scheduler shares its session, Orion limiter and process pool (executor) with the harvesters
+async def harvest(session=None, limiter=None, executor=None):
+    result = False
+    try:
+        source = await collect(args.key, session)
+        if not source:
+            return result
+
+        async with OrionWriter(orion, service=service, path=path, limit_entities=limit_entities,
+                               limit_target=limit_targets, dead_letter=dead_letter, session=session, limiter=limiter,
+                               logger=logger) as writer:
+            result = await pipeline(source, prepare_schema_one, writer, workers=workers, chunk=chunk,
+                                    initializer=setup_worker, initargs=(stations, latest), executor=executor,
+                                    logger=logger)
+    finally:
+        if http_cache is not None:
+            http_cache.end(result)
+
+    return result
+
+
 def log_level_to_int(log_level_string):
     if log_level_string not in log_levels:
         message = 'invalid choice: {0} (choose from {1})'.format(log_level_string, log_levels)
@@ -174,155 +227,31 @@ def log_level_to_int(log_level_string):
     return getattr(logging, log_level_string, logging.ERROR)
 
 
-async def post(body):
-    logger.debug('Posting data to Orion started')
-
-    tasks = list()
-
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    if service:
-        headers['FIWARE-SERVICE'] = service
-
-    if path:
-        headers['FIWARE-SERVICEPATH'] = path
-
-    sem = Semaphore(limit_targets)
-
-    # splitting list to list of lists to fit into limits
-    block = 0
-    items = 0
-    body_divided = dict()
-    body_divided[0] = list()
-    while True:
-        if len(body) > 0:
-            if items < limit_entities:
-                body_divided[block].append(body.pop())
-                items += 1
-            else:
-                items = 0
-                block += 1
-                body_divided[block] = list()
-        else:
-            break
-
-    async with ClientSession() as session:
-        for item in body_divided:
-            task = ensure_future(post_bounded(body_divided[item], headers, sem, session))
-            tasks.append(task)
-
-        response = await gather(*tasks)
-
-    response = list(set(response))
-    if True in response:
-        response.remove(True)
-
-    for item in response:
-        logger.error('Posting data to Orion failed due to the %s', item)
-
-    logger.debug('Posting data to Orion ended')
-    return True
-
-
-async def post_bounded(item, headers, sem, session):
-    async with sem:
-        return await post_one(item, headers, session)
-
-
-async def post_one(item, headers, session):
-    payload = {
-        'actionType': 'APPEND',
-        'entities': item
-    }
-
-    payload = dumps(payload)
-
-    url = orion + '/v2/op/update'
-    try:
-        async with session.post(url, headers=headers, data=payload) as response:
-            status = response.status
-    except ClientConnectorError:
-        return 'connection problem'
-    except ToE:
-        return 'timeout problem'
-
-    if status not in http_ok:
-        return 'response code ' + str(status)
-
-    return True
-
-
-async def prepare_schema(source):
-    logger.debug('Schema preparation started')
-
-    tasks = list()
-
-    for item in source:
-        if item['idema'] in stations:
-            task = ensure_future(prepare_schema_one(item))
-            tasks.append(task)
-
-    result = await gather(*tasks)
-
-    logger.debug('Schema preparation ended')
-
-    return result
-
-
-async def prepare_schema_one(source):
+def prepare_schema_one(source):
     result = None
     id_local = source['idema']
 
     if id_local in stations:
         date_local = source['fint'] + 'Z'
 
-        result = deepcopy(template)
-
         if latest:
-            result['id'] = result['id'] + id_local + '-' + 'latest'
-        else:
-            result['id'] = result['id'] + id_local + '-' + date_local
-
-        result['address']['value']['addressLocality'] = stations[id_local]['name']
-
-        if 'pres' in source:
-            result['atmosphericPressure']['value'] = source['pres']
-        else:
-            del result['atmosphericPressure']
-
-        result['dateObserved']['value'] = date_local
-
-        result['location']['value']['coordinates'] = stations[id_local]['coordinates']
-
-        if 'prec' in source:
-            result['precipitation']['value'] = source['prec']
-        else:
-            del result['precipitation']
-
-        if 'hr' in source:
-            result['relativeHumidity']['value'] = source['hr']
+            item_id = template['id'] + id_local + '-' + 'latest'
         else:
-            del result['relativeHumidity']
-
-        result['stationCode']['value'] = id_local
-
-        result['stationName']['value'] = stations[id_local]['name']
-
-        if 'ta' in source:
-            result['temperature']['value'] = source['ta']
-        else:
-            del result['temperature']
-
-        if 'dv' in source:
-            result['windDirection']['value'] = 180 - source['dv']
-        else:
-            del result['windDirection']
-
-        if 'vv' in source:
-            result['windSpeed']['value'] = source['vv']
-        else:
-            del result['windSpeed']
+            item_id = template['id'] + id_local + '-' + date_local
+
+        result = builder.build(item_id, {
+            'address': {'addressLocality': stations[id_local]['name']},
+            'atmosphericPressure': source.get('pres'),
+            'dateObserved': date_local,
+            'location': {'coordinates': stations[id_local]['coordinates']},
+            'precipitation': source.get('prec'),
+            'relativeHumidity': source.get('hr'),
+            'stationCode': id_local,
+            'stationName': stations[id_local]['name'],
+            'temperature': source.get('ta'),
+            'windDirection': 180 - source['dv'] if 'dv' in source else None,
+            'windSpeed': source.get('vv')
+        })
 
     return result
 
@@ -335,10 +264,107 @@ def reply_status():
     logger.info('Latest: %s', str(latest))
     logger.info('limit_entities: %s', str(limit_entities))
     logger.info('limit_targets: %s', str(limit_targets))
+    logger.info('Workers: %s', str(workers))
     logger.info('Log level: %s', args.log_level)
     logger.info('Timeout: %s', str(timeout))
 
 
+# Parses the arguments (the command line by default) and prepares the harvester, the scheduler uses it too
+def setup(argv=None, local_logger=None):
+    global args, dead_letter, http_cache, latest, limit_entities, limit_targets, logger
+    global orion, path, service, stations, timeout, workers
+
+    parser = ArgumentParser()
+    parser.add_argument('--config',
+                        dest='config',
+                        help='YAML file with list of stations to be collected or excluded from collecting')
+    parser.add_argument('--dead-letter',
+                        action='store',
+                        dest='dead_letter',
+                        help='NDJSON file to store the entities that could not be posted to Orion')
+    parser.add_argument('--http-cache',
+                        action='store',
+                        dest='http_cache',
+                        help='SQLite file to cache the responses of the source, unchanged data is not posted again')
+    parser.add_argument('--key',
+                        action='store',
+                        dest='key',
+                        help='API Key to access to AEMET Open Data Portal',
+                        required=True)
+    parser.add_argument('--latest',
+                        action='store_true',
+                        default=default_latest,
+                        dest='latest',
+                        help='Collect only latest observation')
+    parser.add_argument('--limit-entities',
+                        default=default_limit_entities,
+                        dest='limit_entities',
+                        help='Limit amount of entities per 1 request to Orion')
+    parser.add_argument('--limit-targets',
+                        default=default_limit_targets,
+                        dest='limit_targets',
+                        help='Limit amount of parallel requests to Orion')
+    parser.add_argument('--log-level',
+                        default=default_log_level,
+                        dest='log_level',
+                        help='Set the logging output level. {0}'.format(log_levels),
+                        nargs='?')
+    parser.add_argument('--orion',
+                        action='store',
+                        default=default_orion,
+                        dest='orion',
+                        help='Orion Context Broker endpoint')
+    parser.add_argument('--path',
+                        action='store',
+                        dest='path',
+                        help='FIWARE Service Path')
+    parser.add_argument('--service',
+                        action='store',
+                        dest="service",
+                        help='FIWARE Service')
+    parser.add_argument('--stations',
+                        action='store',
+                        default=default_station_file,
+                        dest="station_file",
+                        help='Station file')
+    parser.add_argument('--timeout',
+                        action='store',
+                        default=default_timeout,
+                        dest='timeout',
+                        help='Run as a service')
+    parser.add_argument('--workers',
+                        action='store',
+                        default=default_workers,
+                        dest='workers',
+                        help='Amount of processes to prepare the schema, one per CPU by default')
+
+    args = parser.parse_args(argv)
+
+    latest = args.latest
+    dead_letter = args.dead_letter
+    http_cache = HttpCache(args.http_cache) if args.http_cache else None
+    limit_entities = int(args.limit_entities)
+    limit_targets = int(args.limit_targets)
+    orion = args.orion
+    timeout = int(args.timeout)
+    workers = int(args.workers) if args.workers else None
+
+    if 'path' in args:
+        path = args.path
+    if 'service' in args:
+        service = args.service
+
+    if local_logger is None:
+        logger = setup_logger()
+    else:
+        logger = local_logger
+
+    res = setup_stations_config(args.config)
+    stations = setup_stations(res, args.station_file)
+
+    reply_status()
+
+
 def setup_logger():
     local_logger = logging.getLogger('root')
     local_logger.setLevel(log_level_to_int(args.log_level))
@@ -349,10 +375,7 @@ def setup_logger():
     handler.setFormatter(formatter)
     local_logger.addHandler(handler)
 
-    local_logger_req = logging.getLogger('requests')
-    local_logger_req.setLevel(logging.WARNING)
-
-    return local_logger, local_logger_req
+    return local_logger
 
 
 def setup_stations(stations_limit, station_file):
@@ -440,86 +463,22 @@ def setup_config_re(station):
     return "- '{}'\n".format(fix)
 
 
-if __name__ == '__main__':
-
-    parser = ArgumentParser()
-    parser.add_argument('--config',
-                        dest='config',
-                        help='YAML file with list of stations to be collected or excluded from collecting')
-    parser.add_argument('--key',
-                        action='store',
-                        dest='key',
-                        help='API Key to access to AEMET Open Data Portal',
-                        required=True)
-    parser.add_argument('--latest',
-                        action='store_true',
-                        default=default_latest,
-                        dest='latest',
-                        help='Collect only latest observation')
-    parser.add_argument('--limit-entities',
-                        default=default_limit_entities,
-                        dest='limit_entities',
-                        help='Limit amount of entities per 1 request to Orion')
-    parser.add_argument('--limit-targets',
-                        default=default_limit_targets,
-                        dest='limit_targets',
-                        help='Limit amount of parallel requests to Orion')
-    parser.add_argument('--log-level',
-                        default=default_log_level,
-                        dest='log_level',
-                        help='Set the logging output level. {0}'.format(log_levels),
-                        nargs='?')
-    parser.add_argument('--orion',
-                        action='store',
-                        default=default_orion,
-                        dest='orion',
-                        help='Orion Context Broker endpoint')
-    parser.add_argument('--path',
-                        action='store',
-                        dest='path',
-                        help='FIWARE Service Path')
-    parser.add_argument('--service',
-                        action='store',
-                        dest="service",
-                        help='FIWARE Service')
-    parser.add_argument('--stations',
-                        action='store',
-                        default=default_station_file,
-                        dest="station_file",
-                        help='Station file')
-    parser.add_argument('--timeout',
-                        action='store',
-                        default=default_timeout,
-                        dest='timeout',
-                        help='Run as a service')
-
-    args = parser.parse_args()
+# Worker processes of the pipeline may not share the globals set in __main__
+def setup_worker(local_stations, local_latest):
+    global latest, logger, stations
 
-    latest = args.latest
-    limit_entities = int(args.limit_entities)
-    limit_targets = int(args.limit_targets)
-    orion = args.orion
-    timeout = int(args.timeout)
+    latest = local_latest
+    logger = logging.getLogger('root')
+    stations = local_stations
 
-    if 'path' in args:
-        path = args.path
-    if 'service' in args:
-        service = args.service
 
-    logger, logger_req = setup_logger()
+if __name__ == '__main__':
+    setup()
 
     set_event_loop_policy(EventLoopPolicy())
 
-    res = setup_stations_config(args.config)
-    stations = setup_stations(res, args.station_file)
-
-    reply_status()
-
     while True:
-        res = collect(args.key)
-        if res:
-            res = run(prepare_schema(res))
-            run(post(res))
+        run(harvest())
         if timeout == -1:
             break
         else:
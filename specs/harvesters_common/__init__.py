@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Code shared by the harvesters of the FIWARE Data Models.
+"""
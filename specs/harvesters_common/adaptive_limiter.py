@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    AIMD (additive increase, multiplicative decrease) limiter of the amount of parallel requests to a server, used
+    instead of a fixed Semaphore.
+
+    - requests are grouped in rounds of as many requests as the current window
+    - after each round, if its p95 latency and error rate are under the targets, the window grows by 1
+    - on a 5xx response or a timeout the window is multiplied by decrease (halved by default). The requests which were
+      already in flight at that moment do not decrease it again
+    - the window is kept between min_limit and max_limit
+
+    Usage:
+
+        limiter = AdaptiveLimiter(limit=50, max_limit=200)
+
+        await limiter.acquire()
+        status = ... # the request
+        await limiter.release(latency, ok, overloaded)
+"""
+
+from asyncio import Condition
+
+default_decrease = 0.5                 # factor applied to the window on overload
+default_min_limit = 1
+default_target_error_rate = 0.05       # max share of failed requests in a round to grow the window
+default_target_latency = 2.0           # seconds, max p95 latency in a round to grow the window
+
+
+class AdaptiveLimiter(object):
+    def __init__(self, limit, min_limit=default_min_limit, max_limit=None, target_latency=default_target_latency,
+                 target_error_rate=default_target_error_rate, decrease=default_decrease):
+        self.max_limit = limit if max_limit is None else max_limit
+        self.min_limit = min(min_limit, self.max_limit)
+        self.limit = float(max(self.min_limit, min(limit, self.max_limit)))
+        self.target_latency = target_latency
+        self.target_error_rate = target_error_rate
+        self.decrease = decrease
+
+        self.in_flight = 0
+        # Created on first use, so it belongs to the running loop
+        self.condition = None
+
+        # Latencies and failures of the current round
+        self.latencies = list()
+        self.errors = 0
+
+        # Amount of requests to be completed before an overload decreases the window again
+        self.cooldown = 0
+
+        # Range of the window since the limiter was created, without keeping every change
+        self.min_window = self.window
+        self.max_window = self.window
+
+    @property
+    def window(self):
+        return int(self.limit)
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = Condition()
+
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.window)
+            self.in_flight += 1
+
+    # Reports the result of a request and frees its slot
+    # ok - the request succeeded, overloaded - it failed due to a 5xx response or a timeout
+    async def release(self, latency, ok, overloaded):
+        async with self.condition:
+            self.in_flight -= 1
+            self.update(latency, ok, overloaded)
+            self.condition.notify_all()
+
+    def update(self, latency, ok, overloaded):
+        window = self.window
+
+        if self.cooldown > 0:
+            self.cooldown -= 1
+
+        if overloaded:
+            if self.cooldown == 0:
+                self.limit = max(float(self.min_limit), self.limit * self.decrease)
+                self.cooldown = self.in_flight + 1
+            self.start_round()
+        else:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+
+            if len(self.latencies) >= window:
+                if self.p95() <= self.target_latency and self.errors <= self.target_error_rate * len(self.latencies):
+                    self.limit = min(float(self.max_limit), self.limit + 1)
+                self.start_round()
+
+        if self.window != window:
+            self.min_window = min(self.min_window, self.window)
+            self.max_window = max(self.max_window, self.window)
+
+    def start_round(self):
+        self.latencies = list()
+        self.errors = 0
+
+    def p95(self):
+        latencies = sorted(self.latencies)
+
+        return latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))]
+
+    def summary(self):
+        return 'window {} (min {}, max {})'.format(self.window, self.min_window, self.max_window)
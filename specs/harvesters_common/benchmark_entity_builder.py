@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Micro-benchmark of EntityBuilder against deepcopy(template), with the WeatherForecast template of the Spain
+    harvester: 8 forecasts per municipality, some values missing.
+
+    Usage, from the specs folder:
+
+        python3 -m harvesters_common.benchmark_entity_builder [--entities N]
+"""
+
+from argparse import ArgumentParser
+from copy import deepcopy
+from timeit import timeit
+
+from .entity_builder import EntityBuilder
+
+template = {
+    'id': 'urn:ngsi-ld:WeatherForecast:Spain-WeatherForecast-',
+    'type': 'WeatherForecast',
+    'address': {'type': 'PostalAddress', 'value': {'addressCountry': 'ES', 'addressLocality': None, 'postalCode': None}},
+    'dateIssued': {'type': 'DateTime', 'value': None},
+    'dataProvider': {'type': 'Text', 'value': 'FIWARE'},
+    'dateRetrieved': {'type': 'DateTime', 'value': None},
+    'dayMaximum': {'type': 'StructuredValue',
+                   'value': {'feelsLikeTemperature': None, 'temperature': None, 'relativeHumidity': None}},
+    'dayMinimum': {'type': 'StructuredValue',
+                   'value': {'feelsLikeTemperature': None, 'temperature': None, 'relativeHumidity': None}},
+    'feelsLikeTemperature': {'type': 'Number', 'value': None},
+    'precipitationProbability': {'type': 'Number', 'value': None},
+    'relativeHumidity': {'type': 'Number', 'value': None},
+    'source': {'type': 'URL', 'value': 'http://www.aemet.es'},
+    'temperature': {'type': 'Number', 'value': None},
+    'validFrom': {'type': 'DateTime', 'value': None},
+    'validTo': {'type': 'DateTime', 'value': None},
+    'validity': {'type': 'Text', 'value': None},
+    'weatherType': {'type': 'Text', 'value': None},
+    'windDirection': {'type': 'Number', 'value': None},
+    'windSpeed': {'type': 'Number', 'value': None}
+}
+
+# One forecast, precipitationProbability and windDirection are missing
+values = {
+    'address': {'addressLocality': 'Madrid', 'postalCode': '28079'},
+    'dateIssued': '2019-07-01T10:00:00Z',
+    'dateRetrieved': '2019-07-01T10:05:00Z',
+    'dayMaximum': {'feelsLikeTemperature': 35.0, 'temperature': 34.0, 'relativeHumidity': 0.6},
+    'dayMinimum': {'feelsLikeTemperature': 20.0, 'temperature': 19.0, 'relativeHumidity': None},
+    'feelsLikeTemperature': 30.0,
+    'precipitationProbability': None,
+    'relativeHumidity': 0.4,
+    'temperature': 29.0,
+    'validFrom': '2019-07-01T12:00:00Z',
+    'validTo': '2019-07-01T18:00:00Z',
+    'validity': '2019-07-01T12:00:00Z/2019-07-01T18:00:00Z',
+    'weatherType': 'sunnyDay',
+    'windDirection': None,
+    'windSpeed': 2.8
+}
+
+
+# The way the harvesters built entities before EntityBuilder
+def build_deepcopy(entity_id):
+    item = deepcopy(template)
+    item['id'] = entity_id
+
+    for name in values:
+        value = values[name]
+        if isinstance(value, dict):
+            for member in value:
+                if value[member] is not None:
+                    item[name]['value'][member] = value[member]
+                else:
+                    del item[name]['value'][member]
+            if len(item[name]['value']) == 0:
+                del item[name]
+        elif value is not None:
+            item[name]['value'] = value
+        else:
+            del item[name]
+
+    return item
+
+
+def main(entities):
+    builder = EntityBuilder(template)
+    entity_id = template['id'] + '28079'
+
+    if build_deepcopy(entity_id) != builder.build(entity_id, values):
+        raise AssertionError('Both ways should build the same entity')
+
+    before = timeit(lambda: build_deepcopy(entity_id), number=entities)
+    after = timeit(lambda: builder.build(entity_id, values), number=entities)
+
+    print('{} entities'.format(entities))
+    print('deepcopy(template): {:.3f}s, {:.0f} entities/s'.format(before, entities / before))
+    print('EntityBuilder:      {:.3f}s, {:.0f} entities/s'.format(after, entities / after))
+    print('speedup:            {:.1f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--entities',
+                        default=100000,
+                        dest='entities',
+                        help='Amount of entities to build')
+
+    args = parser.parse_args()
+
+    main(int(args.entities))
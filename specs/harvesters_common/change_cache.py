@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Change detection of the entities posted to Orion, so that unchanged entities are not posted again on every cycle.
+
+    A SQLite file maps each entity (type and id) to the hash of its attributes, as they were last posted with success.
+    Only entities which are new, or whose attributes changed, are posted.
+
+    - ignore: members of the attributes left out of the hash, i.e. ['metadata'] if only a timestamp changes there
+    - max_age: seconds after which an unchanged entity is posted again anyway, to repair an Orion which lost it
+
+    Usage (the writer does it when it gets change_cache):
+
+        cache = ChangeCache('changes.db')
+        entities, keys = cache.changed(entities)
+        ... # post the entities
+        cache.store(keys)         # for the entities posted with success
+        cache.commit()
+"""
+
+from hashlib import blake2b
+from json import dumps
+from time import time
+import sqlite3
+
+query_chunk = 500                      # max amount of entities per 1 query to SQLite
+
+
+class ChangeCache(object):
+    def __init__(self, file, ignore=(), max_age=None):
+        self.file = file
+        self.ignore = set(ignore)
+        self.max_age = max_age
+
+        self.db = sqlite3.connect(file)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entities '
+                        '(key TEXT PRIMARY KEY, hash TEXT NOT NULL, updated REAL NOT NULL) WITHOUT ROWID')
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def key(entity):
+        return '{}|{}'.format(entity.get('type'), entity.get('id'))
+
+    def hash(self, entity):
+        attributes = dict()
+
+        for name, value in entity.items():
+            if name == 'id' or name == 'type':
+                continue
+            if self.ignore and isinstance(value, dict):
+                value = dict((k, v) for k, v in value.items() if k not in self.ignore)
+            attributes[name] = value
+
+        return blake2b(dumps(attributes, sort_keys=True, separators=(',', ':')).encode('utf-8'),
+                       digest_size=16).hexdigest()
+
+    # Returns the entities which are new or changed, keeping their order, and their (key, hash)
+    def changed(self, entities):
+        keys = [(self.key(entity), self.hash(entity)) for entity in entities]
+        stored = self.lookup([key for key, _ in keys])
+
+        oldest = None if self.max_age is None else time() - self.max_age
+
+        out_entities = list()
+        out_keys = list()
+        for entity, (key, value) in zip(entities, keys):
+            previous = stored.get(key)
+            if previous is not None and previous[0] == value and (oldest is None or previous[1] >= oldest):
+                continue
+            out_entities.append(entity)
+            out_keys.append((key, value))
+
+        return out_entities, out_keys
+
+    # Returns {key: (hash, updated)} for the keys found
+    def lookup(self, keys):
+        out = dict()
+
+        for i in range(0, len(keys), query_chunk):
+            chunk = keys[i:i + query_chunk]
+            query = 'SELECT key, hash, updated FROM entities WHERE key IN ({})'.format(','.join('?' * len(chunk)))
+            for key, value, updated in self.db.execute(query, chunk):
+                out[key] = (value, updated)
+
+        return out
+
+    # Records the hashes of entities posted with success
+    def store(self, keys):
+        now = time()
+        self.db.executemany('INSERT OR REPLACE INTO entities (key, hash, updated) VALUES (?, ?, ?)',
+                            [(key, value, now) for key, value in keys])
+
+    def commit(self):
+        self.db.commit()
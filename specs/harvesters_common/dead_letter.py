@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Dead-letter file of the entities that could not be posted to Orion (NDJSON, one entity per line).
+
+    Entities are appended as they are rejected, so the file keeps them between runs of a harvester, until they are
+    posted again with replay.py.
+"""
+
+from os import remove, rename
+from os.path import exists
+from threading import Lock
+import logging
+
+try:
+    from yajl import loads
+except ImportError:
+    from json import loads
+
+
+class DeadLetter(object):
+    def __init__(self, file, logger=None):
+        self.file = file
+        self.logger = logger or logging.getLogger('root')
+
+        # Batches are written from the threads of an executor, one at a time
+        self.lock = Lock()
+
+        # Amount of entities stored with this instance
+        self.count = 0
+
+    # Stores a batch of serialized entities
+    def write(self, batch, reason):
+        with self.lock:
+            with open(self.file, 'a') as f:
+                f.write('\n'.join(batch) + '\n')
+            self.count += len(batch)
+
+        self.logger.error('%s entities stored in the dead-letter file %s due to the %s', len(batch), self.file, reason)
+
+    # Moves the file aside to be replayed, so that entities failed again are stored in a new one
+    # Returns the path of the moved file, None if there is nothing to replay
+    def take(self):
+        taken = self.file + '.replay'
+
+        if exists(self.file):
+            if exists(taken):
+                # A previous replay did not end, its entities are kept
+                with open(taken, 'a') as f, open(self.file) as current:
+                    for line in current:
+                        f.write(line)
+                remove(self.file)
+            else:
+                rename(self.file, taken)
+
+        return taken if exists(taken) else None
+
+
+def read_entities(file):
+    with open(file) as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Builds NGSI v2 entities from a template, without copying it (deepcopy) for every entity.
+
+    The template is compiled once into a list of attributes:
+    - attributes whose value is not None are constants, i.e. 'source': {'type': 'URL', 'value': 'http://www.aemet.es'}
+    - attributes whose value is None are filled, i.e. 'temperature': {'type': 'Number', 'value': None}
+    - attributes whose value is a dictionary with None members are filled member by member, the other members are
+      constants, i.e. 'address': {'type': 'PostalAddress', 'value': {'addressCountry': 'ES', 'addressLocality': None}}
+
+    Attributes (and members) without a value, or whose value is None, are not added, so nothing has to be deleted
+    afterwards. Filled dictionaries left empty are not added either.
+
+    Usage:
+
+        builder = EntityBuilder(template)
+        entity = builder.build(template['id'] + local_id, {
+            'address': {'addressLocality': 'Madrid'},
+            'temperature': 21.5
+        })
+
+    Constant values are shared by all the entities built, they must not be modified.
+"""
+
+CONSTANT = 0
+VALUE = 1
+MEMBERS = 2
+
+
+class EntityBuilder(object):
+    def __init__(self, template):
+        self.entity_type = template['type']
+        self.spec = list()
+
+        for name, attribute in template.items():
+            if name == 'id' or name == 'type':
+                continue
+
+            value = attribute.get('value')
+            if value is None:
+                self.spec.append((name, VALUE, attribute['type']))
+            elif isinstance(value, dict) and None in value.values():
+                self.spec.append((name, MEMBERS, (attribute['type'], list(value.items()))))
+            else:
+                self.spec.append((name, CONSTANT, attribute))
+
+    def build(self, entity_id, values):
+        entity = {
+            'id': entity_id,
+            'type': self.entity_type
+        }
+
+        for name, kind, data in self.spec:
+            if kind == CONSTANT:
+                entity[name] = data
+            elif kind == VALUE:
+                value = values.get(name)
+                if value is not None:
+                    entity[name] = {
+                        'type': data,
+                        'value': value
+                    }
+            else:
+                given = values.get(name)
+                if given is None:
+                    given = {}
+                value = dict()
+                for member, default in data[1]:
+                    item = given.get(member) if default is None else default
+                    if item is not None:
+                        value[member] = item
+                if len(value) > 0:
+                    entity[name] = {
+                        'type': data[0],
+                        'value': value
+                    }
+
+        return entity
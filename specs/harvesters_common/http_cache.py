@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    On-disk cache of the responses of the sources, to make conditional requests (If-None-Match, If-Modified-Since).
+
+    A SQLite file maps each URL to the validators (ETag, Last-Modified) and the body of its last response. When a
+    source answers 304 Not Modified, the harvester skips the transformation and the post of that data: it was already
+    posted.
+
+    - only responses with an ETag or a Last-Modified header are stored
+    - the responses are stored with commit, once their data was posted with success. Otherwise (discard, or the
+      process stopped) the next request gets the full response again, instead of 304
+    - max_bytes: the size of the bodies stored is kept under it, evicting the least recently used responses
+
+    Usage with any HTTP client (requests, aiohttp):
+
+        cache = HttpCache('http_cache.db')
+        response = get(url, headers=cache.headers(url))
+        body = cache.store(url, response.status_code, response.headers, response.content)
+        if response.status_code == 304:
+            ... # not modified, nothing to do
+        ... # post the data
+        cache.end(posted)         # commit if posted, discard otherwise
+
+    Usage with urllib (blocking harvesters):
+
+        status, body = fetch(url, cache)
+"""
+
+from contextlib import closing
+from time import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import sqlite3
+
+default_max_bytes = 100000000          # max size of the bodies stored, 100 MB
+default_timeout = 60                   # seconds, timeout of one request with fetch
+
+http_not_modified = 304
+
+
+class HttpCache(object):
+    def __init__(self, file, max_bytes=default_max_bytes):
+        self.file = file
+        self.max_bytes = max_bytes
+
+        self.db = sqlite3.connect(file)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                        '(url TEXT PRIMARY KEY, etag TEXT, modified TEXT, body BLOB NOT NULL, size INTEGER NOT NULL, '
+                        'used REAL NOT NULL) WITHOUT ROWID')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+
+        # Responses to be stored on commit, url: (etag, modified, body)
+        self.pending = dict()
+
+        # Amount of responses not modified, and of responses stored, with this instance
+        self.hits = 0
+        self.stored = 0
+
+    def body(self, url):
+        row = self.db.execute('SELECT body FROM responses WHERE url = ?', (url,)).fetchone()
+        return None if row is None else row[0]
+
+    def close(self):
+        self.db.close()
+
+    # Stores the responses recorded since the last commit, once their data was posted
+    def commit(self):
+        if len(self.pending) == 0:
+            return
+
+        with self.db:
+            for url, (etag, modified, body) in self.pending.items():
+                self.db.execute('INSERT OR REPLACE INTO responses (url, etag, modified, body, size, used) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', (url, etag, modified, body, len(body), time()))
+            self.stored += len(self.pending)
+            self.evict()
+
+        self.pending = dict()
+
+    # Forgets the responses recorded since the last commit, their data was not posted
+    def discard(self):
+        self.pending = dict()
+
+    # Commits if the data of the responses recorded was posted, discards them otherwise
+    def end(self, posted):
+        if posted:
+            self.commit()
+        else:
+            self.discard()
+
+    # Removes the least recently used responses until the bodies stored fit in max_bytes
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = list()
+        for url, size in self.db.execute('SELECT url, size FROM responses ORDER BY used'):
+            if total <= self.max_bytes:
+                break
+            evicted.append((url,))
+            total -= size
+
+        self.db.executemany('DELETE FROM responses WHERE url = ?', evicted)
+
+    # Returns the headers of a request to url, with the validators of the response stored (if any)
+    def headers(self, url, headers=None):
+        out = dict(headers or {})
+
+        row = self.db.execute('SELECT etag, modified FROM responses WHERE url = ?', (url,)).fetchone()
+        if row is not None:
+            if row[0] is not None:
+                out['If-None-Match'] = row[0]
+            if row[1] is not None:
+                out['If-Modified-Since'] = row[1]
+
+        return out
+
+    # Records a response, to be stored on commit, returns its body (the one stored if the response is 304 Not Modified)
+    def store(self, url, status, headers, body):
+        if status == http_not_modified:
+            self.hits += 1
+            with self.db:
+                self.db.execute('UPDATE responses SET used = ? WHERE url = ?', (time(), url))
+            return self.body(url)
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        etag = headers.get('ETag')
+        modified = headers.get('Last-Modified')
+
+        # The response stored is outdated, whether the new one is stored or not
+        self.pending.pop(url, None)
+        with self.db:
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+
+        if (etag is not None or modified is not None) and len(body) <= self.max_bytes:
+            self.pending[url] = (etag, modified, body)
+
+        return body
+
+    def summary(self):
+        return 'HTTP cache: {} responses not modified, {} stored'.format(self.hits, self.stored)
+
+
+# GET with urllib, conditional if a cache is given, returns the status and the body
+# urllib raises HTTPError on 304, it is returned as a status here
+def fetch(url, cache=None, headers=None, timeout=default_timeout):
+    request = Request(url=url, headers=headers if cache is None else cache.headers(url, headers))
+
+    try:
+        with closing(urlopen(request, timeout=timeout)) as f:
+            status = f.status
+            response_headers = f.headers
+            body = f.read()
+    except HTTPError as e:
+        if e.code != http_not_modified:
+            raise
+        status = e.code
+        response_headers = e.headers
+        body = b''
+
+    if cache is not None:
+        body = cache.store(url, status, response_headers, body)
+
+    return status, body
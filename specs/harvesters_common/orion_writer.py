@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Batch writer to upload NGSI v2 entities to the Orion Context Broker (/v2/op/update), shared by all the harvesters.
+
+    - one pooled keep-alive aiohttp session per writer
+    - entities are split, in order, in batches of up to limit_entities and limit_bytes
+    - entities can be submitted as they are prepared (submit), full batches are posted at once and the last one with
+      flush, while too many batches wait to be posted submit waits too (backpressure)
+    - batches are posted in parallel, the amount of parallel requests starts at limit_target and is adapted (AIMD) to
+      the latency and errors of Orion, up to limit_target_max (see adaptive_limiter.py)
+    - failed batches (connection problems, timeouts, 5xx) are retried with jittered exponential backoff, up to
+      limit_retries batches wait for a retry at the same time, the others wait for their turn
+    - batches which fail permanently (4xx or out of retries) are stored in a dead-letter NDJSON file, if given, to be
+      posted later with replay.py. The file is written in the default executor, not to block the event loop
+    - with change_cache (a file or a ChangeCache), entities which did not change since they were last posted with
+      success are skipped (see change_cache.py)
+    - the session and the limiter can be shared by several writers (see scheduler.py)
+    - latency of every batch is recorded, and summarized at the end
+
+    Usage from asyncio code:
+
+        async with OrionWriter(orion, service=service, path=path) as writer:
+            await writer.post(entities)
+
+    or, streaming the entities:
+
+        async with OrionWriter(orion, service=service, path=path) as writer:
+            for entities in ...:
+                await writer.submit(entities)
+            await writer.flush()
+
+    Usage from blocking code:
+
+        post_entities(entities, orion, service=service, path=path)
+
+    AsyncIO name convention:
+    async def name - entry point for asynchronous data processing/http requests and post processing
+    async def name_bounded - intermediate step to limit amount of parallel workers
+    async def name_one - worker process
+"""
+
+from aiohttp import ClientSession, ClientError, ClientTimeout, TCPConnector
+from asyncio import Semaphore, ensure_future, gather, get_event_loop, run, sleep, TimeoutError as ToE
+from random import uniform
+from time import monotonic
+import logging
+
+from .adaptive_limiter import AdaptiveLimiter
+from .change_cache import ChangeCache
+from .dead_letter import DeadLetter
+
+try:
+    from yajl import dumps
+except ImportError:
+    from json import dumps
+
+default_action = 'APPEND'
+default_backoff = 0.5                  # seconds before the first retry (jittered), doubled on every retry
+default_limit_bytes = 1000000          # max size of 1 request to Orion (its limit is 1 MB)
+default_limit_entities = 50            # amount of entities per 1 request to Orion
+default_limit_target = 50              # initial amount of parallel request to Orion
+default_limit_target_max = 200         # max amount of parallel request to Orion
+default_limit_retries = 100            # max amount of batches waiting for a retry
+default_retries = 3                    # amount of retries of a failed batch
+default_timeout = 60                   # seconds, timeout of one request to Orion
+
+http_ok = [200, 201, 204]
+
+
+class OrionWriter(object):
+    def __init__(self, orion, service=None, path=None, limit_entities=default_limit_entities,
+                 limit_bytes=default_limit_bytes, limit_target=default_limit_target, limit_target_max=None,
+                 retries=default_retries, limit_retries=default_limit_retries, backoff=default_backoff,
+                 timeout=default_timeout, action=default_action, dead_letter=None, change_cache=None, session=None,
+                 limiter=None, logger=None):
+        self.url = orion + '/v2/op/update'
+        self.limit_entities = limit_entities
+        self.limit_bytes = limit_bytes
+        self.limit_target = limit_target
+        # Set it to limit_target to keep a fixed amount of parallel requests
+        self.limit_target_max = max(limit_target, default_limit_target_max if limit_target_max is None else limit_target_max)
+        self.retries = retries
+        self.limit_retries = limit_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.action = action
+        self.logger = logger or logging.getLogger('root')
+        # A dead-letter file, or any object with write(batch, reason) (called in the default executor), i.e. to
+        # collect the failed batches
+        self.dead_letter = DeadLetter(dead_letter, self.logger) if isinstance(dead_letter, str) else dead_letter
+
+        # A cache given as a file is opened and closed here
+        self.change_cache = ChangeCache(change_cache) if isinstance(change_cache, str) else change_cache
+        self.own_change_cache = isinstance(change_cache, str)
+
+        self.headers = {
+            'Content-Type': 'application/json'
+        }
+        if service:
+            self.headers['FIWARE-SERVICE'] = service
+        if path:
+            self.headers['FIWARE-SERVICEPATH'] = path
+
+        # A session can be shared with other writers, then it is not closed here
+        self.session = session
+        self.own_session = session is None
+
+        self.metrics = list()
+        # Created on first use, so it belongs to the running loop
+        self.retry_slots = None
+
+        # A limiter can be shared with other writers, to bound the requests of all of them to the same Orion
+        self.limiter = AdaptiveLimiter(limit_target, max_limit=self.limit_target_max) if limiter is None else limiter
+
+        # Batches being filled and posted, up to limit_pending are posted or wait for a slot of the limiter
+        self.batcher = Batcher(limit_entities, limit_bytes - len(self.envelope()))
+        self.batch_keys = list()
+        self.limit_pending = 2 * self.limit_target_max
+        self.pending = None
+        self.tasks = list()
+
+        # Amount of entities posted and failed with this writer
+        self.posted = 0
+        self.failed = 0
+        self.skipped = 0
+
+    async def __aenter__(self):
+        if self.session is None:
+            self.session = ClientSession(connector=TCPConnector(limit=self.limit_target_max),
+                                         timeout=ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self.own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+        if self.own_change_cache and self.change_cache is not None:
+            self.change_cache.close()
+            self.change_cache = None
+
+    # Request body without entities, the serialized entities are placed between both parts
+    def envelope(self):
+        return '{"actionType":' + dumps(self.action) + ',"entities":[]}'
+
+    async def post(self, entities):
+        self.logger.debug('Posting data to Orion started')
+
+        await self.submit(entities)
+        result = await self.flush()
+
+        self.logger.debug('Posting data to Orion ended')
+
+        return result
+
+    # Posts the batches waiting to be filled, waits for all the batches and logs the summary
+    # Returns True if all the batches were posted with success
+    async def flush(self):
+        batch = self.batcher.flush()
+        if batch is not None:
+            await self.schedule(batch)
+
+        response = await gather(*self.tasks)
+        self.tasks = list()
+
+        if self.change_cache is not None:
+            self.change_cache.commit()
+
+        response = list(set(response))
+        if True in response:
+            response.remove(True)
+
+        for item in response:
+            self.logger.error('Posting data to Orion failed due to the %s', item)
+
+        self.logger.info(self.summary())
+
+        return len(response) == 0
+
+    # Starts posting a full batch, waits while limit_pending batches are not posted yet
+    async def schedule(self, batch):
+        keys = None
+        if self.change_cache is not None:
+            keys = self.batch_keys[:len(batch)]
+            self.batch_keys = self.batch_keys[len(batch):]
+
+        if self.pending is None:
+            self.pending = Semaphore(self.limit_pending)
+        await self.pending.acquire()
+
+        task = ensure_future(self.post_one(batch, keys))
+        task.add_done_callback(lambda _: self.pending.release())
+        self.tasks.append(task)
+
+    # Sends a payload holding a slot of the limiter, which is freed before retrying
+    async def post_bounded(self, payload):
+        await self.limiter.acquire()
+
+        started = monotonic()
+        status, result = None, 'cancelled'
+        try:
+            status, result = await self.send(payload)
+        finally:
+            await self.limiter.release(monotonic() - started, result is True, self.is_retryable(status))
+
+        return status, result, monotonic() - started
+
+    # Posts one batch (list of serialized entities), retrying it if needed
+    # Returns True or the reason of the failure, then the batch is stored in the dead-letter file (if any)
+    # keys - (key, hash) of the entities of the batch in the change cache, stored on success
+    async def post_one(self, batch, keys=None):
+        envelope = self.envelope()
+        payload = (envelope[:-2] + ','.join(batch) + envelope[-2:]).encode('utf-8')
+
+        attempt = 0
+        while True:
+            status, result, latency = await self.post_bounded(payload)
+            self.record(len(batch), latency, status, attempt)
+
+            if result is True:
+                self.posted += len(batch)
+                if keys is not None:
+                    self.change_cache.store(keys)
+                return result
+
+            if not self.is_retryable(status) or attempt >= self.retries:
+                self.failed += len(batch)
+                if self.dead_letter is not None:
+                    await get_event_loop().run_in_executor(None, self.dead_letter.write, batch, result)
+                return result
+
+            # Jitter spreads the retries of the batches which failed at the same time
+            delay = self.backoff * (2 ** attempt) * uniform(0.5, 1.5)
+            self.logger.debug('Posting batch to Orion failed due to the %s, retrying in %.2f seconds', result, delay)
+
+            # Up to limit_retries batches wait for a retry at the same time, the others wait for a slot
+            if self.retry_slots is None:
+                self.retry_slots = Semaphore(self.limit_retries)
+            async with self.retry_slots:
+                await sleep(delay)
+            attempt += 1
+
+    # Returns the status (None if there was no response) and True or the reason of the failure
+    async def send(self, payload):
+        try:
+            async with self.session.post(self.url, headers=self.headers, data=payload) as response:
+                status = response.status
+                await response.read()
+        except ToE:
+            return None, 'timeout problem'
+        except ClientError:
+            return None, 'connection problem'
+
+        if status not in http_ok:
+            return status, 'response code ' + str(status)
+
+        return status, True
+
+    # Adds entities to the batches, in order, the batches are posted as soon as they are full
+    async def submit(self, entities):
+        keys = None
+        if self.change_cache is not None:
+            total = len(entities)
+            entities, keys = self.change_cache.changed(entities)
+            self.skipped += total - len(entities)
+            self.logger.debug('%s entities unchanged, %s to be posted', total - len(entities), len(entities))
+
+        for i in range(len(entities)):
+            # Batches keep the order of the entities, so their keys are consecutive
+            if keys is not None:
+                self.batch_keys.append(keys[i])
+
+            batch = self.batcher.add(entities[i])
+            if batch is not None:
+                await self.schedule(batch)
+
+    @staticmethod
+    def is_retryable(status):
+        return status is None or status >= 500
+
+    def record(self, entities, latency, status, attempt):
+        self.metrics.append({
+            'entities': entities,
+            'latency': latency,
+            'status': status,
+            'attempt': attempt,
+            'window': self.limiter.window
+        })
+        self.logger.debug('Batch of %s entities posted in %.3f seconds, status %s, window %s', entities, latency, status,
+                          self.limiter.window)
+
+    def summary(self):
+        if len(self.metrics) == 0:
+            return 'Orion: nothing posted, {} entities unchanged'.format(self.skipped)
+
+        latencies = sorted(item['latency'] for item in self.metrics)
+        failed = len([item for item in self.metrics if item['status'] not in http_ok])
+        entities = sum(item['entities'] for item in self.metrics if item['status'] in http_ok)
+        # The range of the window during this writer, the limiter may be shared with other writers
+        windows = [item['window'] for item in self.metrics]
+
+        return ('Orion: {} entities posted, {} unchanged, {} requests, {} failed, '
+                'latency p50 {:.3f}s, p95 {:.3f}s, max {:.3f}s, window {} (min {}, max {})').format(
+            entities, self.skipped, len(self.metrics), failed, percentile(latencies, 50), percentile(latencies, 95),
+            latencies[-1], self.limiter.window, min(windows), max(windows))
+
+
+# Splits entities in batches of up to limit_entities and limit_bytes (the sum of the
+# serialized entities and the commas between them), keeping their order.
+# Each entity is serialized once, batches are lists of serialized entities.
+# An entity bigger than limit_bytes goes alone in its batch
+class Batcher(object):
+    def __init__(self, limit_entities, limit_bytes):
+        self.limit_entities = limit_entities
+        self.limit_bytes = limit_bytes
+        self.batch = list()
+        self.size = 0
+
+    # Adds an entity, returns the batch it did not fit in (full), if any
+    def add(self, entity):
+        item = dumps(entity)
+        item_size = len(item) if item.isascii() else len(item.encode('utf-8'))
+
+        full = None
+        if len(self.batch) > 0 and (len(self.batch) >= self.limit_entities or
+                                    self.size + 1 + item_size > self.limit_bytes):
+            full = self.flush()
+
+        if len(self.batch) > 0:
+            self.size += 1
+        self.batch.append(item)
+        self.size += item_size
+
+        return full
+
+    # Returns the batch being filled, if any, and starts a new one
+    def flush(self):
+        if len(self.batch) == 0:
+            return None
+
+        batch = self.batch
+        self.batch = list()
+        self.size = 0
+
+        return batch
+
+
+# Splits entities in batches in a single pass, see Batcher
+def split_batches(entities, limit_entities, limit_bytes):
+    batcher = Batcher(limit_entities, limit_bytes)
+    batches = list()
+
+    for entity in entities:
+        batch = batcher.add(entity)
+        if batch is not None:
+            batches.append(batch)
+
+    batch = batcher.flush()
+    if batch is not None:
+        batches.append(batch)
+
+    return batches
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+# Returns the amount of entities posted and failed
+async def post_entities_async(entities, orion, **kwargs):
+    async with OrionWriter(orion, **kwargs) as writer:
+        await writer.post(entities)
+
+    return writer.posted, writer.failed
+
+
+# Blocking version, for the harvesters that do not use asyncio
+def post_entities(entities, orion, **kwargs):
+    return run(post_entities_async(entities, orion, **kwargs))
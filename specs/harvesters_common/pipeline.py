@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    One cycle of a harvester in a single event loop, as a pipeline:
+
+        source (collection) -> transform (process pool) -> bounded queue -> OrionWriter
+
+    - items are transformed while the collection goes on, and entities are posted while items are transformed
+    - transform is CPU work (prepare_schema_one), it runs in a ProcessPoolExecutor, on chunks of items to lower the
+      cost of passing them between processes
+    - the amount of chunks being transformed, of transformed chunks waiting in the queue and of batches waiting to be
+      posted is limited, so a slow Orion slows down the collection instead of filling the memory
+
+    source is an iterable or an asynchronous iterable (i.e. an async generator yielding the items as they are
+    collected), items which are False or None (failed collections) are skipped.
+
+    transform must be defined at the top level of a module (it is pickled by name), it returns an entity, a list of
+    entities or None. Worker processes may not share the globals of the harvester, initializer (with initargs) sets
+    them in every worker. An executor can be given instead (with its amount of workers), i.e. shared by the harvesters
+    of the scheduler, then it is not shut down here and initializer is not used.
+
+    Usage:
+
+        async with OrionWriter(orion, service=service, path=path) as writer:
+            await pipeline(collect(), prepare_schema_one, writer, initializer=setup_worker, initargs=(stations,))
+
+    AsyncIO name convention:
+    async def name - entry point for asynchronous data processing/http requests and post processing
+    async def name_bounded - intermediate step to limit amount of parallel workers
+    async def name_one - worker process
+"""
+
+from asyncio import Queue, Semaphore, ensure_future, gather, get_event_loop
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+import logging
+
+default_chunk = 10                     # amount of items per 1 task of a worker process
+default_limit_queue = 100              # amount of transformed chunks waiting for the writer
+
+
+# Items of the source, in chunks of up to size items
+async def chunks(source, size):
+    items = list()
+
+    async for item in iterate(source):
+        if not item:
+            continue
+        items.append(item)
+        if len(items) >= size:
+            yield items
+            items = list()
+
+    if len(items) > 0:
+        yield items
+
+
+async def iterate(source):
+    if hasattr(source, '__aiter__'):
+        async for item in source:
+            yield item
+    else:
+        for item in source:
+            yield item
+
+
+# Returns True if all the entities were posted with success
+async def pipeline(source, transform, writer, workers=None, chunk=default_chunk, limit_queue=default_limit_queue,
+                   initializer=None, initargs=(), executor=None, logger=None):
+    logger = logger or logging.getLogger('root')
+    workers = workers or cpu_count() or 1
+
+    if executor is not None:
+        return await run_pipeline(source, transform, writer, executor, workers, chunk, limit_queue, logger)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        # Forked workers are started before the collection, which may start threads (i.e. to resolve names)
+        await get_event_loop().run_in_executor(executor, int)
+
+        return await run_pipeline(source, transform, writer, executor, workers, chunk, limit_queue, logger)
+
+
+# Submits the transformed entities to the writer, until None
+async def post(queue, writer):
+    while True:
+        entities = await queue.get()
+        if entities is None:
+            break
+        await writer.submit(entities)
+
+    return await writer.flush()
+
+
+# workers - amount of processes of the executor, to keep them busy
+async def run_pipeline(source, transform, writer, executor, workers, chunk, limit_queue, logger):
+    queue = Queue(maxsize=limit_queue)
+    sem = Semaphore(2 * workers)
+
+    logger.debug('Pipeline started, %s worker processes', workers)
+
+    consumer = ensure_future(post(queue, writer))
+    tasks = list()
+
+    try:
+        async for items in chunks(source, chunk):
+            await sem.acquire()
+            tasks.append(ensure_future(transform_bounded(executor, transform, items, queue, sem)))
+
+        await gather(*tasks)
+        await queue.put(None)
+        result = await consumer
+    finally:
+        for task in tasks + [consumer]:
+            task.cancel()
+
+    logger.debug('Pipeline ended')
+
+    return result
+
+
+# The slot is freed once the entities are in the queue, so a full queue stops the transformation too
+async def transform_bounded(executor, transform, items, queue, sem):
+    try:
+        entities = await get_event_loop().run_in_executor(executor, transform_one, transform, items)
+        await queue.put(entities)
+    finally:
+        sem.release()
+
+
+# Runs in a worker process
+def transform_one(transform, items):
+    result = list()
+
+    for item in items:
+        entities = transform(item)
+        if isinstance(entities, list):
+            result.extend(entities)
+        elif entities is not None:
+            result.append(entities)
+
+    return result
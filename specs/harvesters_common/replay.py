@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Posts again to the Orion Context Broker the entities stored in a dead-letter file by a harvester.
+
+    The file is moved aside (FILE.replay) and its entities are posted at full speed. Entities which fail again are
+    stored in a new dead-letter file (FILE), so replay can be run again later. FILE.replay is removed at the end.
+
+    Usage, from the specs folder:
+
+        python3 -m harvesters_common.replay --orion http://orion:1026 --service weather dead_letter.ndjson
+"""
+
+from argparse import ArgumentParser
+from asyncio import run
+from os import remove
+from sys import stdout
+import logging
+
+from .dead_letter import DeadLetter, read_entities
+from .orion_writer import OrionWriter, default_limit_entities, default_limit_target_max
+
+default_orion = 'http://orion:1026'    # Orion Contest Broker endpoint
+
+
+async def replay(file, orion, service=None, path=None, limit_entities=default_limit_entities,
+                 limit_target=default_limit_target_max, logger=None):
+    logger = logger or logging.getLogger('root')
+
+    taken = DeadLetter(file, logger).take()
+    if taken is None:
+        logger.info('Nothing to replay, %s does not exist', file)
+        return 0, 0
+
+    entities = list(read_entities(taken))
+    logger.info('Replaying %s entities from %s', len(entities), taken)
+
+    async with OrionWriter(orion, service=service, path=path, limit_entities=limit_entities, limit_target=limit_target,
+                           dead_letter=file, logger=logger) as writer:
+        await writer.post(entities)
+
+    remove(taken)
+
+    return writer.posted, writer.failed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('file',
+                        help='Dead-letter file')
+    parser.add_argument('--limit-entities',
+                        default=default_limit_entities,
+                        dest='limit_entities',
+                        help='Limit amount of entities per 1 request to Orion')
+    parser.add_argument('--limit-target',
+                        default=default_limit_target_max,
+                        dest='limit_target',
+                        help='Limit amount of parallel requests to Orion')
+    parser.add_argument('--orion',
+                        action='store',
+                        default=default_orion,
+                        dest='orion',
+                        help='Orion Context Broker endpoint')
+    parser.add_argument('--path',
+                        action='store',
+                        dest='path',
+                        help='FIWARE Service Path')
+    parser.add_argument('--service',
+                        action='store',
+                        dest='service',
+                        help='FIWARE Service')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=stdout, level=logging.INFO, format='%(asctime)s %(message)s')
+
+    posted, failed = run(replay(args.file, args.orion, args.service, args.path, int(args.limit_entities),
+                                int(args.limit_target)))
+
+    logging.info('Replay ended, %s entities posted, %s failed', posted, failed)
+    exit(0 if failed == 0 else 1)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Hosts several harvesters in one process, instead of one process (with a while/sleep loop) per harvester.
+
+    Every job runs a harvester on its own schedule, in one event loop:
+    - interval: seconds between two runs, the runs are anchored to the first one, not to the end of the previous one
+    - cron: 5 fields (minute hour day month weekday), with *, lists, ranges and steps, i.e. '*/10 * * * *'
+    - jitter: up to jitter seconds are added to every run, so jobs scheduled at the same time do not hit the sources
+      and Orion at once
+    - a run never overlaps the previous run of the same job, the runs missed meanwhile are skipped with a warning
+
+    Without interval and cron, the job runs every --timeout seconds of the harvester. On SIGTERM or SIGINT, the runs
+    in progress end and no new run starts.
+
+    The jobs share one aiohttp session (sources and Orion), one limiter of the parallel requests to Orion and one pool
+    of worker processes. Every run posts with its own OrionWriter, on the shared session and limiter, so its batches,
+    dead-letter file and summary stay apart. The limiter replaces the --limit-target of the harvesters.
+
+    A harvester can be hosted if it has a setup(argv, logger) function, which parses its arguments and sets its
+    globals, and an async harvest(session, limiter, executor) function, which runs one cycle. The weather forecast,
+    weather observed and weather station harvesters have them. The other harvesters are not hosted: the Madrid and
+    Santander air quality ones are servers (they answer requests, they do not run cycles), and the rest are blocking
+    scripts (urllib, one process per run), which go on running on their own.
+
+    Config (see scheduler.example.yml), the paths of the harvesters are relative to the config file:
+
+        limit_target: 50
+        limit_target_max: 200
+        workers: 4
+        jobs:
+          weather-forecast-portugal:
+            harvester: ../Weather/WeatherForecast/harvesters/portugal/portugal_weather_forecast.py
+            args: ['--orion', 'http://orion:1026', '--service', 'weather']
+            cron: '5 * * * *'
+            jitter: 60
+          weather-observed-portugal:
+            harvester: ../Weather/WeatherObserved/harvesters/portugal/portugal_weather_observed.py
+            args: ['--orion', 'http://orion:1026', '--service', 'weather', '--latest']
+            interval: 600
+            jitter: 30
+
+    Usage, from the specs folder:
+
+        python3 -m harvesters_common.scheduler harvesters_common/scheduler.example.yml
+
+    AsyncIO name convention:
+    async def name - entry point for asynchronous data processing/http requests and post processing
+    async def name_bounded - intermediate step to limit amount of parallel workers
+    async def name_one - worker process
+"""
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from argparse import ArgumentParser
+from asyncio import Event, TimeoutError as ToE, gather, get_event_loop, run, set_event_loop_policy, wait_for
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from importlib.util import module_from_spec, spec_from_file_location
+from multiprocessing import get_context
+from os import cpu_count
+from os.path import abspath, dirname, join
+from random import uniform
+from signal import SIGINT, SIGTERM, SIG_IGN, signal
+from sys import stdout
+from time import time
+from uvloop import EventLoopPolicy
+from yaml import safe_load as load
+import logging
+import sys
+
+from .adaptive_limiter import AdaptiveLimiter
+from .orion_writer import default_limit_target, default_limit_target_max
+
+cron_ranges = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+default_timeout = 60                   # seconds, timeout of one request to the sources and Orion
+
+log_levels = ['ERROR', 'INFO', 'DEBUG']
+logger = None
+
+
+class Cron(object):
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Cron expression must have 5 fields: {}'.format(expression))
+
+        self.minutes, self.hours, self.days, self.months, weekdays = [parse_field(field, *cron_ranges[i])
+                                                                      for i, field in enumerate(fields)]
+        # 0 and 7 are Sunday
+        self.weekdays = {day % 7 for day in weekdays}
+
+        # As in cron, if both the day and the weekday are restricted, a run happens when either matches
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def match_day(self, date):
+        day = date.day in self.days
+        weekday = (date.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    # First time after now (a naive local datetime) which matches the expression
+    def next_time(self, now):
+        date = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = date + timedelta(days=366 * 5)
+
+        while date < limit:
+            if date.month not in self.months:
+                date = (date.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.match_day(date):
+                date = date.replace(hour=0, minute=0) + timedelta(days=1)
+            elif date.hour not in self.hours:
+                date = date.replace(minute=0) + timedelta(hours=1)
+            elif date.minute not in self.minutes:
+                date += timedelta(minutes=1)
+            else:
+                return date
+
+        raise ValueError('Cron expression never matches')
+
+
+class Job(object):
+    def __init__(self, name, module, interval=None, cron=None, jitter=0):
+        self.name = name
+        self.module = module
+        self.interval = interval
+        self.cron = cron
+        self.jitter = jitter
+
+        self.runs = 0
+        self.skipped = 0
+
+    # Timestamp of the run after the one scheduled at previous, without jitter
+    def next_time(self, previous):
+        if self.cron is not None:
+            return self.cron.next_time(datetime.fromtimestamp(previous)).timestamp()
+
+        return previous + self.interval
+
+
+def load_harvester(name, file):
+    spec = spec_from_file_location('harvester_' + name.replace('-', '_'), file)
+    module = module_from_spec(spec)
+
+    # Registered, so the functions of the harvester can be pickled by name for the worker processes
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+
+    for function in ['harvest', 'setup']:
+        if not hasattr(module, function):
+            raise ValueError('Harvester {} can not be scheduled, it has no {} function'.format(file, function))
+
+    return module
+
+
+def load_jobs(file):
+    with open(file, 'r') as f:
+        config = load(f)
+
+    jobs = list()
+    for name, item in (config.get('jobs') or {}).items():
+        module = load_harvester(name, join(dirname(abspath(file)), item['harvester']))
+        module.setup([str(arg) for arg in item.get('args', [])], logging.getLogger(name))
+
+        cron = Cron(item['cron']) if 'cron' in item else None
+        interval = item.get('interval', getattr(module, 'timeout', -1))
+        if cron is None and (interval is None or interval <= 0):
+            raise ValueError('Job {} has no interval nor cron'.format(name))
+
+        jobs.append(Job(name, module, interval=interval, cron=cron, jitter=item.get('jitter', 0)))
+
+    return config, jobs
+
+
+def parse_field(field, low, high):
+    values = set()
+
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(value) for value in part.split('-')]
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError('Cron field out of range: {}'.format(field))
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+# Runs the job on its schedule until stop is set, jobs with an interval run at once the first time
+async def run_job(job, stop, session, limiter, executor):
+    scheduled = time() if job.cron is None else job.next_time(time())
+
+    while not stop.is_set():
+        delay = max(0, scheduled - time()) + uniform(0, job.jitter)
+        logger.debug('Job %s scheduled at %s', job.name, datetime.fromtimestamp(time() + delay).isoformat())
+
+        try:
+            await wait_for(stop.wait(), delay)
+            break
+        except ToE:
+            pass
+
+        logger.info('Job %s started', job.name)
+        try:
+            await job.module.harvest(session, limiter, executor)
+        except Exception:
+            logger.exception('Job %s failed', job.name)
+        job.runs += 1
+        logger.info('Job %s ended', job.name)
+
+        missed = 0
+        scheduled = job.next_time(scheduled)
+        while scheduled < time():
+            scheduled = job.next_time(scheduled)
+            missed += 1
+        if missed > 0:
+            job.skipped += missed
+            logger.warning('Job %s lasted longer than its schedule, %s runs skipped', job.name, missed)
+
+
+async def schedule(jobs, executor, limit_target, limit_target_max, timeout):
+    stop = Event()
+    for signal_number in [SIGINT, SIGTERM]:
+        get_event_loop().add_signal_handler(signal_number, stop.set)
+
+    limiter = AdaptiveLimiter(limit_target, max_limit=max(limit_target, limit_target_max))
+
+    async with ClientSession(connector=TCPConnector(limit=0), timeout=ClientTimeout(total=timeout)) as session:
+        await gather(*[run_job(job, stop, session, limiter, executor) for job in jobs])
+
+    for job in jobs:
+        logger.info('Job %s: %s runs, %s skipped', job.name, job.runs, job.skipped)
+
+
+def setup_logger(log_level):
+    local_logger = logging.getLogger()
+    local_logger.setLevel(logging.getLevelName(log_level))
+    handler = logging.StreamHandler(stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    local_logger.addHandler(handler)
+
+    return logging.getLogger('scheduler')
+
+
+# Signals stop the scheduler, which waits for the runs in progress, so the workers must not stop before it
+# (i.e. on Ctrl+C every process of the group gets SIGINT)
+def setup_worker():
+    for signal_number in [SIGINT, SIGTERM]:
+        signal(signal_number, SIG_IGN)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('config',
+                        help='YAML file with the jobs to be scheduled')
+    parser.add_argument('--log-level',
+                        action='store',
+                        default='INFO',
+                        dest='log_level',
+                        help='Set the logging output level. {0}'.format(log_levels),
+                        nargs='?')
+
+    args = parser.parse_args()
+
+    if args.log_level not in log_levels:
+        parser.error('Log level must be one of {0}'.format(log_levels))
+
+    logger = setup_logger(args.log_level)
+
+    config, jobs = load_jobs(args.config)
+    if len(jobs) == 0:
+        logger.error('No jobs to schedule')
+        exit(1)
+
+    logger.info('Started')
+    logger.info('Jobs: %s', ', '.join(job.name for job in jobs))
+
+    workers = int(config.get('workers') or cpu_count() or 1)
+
+    # Forked after the setup of the harvesters, so the workers have their globals (stations, latest), and before the
+    # event loop, which may start threads (i.e. to resolve names)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('fork'), initializer=setup_worker) as executor:
+        executor.submit(int).result()
+
+        set_event_loop_policy(EventLoopPolicy())
+        run(schedule(jobs, executor, int(config.get('limit_target', default_limit_target)),
+                     int(config.get('limit_target_max', default_limit_target_max)),
+                     int(config.get('timeout', default_timeout))))
+
+    logger.info('Ended')
+    exit(0)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Write-ahead spool on local disk of the records (i.e. the entities of a notification) to be forwarded to Orion.
+
+    - records are appended, as NDJSON lines, to the segment files of a folder (00000000000000000000.log, ...), a new
+      segment is started once the current one reaches segment_bytes
+    - append returns once the record is on disk (fsync). Records appended while a fsync is in progress wait for the
+      next one, so one fsync writes all the records waiting for it (group commit)
+    - the forwarder reads the records on disk from a position, and commits the position of the records forwarded. It
+      is stored in a checkpoint file, the segments before it are removed
+    - on start, reading goes on from the checkpoint, a record partially written by a crash is discarded
+    - a line which can not be decoded is logged, stored in the dead-letter file (if given) and skipped
+    - the records not committed yet are kept under max_bytes, append raises SpoolFull beyond it
+
+    The files are written and read in the default executor, so the event loop is not blocked by the disk.
+
+    Usage:
+
+        spool = Spool('spool')
+        await spool.open()
+
+        await spool.append(entities)
+
+        records, position = await spool.read(spool.checkpoint, 100)
+        ... # forward the records, (start, record) pairs
+        await spool.commit(position)
+
+        await spool.close()
+"""
+
+from asyncio import Event, TimeoutError as ToE, ensure_future, get_event_loop, wait_for
+from os import O_RDONLY, close, fsync, listdir, makedirs, open as open_fd, remove, replace
+from os.path import exists, getsize, join
+import logging
+
+from .dead_letter import DeadLetter
+
+try:
+    from yajl import dumps, loads
+except ImportError:
+    from json import dumps, loads
+
+default_max_bytes = 1000000000         # max size of the records not committed yet, 1 GB
+default_segment_bytes = 16000000       # size from which a new segment is started, 16 MB
+
+checkpoint_file = 'checkpoint'
+segment_suffix = '.log'
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class Spool(object):
+    def __init__(self, folder, segment_bytes=default_segment_bytes, max_bytes=default_max_bytes, dead_letter=None,
+                 logger=None):
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.logger = logger or logging.getLogger('root')
+        self.dead_letter = DeadLetter(dead_letter, self.logger) if isinstance(dead_letter, str) else dead_letter
+
+        # Positions of the lines which could not be decoded, reported once
+        self.corrupt = set()
+
+        # Positions are (segment, offset), the records before durable are on disk
+        self.checkpoint = (0, 0)
+        self.durable = (0, 0)
+        self.sizes = dict()
+
+        self.file = None
+        self.pending = list()
+        self.syncing = None
+        self.written = Event()
+
+        # Amount of records appended and of fsync calls with this instance
+        self.appended = 0
+        self.syncs = 0
+
+    # Returns once the record is on disk
+    async def append(self, record):
+        line = (dumps(record) + '\n').encode('utf-8')
+        if self.backlog() + len(line) > self.max_bytes:
+            raise SpoolFull('{} bytes are not forwarded yet'.format(self.backlog()))
+
+        future = get_event_loop().create_future()
+        self.pending.append((line, future))
+        if self.syncing is None:
+            self.syncing = ensure_future(self.sync())
+
+        await future
+
+    # Size of the records appended and not committed yet
+    def backlog(self):
+        stored = sum(size for segment, size in self.sizes.items() if segment >= self.checkpoint[0])
+        return stored - self.checkpoint[1] + sum(len(line) for line, _ in self.pending)
+
+    async def close(self):
+        while self.syncing is not None:
+            await self.syncing
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # Stores the position of the records forwarded, removes the segments before it
+    async def commit(self, position):
+        if position <= self.checkpoint:
+            return
+
+        segments = [segment for segment in self.sizes if segment < position[0]]
+        self.checkpoint = position
+        for segment in segments:
+            del self.sizes[segment]
+
+        await get_event_loop().run_in_executor(None, self.commit_one, position, segments)
+
+    def commit_one(self, position, segments):
+        path = join(self.folder, checkpoint_file)
+        with open(path + '.tmp', 'w') as f:
+            f.write(dumps({'segment': position[0], 'offset': position[1]}))
+            f.flush()
+            fsync(f.fileno())
+        replace(path + '.tmp', path)
+
+        for segment in segments:
+            remove(self.path(segment))
+        self.sync_folder()
+
+    async def open(self):
+        await get_event_loop().run_in_executor(None, self.open_one)
+
+        self.logger.info('Spool %s opened, %s bytes to be forwarded from %s', self.folder, self.backlog(),
+                         self.checkpoint)
+
+    def open_one(self):
+        makedirs(self.folder, exist_ok=True)
+
+        segments = sorted(int(name[:-len(segment_suffix)]) for name in listdir(self.folder)
+                          if name.endswith(segment_suffix))
+        for segment in segments:
+            self.sizes[segment] = getsize(self.path(segment))
+
+        path = join(self.folder, checkpoint_file)
+        if exists(path):
+            with open(path) as f:
+                item = loads(f.read())
+            self.checkpoint = (item['segment'], item['offset'])
+        elif segments:
+            self.checkpoint = (segments[0], 0)
+
+        # Only the last segment can hold a record partially written
+        current = max(segments[-1] if segments else 0, self.checkpoint[0])
+        self.sizes[current] = self.truncate(current)
+        self.file = open(self.path(current), 'ab')
+        self.sync_folder()
+
+        self.durable = (current, self.sizes[current])
+        self.checkpoint = min(self.checkpoint, self.durable)
+
+    def path(self, segment):
+        return join(self.folder, '{:020d}{}'.format(segment, segment_suffix))
+
+    # Reads up to limit records from position, only those on disk
+    # Returns the (position, record) pairs, and the position after the last line read
+    async def read(self, position, limit):
+        return await get_event_loop().run_in_executor(None, self.read_one, position, limit, self.durable,
+                                                      dict(self.sizes))
+
+    def read_one(self, position, limit, durable, sizes):
+        records = list()
+        segment, offset = position
+
+        while len(records) < limit and (segment, offset) < durable:
+            end = durable[1] if segment == durable[0] else sizes.get(segment, 0)
+            if offset >= end:
+                segment, offset = segment + 1, 0
+                continue
+
+            with open(self.path(segment), 'rb') as f:
+                f.seek(offset)
+                while len(records) < limit and offset < end:
+                    start = (segment, offset)
+                    line = f.readline()
+                    offset += len(line)
+                    try:
+                        record = loads(line.decode('utf-8'))
+                    except ValueError as e:
+                        self.skip(start, line, e)
+                        continue
+                    records.append((start, record))
+
+        return records, (segment, offset)
+
+    # A line which can not be decoded (i.e. a disk error) is skipped, so the records after it are still read
+    def skip(self, position, line, e):
+        if position in self.corrupt:
+            return
+        self.corrupt.add(position)
+
+        self.logger.error('Spool %s: record at %s skipped, it can not be decoded: %s', self.folder, position, e)
+        if self.dead_letter is not None:
+            self.dead_letter.write([line.decode('utf-8', 'replace').rstrip('\n')], 'corrupt spool record')
+
+    # Writes the records waiting, with one fsync, until none is waiting
+    async def sync(self):
+        try:
+            while self.pending:
+                pending = self.pending
+                self.pending = list()
+
+                segment, size = self.durable
+                try:
+                    size, rotated = await get_event_loop().run_in_executor(None, self.sync_one,
+                                                                           [line for line, _ in pending], size)
+                except OSError as e:
+                    self.logger.error('Spool %s could not be written: %s', self.folder, e)
+                    for _, future in pending:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                self.sizes[segment] = size
+                self.durable = (segment, size)
+                if rotated:
+                    self.sizes[segment + 1] = 0
+                    self.durable = (segment + 1, 0)
+
+                self.syncs += 1
+                self.appended += len(pending)
+                for _, future in pending:
+                    if not future.done():
+                        future.set_result(True)
+
+                # Wakes up the readers
+                self.written.set()
+                self.written = Event()
+        finally:
+            self.syncing = None
+
+    def sync_folder(self):
+        fd = open_fd(self.folder, O_RDONLY)
+        try:
+            fsync(fd)
+        finally:
+            close(fd)
+
+    # Returns the size of the segment and if a new one was started
+    def sync_one(self, lines, size):
+        try:
+            self.file.write(b''.join(lines))
+            self.file.flush()
+            fsync(self.file.fileno())
+        except OSError:
+            # The records are not acknowledged, they must not be read
+            self.file.truncate(size)
+            raise
+
+        size = self.file.tell()
+        if size < self.segment_bytes:
+            return size, False
+
+        self.file.close()
+        self.file = open(self.path(self.durable[0] + 1), 'ab')
+        self.sync_folder()
+
+        return size, True
+
+    # Removes a record partially written at the end of a segment, returns the size of the segment
+    def truncate(self, segment):
+        if self.sizes.get(segment, 0) == 0:
+            return 0
+
+        with open(self.path(segment), 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                self.logger.warning('Spool %s: %s bytes partially written discarded', self.folder, len(data) - end)
+                f.truncate(end)
+                f.flush()
+                fsync(f.fileno())
+
+        return end
+
+    # Waits until records are appended after position, up to timeout seconds
+    # Returns False if there are none
+    async def wait(self, position, timeout=None):
+        if position < self.durable:
+            return True
+
+        try:
+            await wait_for(self.written.wait(), timeout)
+        except ToE:
+            return False
+
+        return True
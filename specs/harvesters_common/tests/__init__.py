@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Unit tests of the code shared by the harvesters, from the specs folder:
+
+        python3 -m unittest discover -s harvesters_common/tests -t .
+"""
+
+import logging
+
+# Given to the code under test, so the errors it logs on purpose do not clutter the output
+logger = logging.getLogger('harvesters_common.tests')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from asyncio import ensure_future, run, sleep
+from unittest import TestCase
+
+from harvesters_common.adaptive_limiter import AdaptiveLimiter
+
+
+class TestAdaptiveLimiter(TestCase):
+    def test_grows_after_a_round_under_the_targets(self):
+        limiter = AdaptiveLimiter(4, max_limit=10, target_latency=1.0)
+
+        for _ in range(4):
+            limiter.update(0.1, True, False)
+        self.assertEqual(limiter.window, 5)
+
+        # The next round is as big as the new window
+        for _ in range(4):
+            limiter.update(0.1, True, False)
+        self.assertEqual(limiter.window, 5)
+        limiter.update(0.1, True, False)
+        self.assertEqual(limiter.window, 6)
+
+    def test_does_not_grow_when_slow_or_failing(self):
+        limiter = AdaptiveLimiter(4, max_limit=10, target_latency=1.0, target_error_rate=0.25)
+
+        for _ in range(4):
+            limiter.update(2.0, True, False)
+        self.assertEqual(limiter.window, 4)
+
+        for ok in [False, False, True, True]:
+            limiter.update(0.1, ok, False)
+        self.assertEqual(limiter.window, 4)
+
+    def test_overload_decreases_once_for_the_requests_in_flight(self):
+        limiter = AdaptiveLimiter(16, max_limit=16)
+        limiter.in_flight = 4
+
+        limiter.update(0.1, False, True)
+        self.assertEqual(limiter.window, 8)
+
+        # The requests which were in flight fail too, the window is not halved again
+        for _ in range(4):
+            limiter.update(0.1, False, True)
+        self.assertEqual(limiter.window, 8)
+
+        limiter.update(0.1, False, True)
+        self.assertEqual(limiter.window, 4)
+
+    def test_bounds(self):
+        limiter = AdaptiveLimiter(2, min_limit=2, max_limit=3)
+
+        limiter.update(0.1, False, True)
+        self.assertEqual(limiter.window, 2)
+
+        for _ in range(10):
+            limiter.update(0.1, True, False)
+        self.assertEqual(limiter.window, 3)
+        self.assertEqual((limiter.min_window, limiter.max_window), (2, 3))
+
+    def test_acquire_waits_for_a_slot(self):
+        async def acquire():
+            limiter = AdaptiveLimiter(2, max_limit=2)
+            await limiter.acquire()
+            await limiter.acquire()
+
+            waiting = ensure_future(limiter.acquire())
+            await sleep(0.01)
+            self.assertFalse(waiting.done())
+
+            await limiter.release(0.1, True, False)
+            await waiting
+            self.assertEqual(limiter.in_flight, 2)
+
+        run(acquire())
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from harvesters_common.change_cache import ChangeCache
+
+
+def entity(identifier, value, timestamp='2019-01-01T00:00:00'):
+    return {'id': identifier, 'type': 'T',
+            'value': {'value': value, 'metadata': {'timestamp': {'value': timestamp}}}}
+
+
+class TestChangeCache(TestCase):
+    def setUp(self):
+        self.folder = TemporaryDirectory()
+        self.file = join(self.folder.name, 'changes.db')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def post(self, cache, entities):
+        entities, keys = cache.changed(entities)
+        cache.store(keys)
+        cache.commit()
+
+        return [item['id'] for item in entities]
+
+    def test_only_new_and_changed(self):
+        cache = ChangeCache(self.file)
+
+        self.assertEqual(self.post(cache, [entity('a', 1), entity('b', 1)]), ['a', 'b'])
+        self.assertEqual(self.post(cache, [entity('a', 1), entity('b', 2), entity('c', 1)]), ['b', 'c'])
+        cache.close()
+
+        # Kept between runs
+        cache = ChangeCache(self.file)
+        self.assertEqual(self.post(cache, [entity('a', 1), entity('b', 2), entity('c', 1)]), [])
+        cache.close()
+
+    def test_not_stored_is_posted_again(self):
+        cache = ChangeCache(self.file)
+
+        cache.changed([entity('a', 1)])
+        self.assertEqual(self.post(cache, [entity('a', 1)]), ['a'])
+        cache.close()
+
+    def test_ignore(self):
+        cache = ChangeCache(self.file)
+        self.post(cache, [entity('a', 1)])
+        self.assertEqual(self.post(cache, [entity('a', 1, '2019-01-01T01:00:00')]), ['a'])
+        cache.close()
+
+        cache = ChangeCache(self.file, ignore=['metadata'])
+        self.post(cache, [entity('a', 1)])
+        self.assertEqual(self.post(cache, [entity('a', 1, '2019-01-01T02:00:00')]), [])
+        cache.close()
+
+    def test_max_age(self):
+        cache = ChangeCache(self.file, max_age=3600)
+
+        with patch('harvesters_common.change_cache.time', return_value=1000000.0):
+            self.post(cache, [entity('a', 1)])
+        with patch('harvesters_common.change_cache.time', return_value=1000000.0 + 3599):
+            self.assertEqual(self.post(cache, [entity('a', 1)]), [])
+        with patch('harvesters_common.change_cache.time', return_value=1000000.0 + 3601):
+            self.assertEqual(self.post(cache, [entity('a', 1)]), ['a'])
+        cache.close()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from asyncio import run
+from json import dumps, loads
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from harvesters_common.dead_letter import DeadLetter, read_entities
+from harvesters_common.orion_writer import OrionWriter
+from harvesters_common.replay import replay
+
+from . import logger
+
+
+def batch(*identifiers):
+    return [dumps({'id': identifier, 'type': 'T'}) for identifier in identifiers]
+
+
+# Rejects the entities whose id is in rejected, answers 204 otherwise
+class FakeOrion(object):
+    def __init__(self, rejected=()):
+        self.rejected = set(rejected)
+        self.posted = list()
+
+    async def send(self, payload):
+        identifiers = [item['id'] for item in loads(payload.decode('utf-8'))['entities']]
+        if self.rejected.intersection(identifiers):
+            return 400, 'response code 400'
+
+        self.posted.extend(identifiers)
+        return 204, True
+
+
+class TestDeadLetter(TestCase):
+    def setUp(self):
+        self.folder = TemporaryDirectory()
+        self.file = join(self.folder.name, 'dead_letter.ndjson')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def ids(self, file):
+        return [item['id'] for item in read_entities(file)]
+
+    def test_write_and_take(self):
+        dead_letter = DeadLetter(self.file, logger)
+        self.assertIsNone(dead_letter.take())
+
+        dead_letter.write(batch('a', 'b'), 'response code 400')
+        dead_letter.write(batch('c'), 'timeout problem')
+        self.assertEqual(dead_letter.count, 3)
+
+        taken = dead_letter.take()
+        self.assertFalse(exists(self.file))
+        self.assertEqual(self.ids(taken), ['a', 'b', 'c'])
+
+    def test_take_keeps_a_replay_not_ended(self):
+        dead_letter = DeadLetter(self.file, logger)
+        dead_letter.write(batch('a'), 'response code 400')
+        dead_letter.take()
+
+        dead_letter.write(batch('b'), 'response code 400')
+        self.assertEqual(self.ids(dead_letter.take()), ['a', 'b'])
+
+    def replay(self, orion):
+        with patch.object(OrionWriter, 'send', orion.send):
+            return run(replay(self.file, 'http://orion', limit_entities=1, logger=logger))
+
+    def test_replay(self):
+        DeadLetter(self.file, logger).write(batch('a', 'b', 'c'), 'response code 503')
+
+        orion = FakeOrion(rejected=['b'])
+        self.assertEqual(self.replay(orion), (2, 1))
+        self.assertEqual(sorted(orion.posted), ['a', 'c'])
+
+        # The entity failed again is in a new dead-letter file, the replayed one is removed
+        self.assertEqual(self.ids(self.file), ['b'])
+        self.assertFalse(exists(self.file + '.replay'))
+
+        orion = FakeOrion()
+        self.assertEqual(self.replay(orion), (1, 0))
+        self.assertEqual(orion.posted, ['b'])
+        self.assertFalse(exists(self.file))
+
+    def test_replay_nothing(self):
+        self.assertEqual(self.replay(FakeOrion()), (0, 0))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from harvesters_common.http_cache import HttpCache
+
+url = 'http://source/data'
+
+
+class TestHttpCache(TestCase):
+    def setUp(self):
+        self.folder = TemporaryDirectory()
+        self.file = join(self.folder.name, 'http_cache.db')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_commit(self):
+        cache = HttpCache(self.file)
+
+        self.assertEqual(cache.headers(url, {'Accept': 'application/json'}), {'Accept': 'application/json'})
+        self.assertEqual(cache.store(url, 200, {'ETag': '"1"', 'Last-Modified': 'Tue, 01 Jan 2019 00:00:00 GMT'},
+                                     '[1]'), b'[1]')
+
+        # Not stored until the data is posted
+        self.assertEqual(cache.headers(url), {})
+        cache.end(True)
+        cache.close()
+
+        cache = HttpCache(self.file)
+        self.assertEqual(cache.headers(url), {'If-None-Match': '"1"',
+                                              'If-Modified-Since': 'Tue, 01 Jan 2019 00:00:00 GMT'})
+        self.assertEqual(cache.store(url, 304, {}, b''), b'[1]')
+        self.assertEqual((cache.hits, cache.stored), (1, 0))
+        cache.close()
+
+    def test_discard(self):
+        cache = HttpCache(self.file)
+        cache.store(url, 200, {'ETag': '"1"'}, b'[1]')
+        cache.end(True)
+
+        # A new response which is not posted replaces the stored one, so the next request gets it in full
+        cache.store(url, 200, {'ETag': '"2"'}, b'[2]')
+        cache.end(False)
+        self.assertEqual(cache.headers(url), {})
+        self.assertIsNone(cache.body(url))
+        cache.close()
+
+    def test_without_validators(self):
+        cache = HttpCache(self.file)
+        cache.store(url, 200, {}, b'[1]')
+        cache.commit()
+
+        self.assertEqual(cache.headers(url), {})
+        self.assertEqual(cache.stored, 0)
+        cache.close()
+
+    def test_max_bytes(self):
+        cache = HttpCache(self.file, max_bytes=10)
+
+        cache.store(url + '/1', 200, {'ETag': '"1"'}, b'x' * 6)
+        cache.commit()
+        cache.store(url + '/2', 200, {'ETag': '"2"'}, b'x' * 6)
+        cache.commit()
+        cache.store(url + '/3', 200, {'ETag': '"3"'}, b'x' * 11)
+        cache.commit()
+
+        # The least recently used response is evicted, a response bigger than max_bytes is not stored
+        self.assertIsNone(cache.body(url + '/1'))
+        self.assertEqual(cache.body(url + '/2'), b'x' * 6)
+        self.assertIsNone(cache.body(url + '/3'))
+        cache.close()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+from asyncio import run
+from json import loads
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from harvesters_common.change_cache import ChangeCache
+from harvesters_common.orion_writer import Batcher, OrionWriter, dumps, split_batches
+
+from . import logger
+
+
+def entities(amount, size=0):
+    return [{'id': str(i), 'type': 'T', 'name': {'value': 'x' * size}} for i in range(amount)]
+
+
+# Answers the requests with the statuses given, in order, then with 204
+class FakeOrion(object):
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = list()
+
+    async def send(self, payload):
+        self.requests.append([item['id'] for item in loads(payload.decode('utf-8'))['entities']])
+        status = self.statuses.pop(0) if self.statuses else 204
+
+        if status is None:
+            return None, 'timeout problem'
+        if status >= 300:
+            return status, 'response code ' + str(status)
+        return status, True
+
+
+# Collects the failed batches instead of a dead-letter file
+class Failures(object):
+    def __init__(self):
+        self.batches = list()
+
+    def write(self, batch, reason):
+        self.batches.append(([loads(item)['id'] for item in batch], reason))
+
+
+class TestBatcher(TestCase):
+    def test_limit_entities(self):
+        batches = split_batches(entities(7), 3, 1000000)
+
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        self.assertEqual([loads(item)['id'] for batch in batches for item in batch], [str(i) for i in range(7)])
+
+    def test_limit_bytes(self):
+        items = entities(5, size=100)
+        size = len(dumps(items[0]))
+
+        # Two entities and the comma between them fit, a third one does not
+        batches = split_batches(items, 50, 2 * size + 1)
+
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        for batch in batches:
+            self.assertLessEqual(len(','.join(batch)), 2 * size + 1)
+
+    def test_entity_bigger_than_limit_bytes_goes_alone(self):
+        items = entities(1) + entities(1, size=1000) + entities(1)
+
+        batches = split_batches(items, 50, 500)
+
+        self.assertEqual([len(batch) for batch in batches], [1, 1, 1])
+
+    def test_bytes_of_non_ascii_entities(self):
+        items = [{'id': str(i), 'type': 'T', 'name': {'value': 'ñ' * 100}} for i in range(2)]
+        size = len(dumps(items[0]).encode('utf-8'))
+
+        batcher = Batcher(50, size + 1)
+        self.assertIsNone(batcher.add(items[0]))
+        self.assertEqual(len(batcher.add(items[1])), 1)
+
+    def test_flush(self):
+        batcher = Batcher(2, 1000000)
+
+        self.assertIsNone(batcher.flush())
+        batcher.add(entities(1)[0])
+        self.assertEqual(len(batcher.flush()), 1)
+        self.assertIsNone(batcher.flush())
+
+
+class TestOrionWriter(TestCase):
+    def post(self, orion, items, **kwargs):
+        async def post():
+            with patch.object(OrionWriter, 'send', orion.send), \
+                    patch('harvesters_common.orion_writer.sleep', self.sleep):
+                async with OrionWriter('http://orion', logger=logger, **kwargs) as writer:
+                    result = await writer.post(items)
+            return writer, result
+
+        return run(post())
+
+    def setUp(self):
+        self.delays = list()
+
+    async def sleep(self, delay):
+        self.delays.append(delay)
+
+    def test_batches(self):
+        orion = FakeOrion()
+
+        writer, result = self.post(orion, entities(120), limit_entities=50)
+
+        self.assertTrue(result)
+        self.assertEqual(writer.posted, 120)
+        self.assertEqual(sorted(len(ids) for ids in orion.requests), [20, 50, 50])
+
+    def test_retry_with_backoff(self):
+        orion = FakeOrion([503, None])
+
+        writer, result = self.post(orion, entities(10), backoff=1.0, retries=3)
+
+        self.assertTrue(result)
+        self.assertEqual(writer.posted, 10)
+        self.assertEqual(len(orion.requests), 3)
+        self.assertEqual([item['attempt'] for item in writer.metrics], [0, 1, 2])
+
+        # Jittered exponential backoff, 1 then 2 seconds, +-50%
+        self.assertEqual(len(self.delays), 2)
+        self.assertTrue(0.5 <= self.delays[0] <= 1.5)
+        self.assertTrue(1.0 <= self.delays[1] <= 3.0)
+
+    def test_out_of_retries(self):
+        orion = FakeOrion([503] * 3)
+        failures = Failures()
+
+        writer, result = self.post(orion, entities(10), retries=2, dead_letter=failures)
+
+        self.assertFalse(result)
+        self.assertEqual((writer.posted, writer.failed), (0, 10))
+        self.assertEqual(len(orion.requests), 3)
+        self.assertEqual(failures.batches, [([str(i) for i in range(10)], 'response code 503')])
+
+    def test_rejected_batch_is_not_retried(self):
+        orion = FakeOrion([400])
+        failures = Failures()
+
+        writer, result = self.post(orion, entities(4), limit_entities=2, dead_letter=failures)
+
+        self.assertFalse(result)
+        self.assertEqual((writer.posted, writer.failed), (2, 2))
+        self.assertEqual(len(orion.requests), 2)
+        self.assertEqual(self.delays, [])
+        self.assertEqual(failures.batches, [(orion.requests[0], 'response code 400')])
+
+    def test_change_cache(self):
+        with TemporaryDirectory() as folder:
+            cache = ChangeCache(join(folder, 'changes.db'))
+
+            # The entities of the batch rejected are posted again next time
+            orion = FakeOrion([400])
+            writer, _ = self.post(orion, entities(4), limit_entities=2, change_cache=cache)
+            rejected = orion.requests[0]
+
+            orion = FakeOrion()
+            writer, _ = self.post(orion, entities(4), limit_entities=2, change_cache=cache)
+            self.assertEqual(orion.requests, [rejected])
+            self.assertEqual(writer.skipped, 2)
+
+            cache.close()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from asyncio import Event, ensure_future, run, sleep
+from datetime import datetime
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from harvesters_common import scheduler
+from harvesters_common.scheduler import Cron, Job, load_harvester, parse_field, run_job
+
+from . import logger
+
+
+# Harvester which takes duration seconds per run, and records if two runs overlap
+class Harvester(object):
+    def __init__(self, duration):
+        self.duration = duration
+        self.running = 0
+        self.overlapped = False
+        self.runs = 0
+
+    async def harvest(self, session, limiter, executor):
+        self.running += 1
+        self.overlapped = self.overlapped or self.running > 1
+        await sleep(self.duration)
+        self.running -= 1
+        self.runs += 1
+
+
+class TestCron(TestCase):
+    def test_parse_field(self):
+        self.assertEqual(parse_field('*/15', 0, 59), {0, 15, 30, 45})
+        self.assertEqual(parse_field('1,3-5', 0, 59), {1, 3, 4, 5})
+        self.assertEqual(parse_field('10/20', 0, 59), {10, 30, 50})
+
+        for field in ['60', '5-1', '*/0']:
+            with self.assertRaises(ValueError):
+                parse_field(field, 0, 59)
+
+    def test_next_time(self):
+        cron = Cron('5 */3 * * *')
+
+        self.assertEqual(cron.next_time(datetime(2019, 1, 1, 0, 5)), datetime(2019, 1, 1, 3, 5))
+        self.assertEqual(cron.next_time(datetime(2019, 1, 1, 23, 30)), datetime(2019, 1, 2, 0, 5))
+
+    def test_day_or_weekday(self):
+        # As in cron, the 1st of the month or any Monday
+        cron = Cron('0 0 1 * 1')
+
+        self.assertEqual(cron.next_time(datetime(2019, 1, 1, 12, 0)), datetime(2019, 1, 7))
+        self.assertEqual(cron.next_time(datetime(2019, 1, 28, 12, 0)), datetime(2019, 2, 1))
+
+    def test_sunday(self):
+        self.assertEqual(Cron('0 0 * * 7').next_time(datetime(2019, 1, 1)), datetime(2019, 1, 6))
+
+    def test_invalid(self):
+        for expression in ['* * * *', '0 0 31 2 *']:
+            with self.assertRaises(ValueError):
+                Cron(expression).next_time(datetime(2019, 1, 1))
+
+
+class TestScheduler(TestCase):
+    def setUp(self):
+        patcher = patch.object(scheduler, 'logger', logger)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_job(self, job, seconds):
+        async def test():
+            stop = Event()
+            task = ensure_future(run_job(job, stop, None, None, None))
+            await sleep(seconds)
+            stop.set()
+            await task
+
+        run(test())
+
+    def test_interval(self):
+        # Runs at 0, 0.1, 0.2, 0.3 and 0.4 seconds
+        job = Job('job', Harvester(0), interval=0.1)
+
+        self.run_job(job, 0.45)
+
+        self.assertEqual(job.module.runs, 5)
+        self.assertEqual(job.skipped, 0)
+        self.assertEqual(job.next_time(100), 100.1)
+
+    def test_runs_do_not_overlap(self):
+        # Every run lasts 2 intervals and a half, the runs at 0.1 and 0.2 seconds are skipped, then the ones at 0.4
+        # and 0.5 seconds
+        job = Job('job', Harvester(0.25), interval=0.1)
+
+        self.run_job(job, 0.4)
+
+        self.assertFalse(job.module.overlapped)
+        self.assertEqual(job.runs, 2)
+        self.assertEqual(job.skipped, 4)
+
+    def test_stop_waits_for_the_run_in_progress(self):
+        job = Job('job', Harvester(0.2), interval=10)
+
+        self.run_job(job, 0.1)
+
+        self.assertEqual(job.module.runs, 1)
+
+    def test_harvester_without_entry_points(self):
+        with TemporaryDirectory() as folder:
+            file = join(folder, 'harvester.py')
+            with open(file, 'w') as f:
+                f.write('def setup(argv=None, local_logger=None):\n    pass\n')
+
+            with self.assertRaises(ValueError):
+                load_harvester('harvester', file)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from asyncio import run
+from os import listdir
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from harvesters_common.spool import Spool, SpoolFull, dumps
+
+from . import logger
+
+
+class TestSpool(TestCase):
+    def setUp(self):
+        self.folder = TemporaryDirectory()
+        self.path = join(self.folder.name, 'spool')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def spool(self, **kwargs):
+        return Spool(self.path, logger=logger, **kwargs)
+
+    def test_append_read_commit(self):
+        async def test():
+            spool = self.spool()
+            await spool.open()
+            for i in range(5):
+                await spool.append([i])
+
+            records, position = await spool.read(spool.checkpoint, 3)
+            self.assertEqual([record for _, record in records], [[0], [1], [2]])
+            await spool.commit(position)
+
+            records, position = await spool.read(spool.checkpoint, 10)
+            self.assertEqual([record for _, record in records], [[3], [4]])
+            self.assertGreater(spool.backlog(), 0)
+            await spool.commit(position)
+            self.assertEqual(spool.backlog(), 0)
+
+            await spool.close()
+
+        run(test())
+
+    def test_recovery_after_a_restart(self):
+        async def write():
+            spool = self.spool(segment_bytes=20)
+            await spool.open()
+            for i in range(6):
+                await spool.append(['entity', i])
+
+            records, _ = await spool.read(spool.checkpoint, 2)
+            await spool.commit(records[-1][0])
+            await spool.close()
+
+        async def read():
+            spool = self.spool(segment_bytes=20)
+            await spool.open()
+            records, position = await spool.read(spool.checkpoint, 10)
+            await spool.commit(position)
+            await spool.close()
+
+            return [record[1] for _, record in records]
+
+        run(write())
+
+        # The record partially written by a crash is discarded
+        segments = sorted(name for name in listdir(self.path) if name.endswith('.log'))
+        with open(join(self.path, segments[-1]), 'a') as f:
+            f.write('["entity", ')
+
+        # The records not committed are read again, the segments committed are removed
+        self.assertEqual(run(read()), [1, 2, 3, 4, 5])
+        self.assertEqual(run(read()), [])
+        self.assertEqual(len([name for name in listdir(self.path) if name.endswith('.log')]), 1)
+
+    def test_corrupt_record_is_skipped(self):
+        dead_letter = join(self.folder.name, 'dead_letter.ndjson')
+
+        async def test():
+            spool = self.spool(dead_letter=dead_letter)
+            await spool.open()
+            await spool.append([1])
+            spool.file.write(b'{not json\n')
+            await spool.append([2])
+
+            records, _ = await spool.read(spool.checkpoint, 10)
+            self.assertEqual([record for _, record in records], [[1], [2]])
+
+            # Reported once, even if read again
+            await spool.read(spool.checkpoint, 10)
+            await spool.close()
+
+        run(test())
+
+        with open(dead_letter) as f:
+            self.assertEqual(f.read(), '{not json\n')
+
+    def test_full(self):
+        async def test():
+            # Room for one record, not two
+            spool = self.spool(max_bytes=2 * len(dumps([1, 2, 3]) + '\n') - 1)
+            await spool.open()
+            await spool.append([1, 2, 3])
+            with self.assertRaises(SpoolFull):
+                await spool.append([1, 2, 3])
+
+            _, position = await spool.read(spool.checkpoint, 10)
+            await spool.commit(position)
+            await spool.append([1, 2, 3])
+            await spool.close()
+
+        run(test())
+
+    def test_read_only_what_is_durable(self):
+        async def test():
+            spool = self.spool()
+            await spool.open()
+            self.assertFalse(await spool.wait(spool.checkpoint, 0.01))
+
+            await spool.append([1])
+            self.assertTrue(await spool.wait(spool.checkpoint, 0.01))
+            await spool.close()
+
+        run(test())
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from asyncio import run
+from unittest import TestCase
+from unittest.mock import patch
+
+from harvesters_common.token_bucket import TokenBucket
+
+
+# Time which only goes on while the bucket sleeps
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.delays = list()
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.delays.append(delay)
+        self.now += delay
+
+
+class TestTokenBucket(TestCase):
+    def acquire(self, bucket, clock, amount):
+        async def acquire():
+            for _ in range(amount):
+                await bucket.acquire()
+
+        with patch('harvesters_common.token_bucket.monotonic', clock.monotonic), \
+                patch('harvesters_common.token_bucket.sleep', clock.sleep):
+            run(acquire())
+
+    def test_capacity_is_not_delayed(self):
+        clock = Clock()
+        with patch('harvesters_common.token_bucket.monotonic', clock.monotonic):
+            bucket = TokenBucket(rate=1, capacity=5)
+
+        self.acquire(bucket, clock, 5)
+
+        self.assertEqual(clock.delays, [])
+        self.assertEqual(bucket.delayed, 0)
+
+    def test_rate(self):
+        clock = Clock()
+        with patch('harvesters_common.token_bucket.monotonic', clock.monotonic):
+            bucket = TokenBucket(rate=2, capacity=2)
+
+        self.acquire(bucket, clock, 6)
+
+        # 2 tokens at once, then 1 every half second
+        self.assertEqual(clock.delays, [0.5] * 4)
+        self.assertEqual(bucket.delayed, 4)
+        self.assertAlmostEqual(bucket.waited, 2.0)
+
+    def test_refill_up_to_capacity(self):
+        clock = Clock()
+        with patch('harvesters_common.token_bucket.monotonic', clock.monotonic):
+            bucket = TokenBucket(rate=1, capacity=3)
+
+        self.acquire(bucket, clock, 3)
+        clock.now += 60
+
+        self.acquire(bucket, clock, 4)
+
+        self.assertEqual(clock.delays, [1.0])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Token bucket to keep the requests to a source under its quota, i.e. AEMET Open Data allows a limited amount of
+    requests per minute with one API key.
+
+    - the bucket holds up to capacity tokens, it starts full, so the first capacity requests are not delayed
+    - it is refilled with rate tokens per second
+    - every request takes one token, waiting for it if the bucket is empty. Waiting requests are served in order
+
+    Usage:
+
+        bucket = TokenBucket(rate=149 / 60, capacity=149)
+
+        await bucket.acquire()
+        ... # the request
+"""
+
+from asyncio import Lock, sleep
+from time import monotonic
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(max(1, rate) if capacity is None else capacity)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+
+        # Created on first use, so it belongs to the running loop
+        self.lock = None
+
+        # Amount of requests delayed, and seconds spent waiting for a token
+        self.delayed = 0
+        self.waited = 0.0
+
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = Lock()
+
+        # The lock is fair, requests get their tokens in order
+        async with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                self.delayed += 1
+                self.waited += delay
+                await sleep(delay)
+                self.refill()
+            self.tokens -= 1
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def summary(self):
+        return '{} requests delayed by the rate limit, {:.1f}s in total'.format(self.delayed, self.waited)
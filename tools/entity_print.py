@@ -10,60 +10,47 @@ Author: José Manuel Cantera
 """
 
 import json
-from copy import deepcopy
 
-# Prints the JSON string but with the proper member order
+# Members which go first, in this order. '@context' always goes last
+leading_members = ('id', 'type', 'modifiedAt', 'createdAt')
 
 
-def print_json_string(entity):
-    entity_only_id = {
+# Returns a dictionary with the members of the entity in the proper order
+# Only the top level is rebuilt, attribute values are shared with the entity
+def ordered_entity(entity):
+    out = {
         'id': entity['id'],
+        'type': entity['type']
     }
 
-    out = json.dumps(entity_only_id, indent=4)[:-2]
-
-    entity_only_type = {
-        'type': entity['type'],
-    }
+    for member in leading_members[2:]:
+        if member in entity:
+            out[member] = entity[member]
 
-    # with -2 it is removed the new line char as well
-    out += "," + json.dumps(entity_only_type, indent=4)[1:-2]
+    for member in entity:
+        if member not in leading_members and member != '@context':
+            out[member] = entity[member]
 
-    entity_cloned = deepcopy(entity)
-
-    if 'modifiedAt' in entity:
-        entity_only_modified_at = {
-            'modifiedAt': entity['modifiedAt'],
-        }
-        out += "," + json.dumps(entity_only_modified_at, indent=4)[1:-2]
-
-        del entity_cloned['modifiedAt']
+    if '@context' in entity:
+        out['@context'] = entity['@context']
 
-    if 'createdAt' in entity:
-        entity_only_created_at = {
-            'createdAt': entity['createdAt'],
-        }
-        out += "," + json.dumps(entity_only_created_at, indent=4)[1:-2]
+    return out
 
-        del entity_cloned['createdAt']
 
-    del entity_cloned['id']
-    del entity_cloned['type']
+# Prints the JSON string but with the proper member order
+def print_json_string(entity):
+    return json.dumps(ordered_entity(entity), indent=4)
 
-    if '@context' in entity_cloned:
-        del entity_cloned['@context']
 
-    # Now the rest of the entity without the '@context
-    out += "," + json.dumps(entity_cloned, indent=4)[1:-2]
+# Same as print_json_string but without any whitespace (i.e. for NDJSON)
+def print_json_compact(entity):
+    return json.dumps(ordered_entity(entity), separators=(',', ':'))
 
-    # Last go the '@context'
-    if '@context' in entity:
-        only_ld_context = {
-            '@context': entity['@context']
-        }
 
-        out += "," + json.dumps(only_ld_context, indent=4)[1:]
+# Writes the JSON representation of the entity to a file object,
+# chunk by chunk, without building the whole string in memory
+def write_json_stream(entity, stream, compact=False):
+    if compact:
+        json.dump(ordered_entity(entity), stream, separators=(',', ':'))
     else:
-        out += "\n}"
-
-    return out
+        json.dump(ordered_entity(entity), stream, indent=4)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+
+Reads and writes streams of NGSI Entities so that big exports can be
+converted without loading them in memory.
+
+The input can be NDJSON (one Entity per line) or a JSON array of Entities.
+The output is always NDJSON.
+
+Copyright (c) 2019 FIWARE Foundation e.V.
+
+"""
+
+import sys
+import json
+import time
+
+from entity_print import print_json_compact
+
+# Size of the chunks read when parsing a JSON array
+CHUNK_SIZE = 64 * 1024
+
+# Errors raised by a record which cannot be decoded or converted. The record
+# is reported and skipped, in sequential and in parallel mode
+CONVERSION_ERRORS = (ValueError, KeyError, TypeError, AttributeError)
+
+_decoder = json.JSONDecoder()
+
+
+def open_input(infile):
+    if infile == '-':
+        return sys.stdin
+
+    return open(infile)
+
+
+def open_output(outfile):
+    if outfile == '-':
+        return sys.stdout
+
+    return open(outfile, 'w')
+
+
+# Yields the Entities contained in a stream
+# on_error(position, exception) is called for every record that cannot be
+# decoded. In NDJSON mode the record is skipped and reading goes on
+def read_entities(stream, on_error=None):
+    for position, record in read_records(stream):
+        if not isinstance(record, str):
+            yield record
+            continue
+
+        try:
+            yield json.loads(record)
+        except ValueError as e:
+            if on_error is None:
+                raise
+            on_error(position, e)
+
+
+# Yields (position, record) tuples. position counts from 1: the line
+# number in NDJSON, the number of the element in a JSON array. NDJSON
+# records are yielded as the raw line, so that decoding can be done by
+# the consumer. JSON array elements are yielded already decoded
+def read_records(stream):
+    first = _first_char(stream)
+
+    if first == '':
+        return
+
+    if first == '[':
+        position = 1
+        for entity in _read_array(stream):
+            yield position, entity
+            position += 1
+    else:
+        for record in _read_lines(stream, first):
+            yield record
+
+
+# Reads until the first non blank character and returns it
+def _first_char(stream):
+    while True:
+        c = stream.read(1)
+        if c == '' or not c.isspace():
+            return c
+
+
+def _read_lines(stream, first):
+    line_number = 1
+    line = first + stream.readline()
+
+    while line != '':
+        if line.strip() != '':
+            yield line_number, line
+
+        line_number += 1
+        line = stream.readline()
+
+
+# Incremental parsing of a JSON array. Only the current element and
+# one chunk are kept in memory
+def _read_array(stream):
+    buf = ''
+    pos = 0
+    eof = False
+    expect_value = True
+
+    while True:
+        # Skipping blanks and separators
+        while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ','):
+            if buf[pos] == ',':
+                expect_value = True
+            pos += 1
+
+        if pos < len(buf) and buf[pos] == ']':
+            return
+
+        if pos < len(buf) and expect_value:
+            try:
+                entity, end = _decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                yield entity
+                pos = end
+                expect_value = False
+                continue
+        elif pos < len(buf):
+            raise ValueError('Expecting "," or "]" at position {}'.format(pos))
+
+        if eof:
+            raise ValueError('Unterminated JSON array')
+
+        chunk = stream.read(CHUNK_SIZE)
+        if chunk == '':
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+# Decodes (if needed), converts and serializes one record of read_records
+def convert_record(convert, record):
+    if isinstance(record, str):
+        record = json.loads(record)
+
+    return print_json_compact(convert(record)) + "\n"
+
+
+# Converts a stream of Entities (NDJSON or JSON array) into NDJSON
+# using the function convert on each Entity
+def convert_stream(instream, outstream, convert):
+    stats = BatchStats()
+
+    for position, record in read_records(instream):
+        try:
+            line = convert_record(convert, record)
+        except CONVERSION_ERRORS as e:
+            stats.error(position, repr(e))
+            continue
+
+        outstream.write(line)
+        stats.entities += 1
+
+    return stats
+
+
+# Runs a batch conversion as requested by the command line arguments
+# (input, output, workers, unordered)
+# initializer(*initargs) is run once by every worker process
+def run_batch(args, convert, initializer=None, initargs=()):
+    # Imported here as it is only needed for batch mode
+    from parallel_convert import convert_parallel, default_workers
+
+    workers = args.workers or default_workers()
+    instream = open_input(args.input)
+    outstream = open_output(args.output)
+
+    try:
+        if workers == 1:
+            stats = convert_stream(instream, outstream, convert)
+        else:
+            stats = convert_parallel(instream, outstream, convert, workers=workers,
+                                     ordered=not args.unordered, initializer=initializer, initargs=initargs)
+    finally:
+        if instream is not sys.stdin:
+            instream.close()
+        if outstream is not sys.stdout:
+            outstream.close()
+
+    sys.stderr.write(stats.report() + "\n")
+
+
+def add_batch_arguments(parser):
+    parser.add_argument('--batch', action='store_true', required=True,
+                        help='Convert a stream of Entities (NDJSON or JSON array) into NDJSON')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--unordered', action='store_true',
+                        help='Write results as soon as they are ready, not in input order')
+    parser.add_argument('input', help='Input file, - for stdin')
+    parser.add_argument('output', help='Output file, - for stdout')
+
+
+# Keeps track of the progress of a batch conversion
+class BatchStats(object):
+    def __init__(self):
+        self.entities = 0
+        self.errors = 0
+        self.started = time.time()
+
+    # position of the record, as yielded by read_records
+    def error(self, position, exception):
+        self.errors += 1
+        sys.stderr.write('Error at {}: {}\n'.format(position, exception))
+
+    def report(self):
+        elapsed = time.time() - self.started
+        rate = self.entities / elapsed if elapsed > 0 else 0.0
+
+        return '{} entities converted in {:.2f}s ({:.1f} entities/sec), {} errors'.format(
+            self.entities, elapsed, rate, self.errors)
@@ -11,15 +11,54 @@ Author: José Manuel Cantera
 
 """
 
+import os
+import re
 import sys
 import json
+from argparse import ArgumentParser
 
 from entity_print import print_json_string
+from entity_stream import add_batch_arguments, run_batch
+from schema_types import load_type_map
 
+example_pattern = re.compile(r'^example(-\d+)?\.json$')
 
-def keyValues_2_normalized(entity):
+# Map {entity type: {attribute: NGSI type}}, loaded once per process
+schema_type_map = None
+
+
+# Guesses the NGSI type of an attribute from its name
+# Used for the attributes whose type is not given by a schema
+def guess_type(key):
+    out = None
+
+    if key == 'location':
+        out = 'geo:json'
+
+    if key.startswith('date'):
+        out = 'DateTime'
+
+    if key == 'address':
+        out = 'PostalAddress'
+
+    if key.startswith('ref'):
+        out = 'Relationship'
+
+    if key.startswith('has'):
+        out = 'Relationship'
+
+    return out
+
+
+# type_map is the map {entity type: {attribute: NGSI type}} generated from the
+# schemas (see schema_types.load_type_map)
+def keyValues_2_normalized(entity, type_map=None):
     out = {}
 
+    attr_types = None
+    if type_map is not None:
+        attr_types = type_map.get(entity.get('type'))
+
     for key in entity:
         if key == 'id' or key == 'type':
             out[key] = entity[key]
@@ -29,22 +68,76 @@ def keyValues_2_normalized(entity):
             'value': entity[key]
         }
 
-        if key == 'location':
-            out[key]['type'] = 'geo:json'
+        attr_type = None
+        if attr_types is not None:
+            attr_type = attr_types.get(key)
+        if attr_type is None:
+            attr_type = guess_type(key)
 
-        if key.startswith('date'):
-            out[key]['type'] = 'DateTime'
+        if attr_type is not None:
+            out[key]['type'] = attr_type
 
-        if key == 'address':
-            out[key]['type'] = 'PostalAddress'
+    return out
 
-        if key.startswith('ref'):
-            out[key]['type'] = 'Relationship'
 
-        if key.startswith('has'):
-            out[key]['type'] = 'Relationship'
+# Converts the examples of the Data Models under specs_dir, and checks that
+# the types which differ from the guessed ones are those given by the schemas
+# Returns the amount of attributes whose type is wrong
+def check_examples(specs_dir):
+    type_map = get_type_map()
+    checked = 0
+    changed = 0
+    wrong = 0
 
-    return out
+    for folder, _, files in sorted(os.walk(specs_dir)):
+        for f in sorted(files):
+            if not example_pattern.match(f):
+                continue
+            data = read_json(os.path.join(folder, f))
+            if not isinstance(data, dict):
+                continue
+
+            attr_types = type_map.get(data.get('type'), {})
+            typed = keyValues_2_normalized(data, type_map)
+            guessed = keyValues_2_normalized(data)
+
+            for key in typed:
+                if key == 'id' or key == 'type':
+                    continue
+                checked += 1
+                attr_type = typed[key].get('type')
+                if attr_type == guessed[key].get('type'):
+                    continue
+                if attr_type is not None and attr_type == attr_types.get(key):
+                    changed += 1
+                    continue
+                wrong += 1
+                print('{}: {} typed as {}, guessed as {}'.format(os.path.join(folder, f), key, attr_type,
+                                                                 guessed[key].get('type')))
+
+    print('{} attributes checked, {} typed from the schemas, {} wrong'.format(checked, changed, wrong))
+
+    return wrong
+
+
+def convert(entity):
+    return keyValues_2_normalized(entity, get_type_map())
+
+
+def get_type_map():
+    global schema_type_map
+
+    if schema_type_map is None:
+        schema_type_map = load_type_map()
+
+    return schema_type_map
+
+
+# Worker initializer, the type map is built once by the parent process
+def set_type_map(type_map):
+    global schema_type_map
+
+    schema_type_map = type_map
 
 
 def read_json(infile):
@@ -62,13 +155,31 @@ def write_json(data, outfile):
 
 def main(args):
     data = read_json(args[1])
-    result = keyValues_2_normalized(data)
+    result = convert(data)
     write_json(result, 'example-normalized.json')
 
 
+def main_batch(argv):
+    parser = ArgumentParser(prog='keyValues2Normalized')
+    add_batch_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # The type map is built here, and given once to every worker, which never writes the cache
+    run_batch(args, convert, initializer=set_type_map, initargs=(get_type_map(),))
+
+
 if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--check-examples':
+        exit(1 if check_examples(sys.argv[2]) > 0 else 0)
+
+    if '--batch' in sys.argv:
+        main_batch(sys.argv[1:])
+        exit(0)
+
     if len(sys.argv) != 2:
         print("Usage: keyvalues2Normalized [file]")
+        print("       keyvalues2Normalized --batch [--workers N] [--unordered] [input file|-] [output file|-]")
+        print("       keyvalues2Normalized --check-examples [specs folder]")
         exit(-1)
 
     main(sys.argv)
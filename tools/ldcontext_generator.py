@@ -14,25 +14,15 @@ Copyright (c) 2019 FIWARE Foundation e.V.
 Authors: José M. Cantera, Dmitrii Demin
 """
 
+import hashlib
 import json
 import yaml
 import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 from argparse import ArgumentParser
 
-# The aggregated @context will be stored here
-aggregated_context = {
-}
-
-# The list of mappings (term->schema/specification) will be stored here
-terms_list = {
-    "terms": {}
-}
-
-# The list of terms alerts will be stored here (if the specification file
-# associated with the term doesn't exist)
-alert_list = [
-]
+from schema_index import SchemaIndex
 
 # Template to prepare a valid URL of a schema for a term mapping
 schema_url = 'https://fiware.github.io/data-models/{}'
@@ -41,6 +31,11 @@ specification_url = 'https://fiware-datamodels.readthedocs.io/en/latest/{}'
 # Agri* schemas stored at another github organization
 agri_url = 'https://github.com/GSMADeveloper/NGSI-LD-Entities/blob/master/definitions/{}.md'
 
+# Incremental mode: extraction results of each schema, keyed by file path
+# The previous manifest is read from and the new one written to this file
+default_manifest = 'ldcontext_manifest.json'
+manifest_version = 1
+
 # Used to detect attributes which are actually relationships
 ENTITY_ID = 'https://fiware.github.io/data-models/common-schema.json#/definitions/EntityIdentifierType'
 
@@ -58,42 +53,32 @@ def write_json(data, outfile):
         data_file.write("\n")
 
 
+# The libyaml based dumper is much faster, when available
+yaml_dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+
+
 def write_yaml(data, outfile):
     with open(outfile, 'w') as data_file:
-        data_file.write(yaml.dump(data))
+        data_file.write(yaml.dump(data, Dumper=yaml_dumper))
 
 
 # Finds a node in a JSON Schema
 # (previously parsed as a Python dictionary)
-
-
 def find_node(schema, node_name):
-    result = None
-
-    if isinstance(schema, list):
-        for instance in schema:
-            res = find_node(instance, node_name)
-            if res is not None:
-                result = res
-                break
-    elif isinstance(schema, dict):
-        for member in schema:
-            if member == node_name:
-                result = schema[member]
-                break
-            else:
-                res = find_node(schema[member], node_name)
-                if res is not None:
-                    result = res
-                    break
+    return SchemaIndex(schema, [node_name]).find(node_name)
 
-    return result
+
+# Members looked up by the extractors below
+indexed_members = ['properties', '$ref', 'enum', 'format']
 
 
 # extracts the properties dictionary
 # A list of dictionaries is returned
-def extract_properties(schema):
-    properties = find_node(schema, 'properties')
+def extract_properties(schema, index=None):
+    if index is None:
+        index = SchemaIndex(schema, indexed_members)
+
+    properties = index.find('properties')
 
     out = []
 
@@ -106,15 +91,15 @@ def extract_properties(schema):
             prop['type'] = 'Property'
             prop['name'] = p
 
-            ref = find_node(properties[p], '$ref')
+            ref = index.find('$ref', properties[p])
             if ref is not None and ref == ENTITY_ID:
                 prop['type'] = 'Relationship'
 
-            enum = find_node(properties[p], 'enum')
+            enum = index.find('enum', properties[p])
             if enum is not None:
                 prop['isEnumerated'] = True
 
-            pformat = find_node(properties[p], 'format')
+            pformat = index.find('format', properties[p])
             if pformat is not None and pformat == 'date-time':
                 prop['isDate'] = True
 
@@ -124,10 +109,13 @@ def extract_properties(schema):
 
 
 # extracts the entity type
-def extract_entity_type(schema):
+def extract_entity_type(schema, index=None):
+    if index is None:
+        index = SchemaIndex(schema, indexed_members)
+
     out = None
 
-    properties = find_node(schema, 'properties')
+    properties = index.find('properties')
 
     if properties is not None and 'type' in properties:
         type_node = properties['type']
@@ -139,10 +127,13 @@ def extract_entity_type(schema):
 
 
 # extracts the enumerations
-def extract_enumerations(schema):
+def extract_enumerations(schema, index=None):
+    if index is None:
+        index = SchemaIndex(schema, indexed_members)
+
     out = []
 
-    properties = find_node(schema, 'properties')
+    properties = index.find('properties')
 
     if properties is None:
         return out
@@ -150,7 +141,7 @@ def extract_enumerations(schema):
     for p in properties:
         if p != 'type':
             prop = properties[p]
-            enum = find_node(prop, 'enum')
+            enum = index.find('enum', prop)
             if enum is not None:
                 if isinstance(enum, list):
                     for item in enum:
@@ -213,11 +204,27 @@ def generate_ld_context_enums(properties, uri_prefix, predefined_mappings):
     return context
 
 
+# Extracts from the schema the properties, entity type and enumerations
+def extract_schema(schema):
+    index = SchemaIndex(schema, indexed_members)
+
+    return {
+        'properties': extract_properties(schema, index),
+        'entityType': extract_entity_type(schema, index),
+        'enumerations': extract_enumerations(schema, index)
+    }
+
+
 # Extracts from the schema the relevant JSON-LD @context
 def schema_2_ld_context(schema, uri_prefix, predefined_mappings):
-    properties = extract_properties(schema)
-    entity_type = extract_entity_type(schema)
-    enumerations = extract_enumerations(schema)
+    return extraction_2_ld_context(extract_schema(schema), uri_prefix, predefined_mappings)
+
+
+# Generates the JSON-LD @context from the result of extract_schema
+def extraction_2_ld_context(extraction, uri_prefix, predefined_mappings):
+    properties = extraction['properties']
+    entity_type = extraction['entityType']
+    enumerations = extraction['enumerations']
 
     ld_context = dict()
 
@@ -235,46 +242,135 @@ def schema_2_ld_context(schema, uri_prefix, predefined_mappings):
     return ld_context
 
 
-def process_file(input_file, uri_prefix, predefined_mappings, terms_mappings):
-    if os.path.isfile(input_file) and input_file.endswith('schema.json'):
-        print(input_file)
-        aggregate_ld_context(
-            input_file,
-            uri_prefix,
-            predefined_mappings,
-            terms_mappings)
-    elif os.path.isdir(input_file):
-        for f in (os.listdir(input_file)):
-            process_file(os.path.join(input_file, f),
-                         uri_prefix, predefined_mappings, terms_mappings)
-
-
-def aggregate_ld_context(f, uri_prefix, predefined_mappings, terms_mappings):
-    global aggregated_context
-    global terms_list
-    global alert_list
-
-    schema = read_json(f)
-    ld_context = schema_2_ld_context(schema, uri_prefix, predefined_mappings)
-
-    for t in ld_context:
-        for p in ld_context[t]:
-            aggregated_context[p] = ld_context[t][p]
-
-            # adding related specifications and schemas
-            if p not in terms_list['terms']:
-                terms_list['terms'][p] = {'specifications': list(),
-                                          'schemas': list(),
-                                          'type': t}
-
-            terms_list['terms'][p]['schemas'].append(
-                schema_url.format(f.split('../')[1]))
-
-            file_to_add = find_file(f, terms_mappings)
-            if file_to_add:
-                terms_list['terms'][p]['specifications'].append(file_to_add)
-            else:
-                alert_list.append(f)
+# Discovery phase: returns the schema files found under input_file
+# (or input_file itself), sorted so that the result does not depend on
+# the order in which the file system lists directories
+def find_schemas(input_file):
+    out = []
+
+    if os.path.isfile(input_file):
+        if input_file.endswith('schema.json'):
+            out.append(input_file)
+        return out
+
+    with os.scandir(input_file) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.is_dir():
+                out.extend(find_schemas(entry.path))
+            elif entry.is_file() and entry.name.endswith('schema.json'):
+                out.append(entry.path)
+
+    return out
+
+
+def file_hash(f):
+    with open(f, 'rb') as data_file:
+        return hashlib.sha1(data_file.read()).hexdigest()
+
+
+# Extraction phase (run by the workers): the properties, entity type
+# and enumerations of a schema file, together with its mtime and hash
+def extract_file(f):
+    entry = extract_schema(read_json(f))
+    entry['mtime'] = os.path.getmtime(f)
+    entry['hash'] = file_hash(f)
+
+    return entry
+
+
+# Returns the entry of the previous manifest if the file has not changed
+# (same modification time or, if it was touched, same content)
+def cached_entry(f, previous_manifest):
+    entry = previous_manifest.get(f)
+
+    if entry is not None and entry['mtime'] != os.path.getmtime(f):
+        if entry['hash'] == file_hash(f):
+            entry['mtime'] = os.path.getmtime(f)
+        else:
+            entry = None
+
+    return entry
+
+
+# Returns the extraction results {file: entry} of all the files.
+# Files not found in the previous manifest are extracted on a pool of workers
+def extract_files(files, previous_manifest, workers):
+    out = dict()
+    pending = []
+
+    for f in files:
+        entry = cached_entry(f, previous_manifest)
+        if entry is None:
+            pending.append(f)
+        else:
+            out[f] = entry
+
+    if workers > 1 and len(pending) > 1:
+        chunk_size = max(1, len(pending) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(extract_file, pending, chunksize=chunk_size))
+    else:
+        results = [extract_file(f) for f in pending]
+
+    for f, entry in zip(pending, results):
+        print(f)
+        out[f] = entry
+
+    return out
+
+
+# Merge phase: builds the aggregated @context, the list of mappings
+# (term->schema/specification) and the list of alerts (schemas whose
+# specification file doesn't exist) from the extraction results,
+# following the order of files
+def merge_ld_contexts(files, extractions, uri_prefix, predefined_mappings, terms_mappings):
+    aggregated_context = dict()
+    terms_list = {
+        'terms': {}
+    }
+    alert_list = []
+
+    for f in files:
+        ld_context = extraction_2_ld_context(extractions[f], uri_prefix, predefined_mappings)
+        schema = schema_url.format(f.split('../')[1])
+        specification = find_file(f, terms_mappings)
+
+        for t in ld_context:
+            for p in ld_context[t]:
+                aggregated_context[p] = ld_context[t][p]
+
+                # adding related specifications and schemas
+                if p not in terms_list['terms']:
+                    terms_list['terms'][p] = {'specifications': list(),
+                                              'schemas': list(),
+                                              'type': t}
+
+                terms_list['terms'][p]['schemas'].append(schema)
+
+                if specification:
+                    terms_list['terms'][p]['specifications'].append(specification)
+                else:
+                    alert_list.append(f)
+
+    return aggregated_context, terms_list, alert_list
+
+
+def read_manifest(infile):
+    try:
+        data = read_json(infile)
+    except (IOError, ValueError):
+        return {}
+
+    if data.get('version') != manifest_version:
+        return {}
+
+    return data['schemas']
+
+
+def write_manifest(manifest, outfile):
+    with open(outfile, 'w') as data_file:
+        data_file.write(json.dumps({'version': manifest_version, 'schemas': manifest}, sort_keys=True))
+        data_file.write("\n")
 
 
 # Finds the specification file associated with the term
@@ -302,7 +398,7 @@ def find_file(f, terms_mappings):
         pass
 
 
-def write_context_file():
+def write_context_file(aggregated_context, terms_list):
     print('writing LD @context...' + ' size: ' + str(len(aggregated_context)))
 
     ld_context = {
@@ -320,9 +416,20 @@ def main(args):
     predefined_mappings = read_json('ldcontext_mappings.json')
     terms_mappings = read_json('ldcontext_terms_mappings.json')
 
-    process_file(args.f, uri_prefix, predefined_mappings, terms_mappings)
+    previous_manifest = dict()
+    if args.incremental:
+        previous_manifest = read_manifest(args.manifest)
+
+    files = find_schemas(args.f)
+    extractions = extract_files(files, previous_manifest, args.workers or os.cpu_count() or 1)
+
+    aggregated_context, terms_list, alert_list = merge_ld_contexts(
+        files, extractions, uri_prefix, predefined_mappings, terms_mappings)
+
+    write_context_file(aggregated_context, terms_list)
 
-    write_context_file()
+    if args.incremental:
+        write_manifest(extractions, args.manifest)
 
     print("specification file was  not found for this files")
     print("\n".join(sorted(set(alert_list))))
@@ -333,6 +440,12 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-f', required=True, help='folder')
     parser.add_argument('-u', required=True, help='URI prefix')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='only extract the schemas changed since the previous run')
+    parser.add_argument('--manifest', default=default_manifest,
+                        help='manifest file used by the incremental mode')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of processes extracting schemas (default: number of CPUs)')
 
     arguments = parser.parse_args()
 
@@ -13,12 +13,22 @@ Author: José Manuel Cantera
 
 import sys
 import json
+from argparse import ArgumentParser
+from functools import partial, lru_cache
 
 from rfc3987 import parse
 from entity_print import print_json_string
+from entity_stream import add_batch_arguments, run_batch
 
 etsi_core_context = 'https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld'
 
+# URI schemes which are accepted as they are for ids and Relationship objects
+ld_uri_schemes = ('urn', 'http', 'https')
+ld_uri_prefixes = tuple(scheme + ':' for scheme in ld_uri_schemes)
+
+# Max number of values whose full URI parsing result is remembered
+uri_cache_size = 65536
+
 
 def ngsild_uri(type_part, id_part):
     template = 'urn:ngsi-ld:{}:{}'
@@ -26,15 +36,35 @@ def ngsild_uri(type_part, id_part):
     return template.format(type_part, id_part)
 
 
+# Checks whether a value can be used as it is as an NGSI-LD URI
+# The common prefixes are accepted without parsing, the rest of values
+# go through the (expensive) full URI parsing, whose results are cached
+def is_ld_uri(value):
+    if value.startswith(ld_uri_prefixes):
+        return True
+
+    return has_ld_uri_scheme(value)
+
+
+@lru_cache(maxsize=uri_cache_size)
+def has_ld_uri_scheme(value):
+    try:
+        d = parse(value, rule='URI')
+    except ValueError:
+        return False
+
+    return d['scheme'] in ld_uri_schemes
+
+
+# Returns the hits, misses and size of the URI parsing cache
+def uri_cache_info():
+    return has_ld_uri_scheme.cache_info()
+
+
 # Generates an Entity Id as a URI
 def ld_id(entity_id, entity_type):
     out = entity_id
-    try:
-        d = parse(entity_id, rule='URI')
-        scheme = d['scheme']
-        if scheme != 'urn' and scheme != 'http' and scheme != 'https':
-            raise ValueError
-    except ValueError:
+    if not is_ld_uri(entity_id):
         out = ngsild_uri(entity_type, entity_id)
 
     return out
@@ -43,12 +73,7 @@ def ld_id(entity_id, entity_type):
 # Generates a Relationship's object as a URI
 def ld_object(attribute_name, entity_id):
     out = entity_id
-    try:
-        d = parse(entity_id, rule='URI')
-        scheme = d['scheme']
-        if scheme != 'urn' and scheme != 'http' and scheme != 'https':
-            raise ValueError
-    except ValueError:
+    if not is_ld_uri(entity_id):
         entity_type = ''
         if attribute_name.startswith('ref'):
             entity_type = attribute_name[3:]
@@ -156,9 +181,24 @@ def main(args):
     write_json(result, args[2])
 
 
+def main_batch(argv):
+    parser = ArgumentParser(prog='normalized2LD')
+    add_batch_arguments(parser)
+    parser.add_argument('ld_context', help='Target LD @context')
+    args = parser.parse_args(argv)
+
+    run_batch(args, partial(normalized_2_LD, ld_context_uri=args.ld_context))
+
+
 if __name__ == '__main__':
+    if '--batch' in sys.argv:
+        main_batch(sys.argv[1:])
+        exit(0)
+
     if len(sys.argv) != 4:
         print("Usage: normalized2LD [input file] [output file] [target ld_context]")
+        print("       normalized2LD --batch [--workers N] [--unordered] [input file|-] [output file|-] "
+              "[target ld_context]")
         exit(-1)
 
     main(sys.argv)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+
+Runs an Entity conversion function (normalized_2_LD, keyValues_2_normalized)
+on several processes.
+
+The input stream is split into chunks of Entities which are converted and
+serialized by a pool of workers. By default results are written in input
+order. In unordered mode chunks are written as soon as they are ready.
+The amount of chunks in flight is bounded, so memory does not depend on
+the size of the input.
+
+Copyright (c) 2019 FIWARE Foundation e.V.
+
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from os import cpu_count
+
+from entity_stream import CONVERSION_ERRORS, convert_record, read_records, BatchStats
+
+default_chunk_size = 1000   # Entities per task sent to a worker
+default_pending = 2         # Chunks in flight per worker
+
+
+def default_workers():
+    return cpu_count() or 1
+
+
+# Worker. Decodes (if needed), converts and serializes a chunk of records
+# Returns the serialized lines and the list of errors found
+def convert_chunk(convert, chunk):
+    lines = []
+    errors = []
+
+    for position, record in chunk:
+        try:
+            lines.append(convert_record(convert, record))
+        except CONVERSION_ERRORS as e:
+            errors.append((position, repr(e)))
+
+    return lines, errors
+
+
+def read_chunks(stream, chunk_size):
+    chunk = []
+
+    for record in read_records(stream):
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if len(chunk) > 0:
+        yield chunk
+
+
+def write_result(result, outstream, stats):
+    lines, errors = result
+
+    outstream.writelines(lines)
+    stats.entities += len(lines)
+
+    for position, error in errors:
+        stats.error(position, error)
+
+
+# Converts all the Entities of instream and writes them as NDJSON on outstream
+# convert must be picklable (a module level function or a functools.partial)
+# initializer(*initargs) is run once by every worker process, i.e. to set large read-only data
+def convert_parallel(instream, outstream, convert, workers=None, chunk_size=default_chunk_size,
+                     ordered=True, initializer=None, initargs=()):
+    stats = BatchStats()
+
+    if workers is None:
+        workers = default_workers()
+
+    max_pending = workers * default_pending
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+
+        for chunk in read_chunks(instream, chunk_size):
+            pending.append(executor.submit(convert_chunk, convert, chunk))
+
+            if len(pending) >= max_pending:
+                drain(pending, outstream, stats, ordered, len(pending) - max_pending + 1)
+
+        drain(pending, outstream, stats, ordered, len(pending))
+
+    return stats
+
+
+# Writes the results of at least 'count' pending tasks
+def drain(pending, outstream, stats, ordered, count):
+    written = 0
+
+    while written < count:
+        if ordered:
+            write_result(pending.popleft().result(), outstream, stats)
+            written += 1
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                write_result(future.result(), outstream, stats)
+                written += 1
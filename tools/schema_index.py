@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+
+Index of the members of a JSON Schema (previously parsed as a Python
+dictionary), built with a single traversal.
+
+For each member name it keeps its occurrences in depth-first order, and for
+each object or array the range of occurrences found under it. Finding the
+first occurrence of a member, in the whole schema or under one of its nodes,
+is then a binary search instead of a recursive walk:
+
+    index = SchemaIndex(schema)
+    properties = index.find('properties')
+    index.find('$ref', properties['refDevice'])
+
+Results are the same as the ones of a depth-first search which checks the
+members of each object in order before descending into them.
+
+If only a few member names are going to be looked up, they can be given
+(names=...) so that only those are recorded.
+
+Copyright (c) 2019 FIWARE Foundation e.V.
+
+"""
+
+from bisect import bisect_left, bisect_right
+
+
+class SchemaIndex(object):
+    def __init__(self, schema, names=None):
+        self.schema = schema
+        self.names = names
+
+        # id(node) -> (first, last) order numbers of the members under it
+        # (only for objects and arrays)
+        self.spans = dict()
+        # member name -> (order numbers, values) of its occurrences
+        self.members = dict()
+        # order number of a null occurrence -> last order number of the
+        # object which holds it
+        self.null_ends = dict()
+
+        if names is not None:
+            for name in names:
+                self.members[name] = ([], [])
+
+        self.count = 0
+        self.add_node(schema)
+
+    def add_node(self, node):
+        first = self.count + 1
+
+        if type(node) is dict:
+            members = self.members
+            nulls = []
+            for member, value in node.items():
+                self.count += 1
+                occurrences = members.get(member)
+                if occurrences is not None:
+                    occurrences[0].append(self.count)
+                    occurrences[1].append(value)
+                elif self.names is None:
+                    members[member] = ([self.count], [value])
+
+                value_type = type(value)
+                if value is None:
+                    nulls.append(self.count)
+                elif value_type is dict or value_type is list:
+                    self.add_node(value)
+
+            for order in nulls:
+                self.null_ends[order] = self.count
+        elif type(node) is list:
+            for item in node:
+                item_type = type(item)
+                if item_type is dict or item_type is list:
+                    self.add_node(item)
+
+        self.spans[id(node)] = (first, self.count)
+
+    # Value of the first member called name under node (by default, the
+    # whole schema). None if there is not any
+    def find(self, name, node=None):
+        occurrences = self.members.get(name)
+        span = self.spans.get(id(self.schema if node is None else node))
+
+        if occurrences is None or span is None:
+            return None
+
+        orders, values = occurrences
+        first, last = span
+        i = bisect_left(orders, first)
+
+        # Like a depth-first search, a null value is skipped, and so is the
+        # rest of the object which holds it
+        while i < len(orders) and orders[i] <= last:
+            if values[i] is not None:
+                return values[i]
+            i = bisect_right(orders, self.null_ends[orders[i]], i + 1)
+
+        return None
+
+    # Values of all the members called name, in depth-first order
+    def find_all(self, name):
+        occurrences = self.members.get(name)
+
+        return [] if occurrences is None else list(occurrences[1])
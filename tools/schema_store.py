@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+
+Offline access to the JSON Schemas of the Data Models.
+
+Schemas reference each other through their public URLs
+(i.e. https://fiware.github.io/data-models/common-schema.json). This module
+maps those URLs to the files of this repository so that references can be
+resolved without network access.
+
+Copyright (c) 2019 FIWARE Foundation e.V.
+
+"""
+
+import json
+import os
+
+# Root folder of the repository
+default_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Public URL prefixes of the files of this repository
+base_urls = [
+    'https://fiware.github.io/data-models/',
+    'https://fiware.github.io/dataModels/'
+]
+
+# Remote schemas which have a copy in this repository
+url_aliases = {
+    'http://geojson.org/schema/Geometry.json': 'geometry-schema.json'
+}
+
+GEOMETRY_URL = 'http://geojson.org/schema/Geometry.json'
+
+# Keywords whose value is data, not a (sub)schema
+literal_keywords = ('enum', 'const', 'default', 'examples')
+
+ENTITY_ID = 'https://fiware.github.io/data-models/common-schema.json#/definitions/EntityIdentifierType'
+
+
+# Returns the absolute URL of a '$ref' found in the document doc_url
+def ref_url(doc_url, ref):
+    # Some schemas use '/definitions/...' to refer to their own definitions
+    if ref.startswith('/definitions/'):
+        ref = '#' + ref
+
+    if ref.startswith('#'):
+        return doc_url.split('#')[0] + ref
+
+    return ref
+
+
+def split_url(url):
+    if '#' in url:
+        doc, fragment = url.split('#', 1)
+    else:
+        doc, fragment = url, ''
+
+    return doc, fragment
+
+
+# Returns the node addressed by a fragment, either a JSON pointer
+# ('/definitions/X') or a plain name declared with '$id' ('#Point')
+# None if it does not exist
+def resolve_fragment(document, fragment):
+    if fragment != '' and not fragment.startswith('/'):
+        return find_anchor(document, '#' + fragment)
+
+    return resolve_pointer(document, fragment)
+
+
+def find_anchor(node, anchor):
+    if isinstance(node, dict):
+        if node.get('$id') == anchor:
+            return node
+        children = node.values()
+    elif isinstance(node, list):
+        children = node
+    else:
+        return None
+
+    for child in children:
+        out = find_anchor(child, anchor)
+        if out is not None:
+            return out
+
+    return None
+
+
+# Returns the node addressed by a JSON pointer ('/definitions/X')
+# None if it does not exist
+def resolve_pointer(document, fragment):
+    node = document
+
+    for part in fragment.split('/')[1:]:
+        part = part.replace('~1', '/').replace('~0', '~')
+        if isinstance(node, dict) and part in node:
+            node = node[part]
+        elif isinstance(node, list) and part.isdigit() and int(part) < len(node):
+            node = node[int(part)]
+        else:
+            return None
+
+    return node
+
+
+class SchemaStore(object):
+    def __init__(self, root=default_root):
+        self.root = os.path.abspath(root)
+        self.documents = dict()
+
+    # Path of the file which holds the document of a URL (None if not local)
+    def local_path(self, url):
+        doc, _ = split_url(url)
+
+        if doc in url_aliases:
+            return os.path.join(self.root, url_aliases[doc])
+
+        for prefix in base_urls:
+            if doc.startswith(prefix):
+                return os.path.join(self.root, doc[len(prefix):])
+
+        return None
+
+    # Path relative to the root, used as a stable key
+    def relative_path(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, '/')
+
+    def load(self, path):
+        path = os.path.abspath(path)
+
+        if path not in self.documents:
+            with open(path) as data_file:
+                self.documents[path] = json.loads(data_file.read())
+
+        return self.documents[path]
+
+    # Public URL of a schema file. Its '$id' if present
+    def url_of(self, path):
+        document = self.load(path)
+
+        if isinstance(document, dict) and isinstance(document.get('$id'), str):
+            return document['$id']
+
+        return base_urls[0] + self.relative_path(path)
+
+    # Returns the node addressed by an absolute URL and the path of its file
+    # Raises LookupError if it cannot be resolved locally
+    def resolve(self, url):
+        path = self.local_path(url)
+        if path is None or not os.path.isfile(path):
+            raise LookupError('Schema not available locally: ' + url)
+
+        _, fragment = split_url(url)
+        node = resolve_fragment(self.load(path), fragment)
+        if node is None:
+            raise LookupError('Unresolvable reference: ' + url)
+
+        return node, path
+
+    # Returns a copy of node where every '$ref' has been replaced by (a copy of)
+    # the node it points to, so that the result is self-contained.
+    # deps collects the paths of the files the references were resolved from.
+    # References which cannot be resolved locally are left as they are
+    def inline_refs(self, node, base_url, deps, stack=()):
+        if isinstance(node, list):
+            return [self.inline_refs(item, base_url, deps, stack) for item in node]
+
+        if not isinstance(node, dict):
+            return node
+
+        if isinstance(node.get('$ref'), str):
+            url = ref_url(base_url, node['$ref'])
+            if url in stack:
+                return dict(node)
+            try:
+                target, path = self.resolve(url)
+            except LookupError:
+                return dict(node)
+            deps.add(path)
+            return self.inline_refs(target, url, deps, stack + (url,))
+
+        out = dict()
+        for key in node:
+            if key == '$id' and len(stack) > 0:
+                # Only meaningful in the document where it was declared
+                continue
+            if key in literal_keywords:
+                out[key] = node[key]
+            else:
+                out[key] = self.inline_refs(node[key], base_url, deps, stack)
+
+        return out
+
+    # Lists all the schema.json files under a folder
+    def find_schemas(self, folder):
+        out = []
+
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames.sort()
+            if 'schema.json' in filenames:
+                out.append(os.path.join(dirpath, 'schema.json'))
+
+        return out
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+
+Builds, from the JSON Schema of each Data Model, the NGSI type of each of its
+attributes:
+
+ - Relationship, for references to EntityIdentifierType (or arrays of them)
+ - geo:json, for references to GeoJSON geometries
+ - DateTime, for strings with format date-time
+ - PostalAddress, for the address structure
+
+The result is a map {entity type: {attribute: NGSI type}}. As building it
+requires parsing and resolving all the schemas, it is cached on disk. Each
+cached entry is reused while the schema and all the files it references keep
+their modification time.
+
+Copyright (c) 2019 FIWARE Foundation e.V.
+
+"""
+
+import json
+import os
+import tempfile
+
+from schema_store import SchemaStore, ref_url, GEOMETRY_URL, ENTITY_ID
+
+default_cache_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.schema_types_cache.json')
+
+cache_version = 1
+
+# Max depth when following '$ref' chains
+max_ref_depth = 16
+
+combinators = ('allOf', 'anyOf', 'oneOf')
+
+
+# Returns the NGSI type of a property node, None if it has no special type
+def attribute_type(store, name, node, doc_url, deps, depth=0):
+    if not isinstance(node, dict) or depth > max_ref_depth:
+        return None
+
+    if '$ref' in node:
+        url = ref_url(doc_url, node['$ref'])
+        if url == ENTITY_ID:
+            return 'Relationship'
+        if url.startswith(GEOMETRY_URL):
+            return 'geo:json'
+        try:
+            target, path = store.resolve(url)
+        except LookupError:
+            return None
+        deps.add(path)
+        return attribute_type(store, name, target, url, deps, depth + 1)
+
+    if node.get('format') == 'date-time':
+        return 'DateTime'
+
+    if name == 'address' and node.get('type') == 'object':
+        return 'PostalAddress'
+
+    if node.get('type') == 'array' and 'items' in node:
+        if attribute_type(store, name, node['items'], doc_url, deps, depth + 1) == 'Relationship':
+            return 'Relationship'
+
+    for key in combinators:
+        for sub_node in node.get(key, []):
+            out = attribute_type(store, name, sub_node, doc_url, deps, depth + 1)
+            if out is not None:
+                return out
+
+    return None
+
+
+# Collects the properties of a schema, following '$ref' and combinators
+def collect_properties(store, node, doc_url, deps, out, depth=0):
+    if not isinstance(node, dict) or depth > max_ref_depth:
+        return
+
+    if '$ref' in node:
+        url = ref_url(doc_url, node['$ref'])
+        try:
+            target, path = store.resolve(url)
+        except LookupError:
+            return
+        deps.add(path)
+        collect_properties(store, target, url, deps, out, depth + 1)
+
+    properties = node.get('properties')
+    if isinstance(properties, dict):
+        for name in properties:
+            if name not in out:
+                out[name] = (properties[name], doc_url)
+
+    for key in combinators:
+        for sub_node in node.get(key, []):
+            collect_properties(store, sub_node, doc_url, deps, out, depth + 1)
+
+
+# Compiles one schema. Returns the entry stored in the cache
+def compile_schema(store, schema_file):
+    deps = set([os.path.abspath(schema_file)])
+    properties = dict()
+
+    collect_properties(store, store.load(schema_file), store.url_of(schema_file), deps, properties)
+
+    entity_type = None
+    type_node = properties.get('type', (None, None))[0]
+    if isinstance(type_node, dict) and len(type_node.get('enum', [])) > 0:
+        entity_type = type_node['enum'][0]
+
+    attributes = dict()
+    for name in properties:
+        if name == 'id' or name == 'type':
+            continue
+        node, doc_url = properties[name]
+        ngsi_type = attribute_type(store, name, node, doc_url, deps)
+        if ngsi_type is not None:
+            attributes[name] = ngsi_type
+
+    return {
+        'entityType': entity_type,
+        'attributes': attributes,
+        'deps': dict((store.relative_path(d), os.path.getmtime(d)) for d in deps)
+    }
+
+
+def is_fresh(store, entry):
+    for dep in entry['deps']:
+        path = os.path.join(store.root, dep)
+        if not os.path.isfile(path) or os.path.getmtime(path) != entry['deps'][dep]:
+            return False
+
+    return True
+
+
+def read_cache(cache_file):
+    try:
+        with open(cache_file) as data_file:
+            cache = json.loads(data_file.read())
+    except (IOError, ValueError):
+        return {}
+
+    if cache.get('version') != cache_version:
+        return {}
+
+    return cache.get('schemas', {})
+
+
+# Written to a temporary file of its own and moved, so concurrent writers never see a partial cache
+def write_cache(cache_file, schemas):
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file)), suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'w') as data_file:
+            data_file.write(json.dumps({'version': cache_version, 'schemas': schemas}))
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+# Returns the map {entity type: {attribute: NGSI type}} for all the schemas
+# found under specs_dir. Only new or modified schemas are compiled
+def load_type_map(specs_dir=None, cache_file=default_cache_file):
+    store = SchemaStore()
+
+    if specs_dir is None:
+        specs_dir = os.path.join(store.root, 'specs')
+
+    if not os.path.isdir(specs_dir):
+        return {}
+
+    cached = read_cache(cache_file) if cache_file else {}
+    schemas = dict()
+    changed = False
+
+    for schema_file in store.find_schemas(specs_dir):
+        key = store.relative_path(schema_file)
+        entry = cached.get(key)
+
+        if entry is None or not is_fresh(store, entry):
+            try:
+                entry = compile_schema(store, schema_file)
+            except ValueError:
+                # Not a valid JSON file
+                continue
+            changed = True
+
+        schemas[key] = entry
+
+    if cache_file and (changed or len(schemas) != len(cached)):
+        write_cache(cache_file, schemas)
+
+    type_map = dict()
+    for key in sorted(schemas):
+        entry = schemas[key]
+        if entry['entityType'] is not None:
+            type_map.setdefault(entry['entityType'], dict()).update(entry['attributes'])
+
+    return type_map
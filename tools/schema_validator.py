@@ -0,0 +1,272 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+
+Validates NGSI Entities (key-values representation) against the JSON Schemas
+of the Data Models, in process and without network access.
+
+All the schemas are loaded once. '$ref's to common-schema.json,
+geometry-schema.json and the domain schemas are resolved from the local
+files of the repository and inlined, so each schema becomes self-contained.
+Each schema is compiled into a reusable validator, looked up by the Entity
+type it describes:
+
+    validator = ModelValidator()
+    errors = validator.validate(entity)
+
+It can also be used from the command line, as validate.sh:
+ - to validate data files against a schema:
+   schema_validator.py -s ../specs/Parking/OffStreetParking/schema.json -d example.json
+ - to validate the examples (example.json, example-N.json) of all the
+   Data Models under a folder:
+   schema_validator.py -p ../specs
+
+Resolved schemas are cached on disk (.schema_validator_cache.json), keyed by
+the content hash of the schema and of every file it references. On a warm
+start schemas are neither parsed nor resolved again; when a file changes only
+the schemas which depend on it are resolved again.
+
+Formats (date-time, uri, ...) are checked only if the checkers of the
+jsonschema format extra are installed (pip install 'jsonschema[format]',
+as in requirements.txt), otherwise any value passes.
+
+Copyright (c) 2019 FIWARE Foundation e.V.
+
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+from argparse import ArgumentParser
+
+from jsonschema import Draft7Validator, FormatChecker
+from jsonschema.validators import validator_for
+
+from schema_store import SchemaStore
+
+example_pattern = re.compile(r'^example(-\d+)?\.json$')
+
+default_cache_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.schema_validator_cache.json')
+
+cache_version = 1
+
+
+class ModelValidator(object):
+    def __init__(self, root=None, specs_dir=None, cache_file=default_cache_file):
+        self.store = SchemaStore() if root is None else SchemaStore(root)
+        self.cache_file = cache_file
+
+        # path -> content hash of the files read during this run
+        self.hashes = dict()
+
+        # Resolved schemas, loaded from / saved to the cache file
+        self.cache = read_cache(cache_file) if cache_file else {}
+        self.cache_changed = False
+
+        # schema file -> compiled validator
+        self.validators = dict()
+        # entity type -> schema file
+        self.schema_files = dict()
+
+        if specs_dir is None:
+            specs_dir = os.path.join(self.store.root, 'specs')
+
+        if os.path.isdir(specs_dir):
+            for schema_file in self.store.find_schemas(specs_dir):
+                self.add_schema(schema_file)
+
+        self.save_cache()
+
+    def file_hash(self, path):
+        if path not in self.hashes:
+            with open(path, 'rb') as data_file:
+                self.hashes[path] = hashlib.sha1(data_file.read()).hexdigest()
+
+        return self.hashes[path]
+
+    # A cached entry is valid while the schema and all the files it
+    # references keep the same content
+    def is_fresh(self, entry):
+        for dep in entry['deps']:
+            path = os.path.join(self.store.root, dep)
+            if not os.path.isfile(path) or self.file_hash(path) != entry['deps'][dep]:
+                return False
+
+        return True
+
+    # Returns the schema with all its '$ref's resolved, from the cache if
+    # possible. Otherwise it is parsed and resolved, and the cache updated
+    def resolved_schema(self, schema_file):
+        key = self.store.relative_path(schema_file)
+        entry = self.cache.get(key)
+
+        if entry is not None and self.is_fresh(entry):
+            return entry['schema']
+
+        deps = set([schema_file])
+        schema = self.store.inline_refs(self.store.load(schema_file), self.store.url_of(schema_file), deps)
+
+        self.cache[key] = {
+            'deps': dict((self.store.relative_path(d), self.file_hash(d)) for d in deps),
+            'schema': schema
+        }
+        self.cache_changed = True
+
+        return schema
+
+    def save_cache(self):
+        if self.cache_file and self.cache_changed:
+            write_cache(self.cache_file, self.cache)
+            self.cache_changed = False
+
+    # Compiles a schema file and registers it for its Entity type
+    def add_schema(self, schema_file):
+        schema_file = os.path.abspath(schema_file)
+
+        if schema_file in self.validators:
+            return self.validators[schema_file]
+
+        schema = self.resolved_schema(schema_file)
+
+        cls = validator_for(schema, default=Draft7Validator)
+        # FormatChecker checks date-time only with the format extra installed (jsonschema[format])
+        validator = cls(schema, format_checker=FormatChecker())
+
+        self.validators[schema_file] = validator
+
+        entity_type = schema_entity_type(schema)
+        if entity_type is not None and entity_type not in self.schema_files:
+            self.schema_files[entity_type] = schema_file
+
+        return validator
+
+    def entity_types(self):
+        return sorted(self.schema_files)
+
+    def validator_for_type(self, entity_type):
+        schema_file = self.schema_files.get(entity_type)
+        if schema_file is None:
+            return None
+
+        return self.validators[schema_file]
+
+    # Returns the list of errors (as strings) of an Entity
+    # Raises LookupError if there is no schema for its type
+    def validate(self, entity, schema_file=None):
+        if schema_file is not None:
+            validator = self.add_schema(schema_file)
+        else:
+            validator = self.validator_for_type(entity.get('type'))
+            if validator is None:
+                raise LookupError('No schema for Entity type: ' + str(entity.get('type')))
+
+        return [format_error(error) for error in validator.iter_errors(entity)]
+
+    def is_valid(self, entity, schema_file=None):
+        return len(self.validate(entity, schema_file)) == 0
+
+
+def read_cache(cache_file):
+    try:
+        with open(cache_file) as data_file:
+            cache = json.loads(data_file.read())
+    except (IOError, ValueError):
+        return {}
+
+    if cache.get('version') != cache_version:
+        return {}
+
+    return cache.get('schemas', {})
+
+
+def write_cache(cache_file, schemas):
+    tmp_file = cache_file + '.tmp'
+
+    with open(tmp_file, 'w') as data_file:
+        data_file.write(json.dumps({'version': cache_version, 'schemas': schemas}))
+
+    os.replace(tmp_file, cache_file)
+
+
+def format_error(error):
+    location = '/'.join(str(p) for p in error.absolute_path)
+
+    return '{}: {}'.format(location or '(root)', error.message)
+
+
+# The Entity type is the first value of the 'type' enumeration
+def schema_entity_type(schema):
+    for node in iterate_properties(schema):
+        type_node = node.get('type')
+        if isinstance(type_node, dict) and len(type_node.get('enum', [])) > 0:
+            return type_node['enum'][0]
+
+    return None
+
+
+def iterate_properties(node):
+    if isinstance(node, dict):
+        if isinstance(node.get('properties'), dict):
+            yield node['properties']
+        for key in ('allOf', 'anyOf', 'oneOf'):
+            for sub_node in node.get(key, []):
+                for properties in iterate_properties(sub_node):
+                    yield properties
+
+
+def read_json(infile):
+    with open(infile) as data_file:
+        data = json.loads(data_file.read())
+
+    return data
+
+
+def check_file(validator, data_file, schema_file):
+    try:
+        errors = validator.validate(read_json(data_file), schema_file)
+    except ValueError as e:
+        errors = ['invalid JSON: ' + str(e)]
+
+    if len(errors) == 0:
+        print(data_file + ' valid')
+    else:
+        print(data_file + ' invalid')
+        for error in errors:
+            print('    ' + error)
+
+    return len(errors) == 0
+
+
+def main(args):
+    validator = ModelValidator(specs_dir='' if args.p is None else args.p)
+    ok = True
+
+    if args.s is not None:
+        for data_file in args.d:
+            ok = check_file(validator, data_file, args.s) and ok
+    else:
+        for schema_file in validator.store.find_schemas(args.p):
+            folder = os.path.dirname(schema_file)
+            for f in sorted(os.listdir(folder)):
+                if example_pattern.match(f):
+                    ok = check_file(validator, os.path.join(folder, f), schema_file) and ok
+
+    validator.save_cache()
+
+    return ok
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(epilog="Formats (i.e. date-time) are checked only with jsonschema[format] installed")
+    parser.add_argument('-s', help='schema file')
+    parser.add_argument('-d', nargs='+', default=[], help='data files to be validated against the schema')
+    parser.add_argument('-p', help='folder whose Data Models examples are validated')
+
+    arguments = parser.parse_args()
+
+    if (arguments.s is None) == (arguments.p is None):
+        parser.error('either -s or -p is required')
+
+    sys.exit(0 if main(arguments) else 1)
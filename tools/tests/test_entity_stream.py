@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import entity_stream  # noqa: E402
+from entity_stream import BatchStats, convert_stream, read_entities, read_records  # noqa: E402
+from parallel_convert import convert_parallel  # noqa: E402
+
+
+# Conversion which fails on the Entities without type
+def convert(entity):
+    return {'id': entity['id'], 'type': entity['type']}
+
+
+class TestReadRecords(unittest.TestCase):
+    def records(self, text):
+        return list(read_records(io.StringIO(text)))
+
+    def test_ndjson(self):
+        text = '  {"id": "a"}\n\n{"id": "b"}\n   \n{"id": "c"}'
+
+        # Raw lines, numbered from 1, blank lines are skipped but counted
+        self.assertEqual(self.records(text), [(1, '{"id": "a"}\n'), (3, '{"id": "b"}\n'), (5, '{"id": "c"}')])
+        self.assertEqual([e['id'] for e in read_entities(io.StringIO(text))], ['a', 'b', 'c'])
+
+    def test_ndjson_errors(self):
+        errors = []
+        entities = read_entities(io.StringIO('{"id": "a"}\n{not json\n{"id": "b"}\n'),
+                                 on_error=lambda position, e: errors.append(position))
+
+        self.assertEqual([e['id'] for e in entities], ['a', 'b'])
+        self.assertEqual(errors, [2])
+
+    def test_array(self):
+        entities = [{'id': 'a', 'name': 'x, [y]', 'location': {'coordinates': [1, [2, 3]]}},
+                    {'id': 'b', 'name': '] , ['}, [1, 2], 'c', 3]
+        text = ' \n[' + ' , '.join(json.dumps(e) for e in entities) + '\n]\n'
+
+        for chunk_size in [1, 2, 7, 64 * 1024]:
+            with patch.object(entity_stream, 'CHUNK_SIZE', chunk_size):
+                # Decoded elements, numbered from 1
+                self.assertEqual(self.records(text), list(enumerate(entities, 1)), chunk_size)
+
+    def test_empty(self):
+        for text in ['', '  \n ', '[]', ' [ \n ] ']:
+            self.assertEqual(self.records(text), [], text)
+
+    def test_invalid_array(self):
+        for text in ['[{"id": "a"}, {"id": "b"}', '[{"id": "a"} {"id": "b"}]', '[{"id": "a"}, {"id": ']:
+            with patch.object(entity_stream, 'CHUNK_SIZE', 4):
+                with self.assertRaises(ValueError):
+                    self.records(text)
+
+
+class TestConvert(unittest.TestCase):
+    def setUp(self):
+        self.errors = []
+        patcher = patch.object(BatchStats, 'error', lambda stats, position, e: self.errors.append(position))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_errors_sequential_and_parallel(self):
+        # Input, positions of the errors
+        inputs = [
+            ('{"id": "a", "type": "T"}\n{"id": "b"}\n\n{not json\n{"id": "c", "type": "T"}\n[1]\n', [2, 4, 6]),
+            ('[{"id": "a", "type": "T"}, {"id": "b"}, 1, {"id": "c", "type": "T"}, null]', [2, 3, 5])
+        ]
+
+        for text, errors in inputs:
+            outstream = io.StringIO()
+            stats = convert_stream(io.StringIO(text), outstream, convert)
+            sequential = (outstream.getvalue(), stats.entities, self.errors)
+
+            self.errors = []
+            outstream = io.StringIO()
+            stats = convert_parallel(io.StringIO(text), outstream, convert, workers=2, chunk_size=2)
+            parallel = (outstream.getvalue(), stats.entities, self.errors)
+
+            self.assertEqual(sequential, parallel, text)
+            self.assertEqual(stats.entities, 2, text)
+            self.assertEqual(self.errors, errors, text)
+            self.errors = []
+
+
+if __name__ == '__main__':
+    unittest.main()
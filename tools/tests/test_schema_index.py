@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from schema_index import SchemaIndex  # noqa: E402
+from schema_store import SchemaStore  # noqa: E402
+
+specs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'specs')
+
+names = ['properties', '$ref', 'enum', 'format', 'type', 'description', 'items', 'anyOf']
+
+
+# The recursive search which SchemaIndex replaced (ldcontext_generator.py)
+def find_node(schema, node_name):
+    result = None
+
+    if isinstance(schema, list):
+        for instance in schema:
+            res = find_node(instance, node_name)
+            if res is not None:
+                result = res
+                break
+    elif isinstance(schema, dict):
+        for member in schema:
+            if member == node_name:
+                result = schema[member]
+                break
+            else:
+                res = find_node(schema[member], node_name)
+                if res is not None:
+                    result = res
+                    break
+
+    return result
+
+
+class TestSchemaIndex(unittest.TestCase):
+    def assertSameAsFindNode(self, schema, index, name, node=None):
+        expected = find_node(schema if node is None else node, name)
+        # The very same object, not an equal one
+        self.assertIs(index.find(name, node), expected, name)
+
+    def test_same_as_find_node_on_the_schemas(self):
+        for schema_file in SchemaStore().find_schemas(specs_dir):
+            with open(schema_file) as data_file:
+                schema = json.loads(data_file.read())
+
+            for index in [SchemaIndex(schema), SchemaIndex(schema, names)]:
+                for name in names:
+                    self.assertSameAsFindNode(schema, index, name)
+
+                properties = index.find('properties')
+                for prop in properties.values() if isinstance(properties, dict) else []:
+                    for name in names:
+                        self.assertSameAsFindNode(schema, index, name, prop)
+
+    def test_depth_first(self):
+        schema = {
+            'a': {'b': {'name': 1}},
+            'name': 2,
+            'c': [{'name': 3}]
+        }
+        index = SchemaIndex(schema)
+
+        self.assertEqual(index.find('name'), 1)
+        self.assertEqual(index.find('name', schema['c']), 3)
+        self.assertEqual(index.find('name', schema['c'][0]), 3)
+        self.assertIsNone(index.find('name', schema['a']['b']['name']))
+        self.assertIsNone(index.find('other'))
+        self.assertEqual(index.find_all('name'), [1, 2, 3])
+
+    def test_null_values(self):
+        schemas = [
+            # A null match is skipped, the search goes on after the object which holds it
+            {'a': {'name': None}, 'b': {'name': 1}},
+            # but not in the rest of that object
+            {'name': None, 'b': {'name': 1}},
+            {'a': {'name': None, 'b': {'name': 1}}, 'c': {'name': 2}},
+            {'a': [{'name': None, 'b': {'name': 1}}, {'name': 2}]},
+            {'a': {'b': {'name': None}, 'c': {'name': 1}}},
+            # Falsy values are matches
+            {'a': {'name': False}, 'b': {'name': 1}},
+            {'a': {'name': 0}, 'b': {'name': 1}},
+        ]
+
+        for schema in schemas:
+            index = SchemaIndex(schema)
+            self.assertEqual(index.find('name'), find_node(schema, 'name'), schema)
+            self.assertEqual(SchemaIndex(schema, ['name']).find('name'), find_node(schema, 'name'), schema)
+
+            for node in schema.values():
+                self.assertEqual(index.find('name', node), find_node(node, 'name'), schema)
+
+    def test_names(self):
+        schema = {'a': {'name': 1, 'other': 2}}
+        index = SchemaIndex(schema, ['name'])
+
+        self.assertEqual(index.find('name'), 1)
+        self.assertIsNone(index.find('other'))
+
+
+if __name__ == '__main__':
+    unittest.main()
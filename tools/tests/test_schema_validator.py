@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sys
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from schema_store import SchemaStore  # noqa: E402
+from schema_validator import ModelValidator  # noqa: E402
+
+schema = {
+    '$schema': 'http://json-schema.org/schema#',
+    'type': 'object',
+    'allOf': [
+        {
+            'properties': {
+                'type': {'type': 'string', 'enum': ['Thing']},
+                'name': {'$ref': 'https://fiware.github.io/data-models/common-schema.json#/definitions/Name'}
+            }
+        }
+    ]
+}
+
+entity = {'id': 'thing-1', 'type': 'Thing', 'name': 'abcdef'}
+
+
+class TestModelValidatorCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = TemporaryDirectory()
+        self.root = self.folder.name
+        self.cache_file = os.path.join(self.root, 'cache.json')
+
+        self.write('common-schema.json', self.common_schema(10))
+        self.write('specs/Thing/schema.json', schema)
+        self.write('geometry-schema.json', {'type': 'object'})
+
+        # Counts the schemas which are resolved (inline_refs is recursive, only the outer calls count)
+        self.resolved = 0
+        self.depth = 0
+        inline_refs = SchemaStore.inline_refs
+
+        def counting_inline_refs(store, *args, **kwargs):
+            self.resolved += 1 if self.depth == 0 else 0
+            self.depth += 1
+            try:
+                return inline_refs(store, *args, **kwargs)
+            finally:
+                self.depth -= 1
+
+        patcher = patch.object(SchemaStore, 'inline_refs', counting_inline_refs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def common_schema(self, max_length):
+        return {'definitions': {'Name': {'type': 'string', 'maxLength': max_length}}}
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'w') as data_file:
+            data_file.write(content if isinstance(content, str) else json.dumps(content))
+
+    def validator(self):
+        self.resolved = 0
+        return ModelValidator(root=self.root, cache_file=self.cache_file)
+
+    def test_warm_start(self):
+        self.assertTrue(self.validator().is_valid(entity))
+        self.assertEqual(self.resolved, 1)
+
+        # Neither parsed nor resolved again
+        validator = self.validator()
+        self.assertEqual(self.resolved, 0)
+        self.assertEqual(validator.entity_types(), ['Thing'])
+        self.assertTrue(validator.is_valid(entity))
+
+    def test_dependency_changed(self):
+        self.validator()
+
+        self.write('common-schema.json', self.common_schema(5))
+        validator = self.validator()
+
+        self.assertEqual(self.resolved, 1)
+        self.assertEqual(validator.validate(entity), ["name: 'abcdef' is too long"])
+
+    def test_unrelated_file_changed(self):
+        self.validator()
+
+        self.write('geometry-schema.json', {'type': 'string'})
+        self.assertTrue(self.validator().is_valid(entity))
+        self.assertEqual(self.resolved, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()